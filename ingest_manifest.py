@@ -0,0 +1,187 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class IngestManifest:
+    """
+    A local SQLite record of the datasets and files already indexed into ES
+
+    Datasets are keyed by their url and version (ETag, or size when the
+    server sends no ETag), files by the dataset they belong to and their
+    name. Each file keeps the number of rows acknowledged by ES so an
+    interrupted ingest can resume from its last acknowledged chunk. The
+    dataset versions whose edges are in the saved interaction graph of a
+    dataset are kept too, so the zips of a dataset are merged into it once.
+
+    Attributes:
+      path: path of the SQLite file
+    """
+
+    def __init__(self, path="./ingest_manifest.sqlite"):
+        """
+        Open (or create) the manifest
+
+        Attributes:
+          path: path of the SQLite file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS datasets (
+                url TEXT NOT NULL,
+                version TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (url, version)
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                url TEXT NOT NULL,
+                version TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                rows_indexed INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (url, version, file_name)
+            );
+            CREATE TABLE IF NOT EXISTS graphs (
+                dataset TEXT NOT NULL,
+                url TEXT NOT NULL,
+                version TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (dataset, url)
+            );
+        """)
+        self.connection.commit()
+
+    @staticmethod
+    def dataset_version(headers):
+        """
+        Build the version of a remote dataset from its response headers
+
+        Attributes:
+          headers: headers of a HEAD request on the dataset url
+        """
+        etag = headers.get("ETag", "").strip('"')
+        if etag:
+            return f"etag:{etag}"
+        return f"size:{headers.get('Content-Length', '')}"
+
+    def is_dataset_done(self, url, version):
+        """
+        Check if every file of a dataset version has been indexed
+
+        Attributes:
+          url: url of the dataset
+          version: version returned by dataset_version
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM datasets WHERE url = ? AND version = ?", (url, version)
+            ).fetchone()
+        return row is not None and row[0] == "done"
+
+    def mark_dataset_done(self, url, version):
+        """
+        Record that every file of a dataset version has been indexed
+
+        Attributes:
+          url: url of the dataset
+          version: version returned by dataset_version
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO datasets (url, version, status, updated_at) VALUES (?, ?, 'done', ?)",
+                (url, version, _now())
+            )
+            self.connection.commit()
+
+    def file_progress(self, url, version, file_name):
+        """
+        Get the number of rows acknowledged and the status of a file, (0, None) if it was never started
+
+        Attributes:
+          url: url of the dataset the file belongs to
+          version: version returned by dataset_version
+          file_name: name of the CSV file in the dataset
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT rows_indexed, status FROM files WHERE url = ? AND version = ? AND file_name = ?",
+                (url, version, file_name)
+            ).fetchone()
+        if row is None:
+            return 0, None
+        return row[0], row[1]
+
+    def update_file(self, url, version, file_name, rows_indexed, status="in_progress"):
+        """
+        Record the number of rows of a file acknowledged by ES
+
+        Attributes:
+          url: url of the dataset the file belongs to
+          version: version returned by dataset_version
+          file_name: name of the CSV file in the dataset
+          rows_indexed: number of rows acknowledged so far, counted from the start of the file
+          status: "in_progress" or "done"
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (url, version, file_name, rows_indexed, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, version, file_name, rows_indexed, status, _now())
+            )
+            self.connection.commit()
+
+    def indexed_files(self):
+        """
+        Get the files with rows indexed, from any dataset version, as (url, version, file_name), oldest first
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT url, version, file_name FROM files WHERE rows_indexed > 0 OR status = 'done' "
+                "ORDER BY updated_at"
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def graph_sources(self, dataset):
+        """
+        Get the dataset versions whose edges are in the saved graph of a dataset, as {url: version}
+
+        Attributes:
+          dataset: name of the dataset the graph belongs to
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT url, version FROM graphs WHERE dataset = ?", (dataset,)
+            ).fetchall()
+        return dict(rows)
+
+    def set_graph_sources(self, dataset, sources):
+        """
+        Record the dataset versions whose edges are in the saved graph of a dataset, replacing the previous ones
+
+        Attributes:
+          dataset: name of the dataset the graph belongs to
+          sources: {url: version} of the zips the graph was built from
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM graphs WHERE dataset = ?", (dataset,))
+            self.connection.executemany(
+                "INSERT INTO graphs (dataset, url, version, updated_at) VALUES (?, ?, ?, ?)",
+                [(dataset, url, version, _now()) for url, version in sources.items()]
+            )
+            self.connection.commit()
+
+    def close(self):
+        """
+        Close the SQLite connection
+        """
+        self.connection.close()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
@@ -0,0 +1,109 @@
+import ast
+import re
+import sys
+import timeit
+
+# A single or double quoted Python string, escapes included
+_STRING = re.compile(r"""'(?:[^'\\\n\r\x00]|\\[^\x00])*'|"(?:[^"\\\n\r\x00]|\\[^\x00])*\"""")
+# The separator following an item, either a comma or the closing bracket
+_SEPARATOR = re.compile(r"[ \t]*([,\]])[ \t]*")
+_BLANK = re.compile(r"[ \t]*")
+
+
+def parse_list_literal(value):
+    """
+    Parse a Python list literal of strings, such as "['1255650154021113862']", the way the
+    CSV columns hashtags, urls and user_mentions are written in the IO dumps
+
+    Lists of plain quoted strings are decoded with a couple of regexes
+    instead of building a full AST. Anything else (escapes that need
+    decoding, numbers, nested lists, comments...) goes through
+    ast.literal_eval, so the result is always the same as
+    ast.literal_eval, with malformed input giving an empty list.
+
+    Attributes:
+      value: string holding the list literal
+    """
+    if value == "[]":
+        return []
+    items = _parse_simple_list(value)
+    if items is not None:
+        return items
+    try:
+        return ast.literal_eval(value)
+    except Exception:
+        return []
+
+
+def _parse_simple_list(value):
+    """
+    Parse a list of quoted strings, None if value is not one
+    """
+    text = value.strip(" \t")
+    if not text.startswith("["):
+        return None
+    end = len(text)
+    pos = _BLANK.match(text, 1).end()
+    items = []
+    while pos < end:
+        if text[pos] == "]":
+            # Either "[]" or a trailing comma: "['a',]"
+            return items if pos + 1 == end else None
+
+        match = _STRING.match(text, pos)
+        if match is None:
+            return None
+        token = match.group()
+        if "\\" in token:
+            try:
+                items.append(ast.literal_eval(token))
+            except Exception:
+                return None
+        else:
+            items.append(token[1:-1])
+
+        match = _SEPARATOR.match(text, match.end())
+        if match is None:
+            return None
+        pos = match.end()
+        if match.group(1) == "]":
+            return items if pos == end else None
+    return None
+
+
+def _benchmark(values, number=5):
+    """
+    Time parse_list_literal against ast.literal_eval on a list of literals and print the speedup
+
+    Attributes:
+      values: list of list literal strings
+      number: number of passes over the values
+    """
+    def literal_eval(value):
+        try:
+            return ast.literal_eval(value)
+        except Exception:
+            return []
+
+    mismatches = sum(parse_list_literal(value) != literal_eval(value) for value in values)
+    baseline = min(timeit.repeat(lambda: [literal_eval(v) for v in values], number=number, repeat=3))
+    fast = min(timeit.repeat(lambda: [parse_list_literal(v) for v in values], number=number, repeat=3))
+    count = len(values) * number
+    print(f"{len(values)} values, {mismatches} mismatches")
+    print(f"ast.literal_eval:   {count / baseline:12.0f} values/sec")
+    print(f"parse_list_literal: {count / fast:12.0f} values/sec ({baseline / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    # Micro-benchmark on the list columns of a tweets CSV if one is given,
+    # otherwise on the rows sampled from real IO dumps in search_api/mock_data.py
+    columns = ("hashtags", "urls", "user_mentions")
+    if len(sys.argv) > 1:
+        import pandas as pd
+        frame = pd.read_csv(sys.argv[1], dtype=str, keep_default_na=False, usecols=lambda c: c in columns)
+        corpus = [value for col in frame.columns for value in frame[col] if value]
+    else:
+        sys.path.insert(0, "search_api")
+        from mock_data import mock_tweets
+        corpus = [hit["_source"][col] for hit in mock_tweets["hits"]["hits"] for col in columns] * 1000
+    _benchmark(corpus)
@@ -0,0 +1,151 @@
+import re
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# MinHash signatures have num_bands * band_rows values. Two texts share a band,
+# and so end up in the same cluster, with probability 1 - (1 - s^band_rows)^num_bands
+# for a Jaccard similarity s of their shingles: about 50% at s = 0.63, 95% at s = 0.8
+num_bands = 10
+band_rows = 6
+shingle_size = 3
+
+# Prime above 2^32, hash permutations are (a * x + b) mod _PRIME
+_PRIME = np.uint64(4294967311)
+_rng = np.random.default_rng(20240601)
+# a < 2^31 and x < 2^32 keep a * x + b below 2^64
+_A = _rng.integers(1, 2 ** 31, size=(num_bands * band_rows, 1), dtype=np.uint64)
+_B = _rng.integers(0, 2 ** 31, size=(num_bands * band_rows, 1), dtype=np.uint64)
+
+_URL = re.compile(r"https?://\S+")
+_MENTION = re.compile(r"@\w+")
+_RETWEET_PREFIX = re.compile(r"^rt\s+@\w+:\s*")
+_WORD = re.compile(r"\w+")
+
+
+def normalize_text(text):
+    """
+    Words of a tweet text, lowercased and without the retweet prefix, urls and mentions,
+    which change between copies of the same message
+    """
+    text = _RETWEET_PREFIX.sub("", text.lower())
+    text = _MENTION.sub(" ", _URL.sub(" ", text))
+    return _WORD.findall(text)
+
+
+def shingle_hashes(text, size=shingle_size):
+    """
+    32 bit hashes of the word shingles (n-grams) of a tweet text, None if it has no words
+
+    Attributes:
+      text: tweet text
+      size: number of words per shingle, texts shorter than that are a single shingle
+    """
+    words = normalize_text(text)
+    if not words:
+        return None
+    if len(words) <= size:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    # crc32 is the same in every process, unlike hash() on strings
+    return np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                       dtype=np.uint64, count=len(shingles))
+
+
+def minhash_signature(text):
+    """
+    MinHash signature of a tweet text, num_bands * band_rows values, None if it has no words
+
+    Attributes:
+      text: tweet text
+    """
+    hashes = shingle_hashes(text)
+    if hashes is None:
+        return None
+    return ((_A * hashes + _B) % _PRIME).min(axis=1)
+
+
+def lsh_bands(text):
+    """
+    LSH band keys of a tweet text: texts sharing a key are likely near duplicates
+
+    Keys are ints hashed from the band number and its signature values, so
+    they are the same whatever process computes them.
+
+    Attributes:
+      text: tweet text
+    """
+    signature = minhash_signature(text)
+    if signature is None:
+        return None
+    bands = signature.reshape(num_bands, band_rows).tolist()
+    return [hash((band, *values)) for band, values in enumerate(bands)]
+
+
+class ClusterAssigner:
+    """
+    Assigns a cluster_id to every tweet of a dataset from its LSH band keys, in a single pass
+
+    The first tweet of a cluster is its leader, and gives the cluster its
+    tweetid. A later tweet sharing a band key with a leader joins its cluster,
+    otherwise it leads a new one. Only leaders' keys are kept, one LRU table
+    per dataset holding the keys of at most max_leaders clusters: the keys
+    used the longest ago are dropped first, so a copy of a text not seen for a
+    long while may start a new cluster.
+
+    Leaders are yielded before any copy joins them, so they get no cluster_id,
+    like unique tweets, and cluster_id only has a value per actual cluster.
+    populate_IOA.py back-fills the leaders of clusters that got copies once
+    their dataset is indexed.
+
+    Attributes:
+      max_leaders: maximum number of clusters whose keys are kept per dataset
+      leaders: dict of dataset to OrderedDict of band key to cluster_id, least recently used first
+    """
+
+    def __init__(self, max_leaders=200000):
+        self.max_leaders = max_leaders
+        self.leaders = {}
+
+    def assign(self, rows, dataset):
+        """
+        Yield rows with their cluster_id set, the tweetid of the leader of the cluster they join or None,
+        popping the _lsh_bands added by coerce_frame
+
+        Attributes:
+          rows: iterable of coerced row dicts
+          dataset: dataset the rows belong to
+        """
+        leaders = self.leaders.setdefault(dataset, OrderedDict())
+        max_keys = self.max_leaders * num_bands
+        for row in rows:
+            bands = row.pop("_lsh_bands", None)
+            if bands is None:
+                row["cluster_id"] = None
+                yield row
+                continue
+
+            cluster_id = None
+            for key in bands:
+                cluster_id = leaders.get(key)
+                if cluster_id is not None:
+                    leaders.move_to_end(key)
+                    break
+            if cluster_id is None and row.get("tweetid"):
+                for key in bands:
+                    leaders[key] = row["tweetid"]
+                while len(leaders) > max_keys:
+                    leaders.popitem(last=False)
+            row["cluster_id"] = cluster_id
+            yield row
+
+    def forget(self, dataset):
+        """
+        Drop the leaders of a dataset once it is fully indexed
+
+        Attributes:
+          dataset: dataset to forget
+        """
+        self.leaders.pop(dataset, None)
@@ -1,214 +1,1816 @@
-import requests
-import zipfile
+import contextlib
+import csv
+import glob
+import gzip
+import hashlib
+import io
+import itertools
 import os
-import shutil
-import pandas as pd
-from tqdm import tqdm
-from datetime import datetime
-import ast
+import sys
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from urllib.parse import urlparse
 
+import numpy as np
 import pandas as pd
 import requests
-import os
-from tqdm import tqdm
 from elasticsearch import Elasticsearch, helpers
-import csv
+from tqdm import tqdm
 
+from ingest_manifest import IngestManifest
+from list_literal import parse_list_literal
+from near_duplicates import ClusterAssigner, lsh_bands
 
-# Connect to Elasticsearch
-from elasticsearch import Elasticsearch
+# The local search backend is shared with the search API, whose modules import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_api"))
+from accounts import account_aggs, account_document, accounts_mapping
+from cascades import cascade_aggs, cascade_document, cascades_mapping
+from clusters import cluster_aggs, cluster_document, clusters_mapping
+from graph_store import GraphBuilder
+from rollups import rollup_top_k
+from search_backend import SQLiteBackend
+from tweet_columns import (bool_columns, date_columns, id_errors_column, int_columns, list_columns,
+                           parquet_table, tweet_id_columns, user_id_columns)
 
-from elasticsearch import Elasticsearch
 
 # CSV Download and update to elasticsearch instance
 requests.packages.urllib3.disable_warnings()
 
-def download_and_extract_zip(url, destination_folder):
+def storage_url(url):
+    """
+    Modify a google storage url to use storage.googleapis.com, which can be downloaded without a browser session
+
+    Attributes:
+      url: google storage url of a file
+    """
+    return url.replace('https://storage.cloud.google.com', 'https://storage.googleapis.com')
+
+
+def probe_file(url):
+    """
+    Get the headers of a remote file without downloading its body.
+
+    Uses a HEAD request, and falls back to a streamed GET that is closed
+    before the body is read for servers that do not allow HEAD.
+
+    Attributes:
+      url: url of the file to probe
+
+    Returns:
+      the response headers, or None if the file can't be reached
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=60)
+        if response.status_code in (403, 405, 501):
+            with requests.get(url, stream=True, timeout=60) as response:
+                pass
+    except requests.RequestException as e:
+        print(f"Failed to probe {url}: {e}")
+        return None
+
+    if response.status_code != 200:
+        print(f"Failed to probe {url}. Status code: {response.status_code}")
+        return None
+    return response.headers
+
+
+def range_validator(headers):
+    """
+    Validator of a remote file to send as If-Range: its ETag if it is a strong one, else its Last-Modified
+
+    Attributes:
+      headers: response headers of the file
+    """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def download_file(url, destination_path, chunk_size=1024 * 1024, max_retries=3, validator=None):
+    """
+    Stream a file to disk chunk by chunk, resuming partial downloads with HTTP Range requests
+
+    The body is written to destination_path + ".part" and renamed once
+    complete, so an interrupted download (in this run or a previous one) is
+    picked up where it stopped instead of being fetched again. Ranges are
+    sent with If-Range, so if the remote file changed since the partial one
+    was started the server sends it whole and the download starts over.
+
+    Attributes:
+      url: url of the file to download
+      destination_path: where the downloaded file should be placed
+      chunk_size: number of bytes written to disk at a time
+      max_retries: number of times an interrupted transfer is resumed
+      validator: ETag or Last-Modified of the file when it was probed, see range_validator
+
+    Returns:
+      destination_path if the download succeeded, None otherwise
+    """
+    part_path = destination_path + ".part"
+    # Validator of the file the partial download comes from, kept next to it for the next runs
+    validator_path = part_path + ".validator"
+    for attempt in range(max_retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            part_validator = validator
+            if os.path.exists(validator_path):
+                with open(validator_path, encoding="utf-8") as f:
+                    part_validator = f.read() or None
+            if part_validator:
+                headers["If-Range"] = part_validator
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416:
+                    # Nothing left to download, the partial file is complete
+                    break
+                if response.status_code not in (200, 206):
+                    print(f"Failed to download the file. Status code: {response.status_code}")
+                    return None
+
+                # A 200 means the server ignored the range or the file changed, start over
+                mode = "ab" if response.status_code == 206 else "wb"
+                if mode == "wb":
+                    with open(validator_path, "w", encoding="utf-8") as f:
+                        f.write(range_validator(response.headers) or "")
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            break
+        except requests.RequestException as e:
+            print(f"Download of {url} interrupted ({e}), attempt {attempt + 1} of {max_retries + 1}")
+    else:
+        return None
+
+    os.replace(part_path, destination_path)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+    return destination_path
+
+
+def download_zip(url, destination_folder, manifest=None):
     """
     Download zip files to computer based on google storage url link
 
     Attributes:
       url: google storage url of zip file
       destination_folder: folder for where file should be temporarily placed
+      manifest: optional IngestManifest, datasets it marks as done are not downloaded again
+
+    Returns:
+      (path of the downloaded zip file, dataset version) tuple, the path is
+      None if the file was skipped or could not be downloaded
     """
-    # Modify the URL to use storage.googleapis.com
-    url = url.replace('https://storage.cloud.google.com', 'https://storage.googleapis.com')
-    
-    # Send a GET request to the URL to download the zip file
-    response = requests.get(url)
-    
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        # Create the destination folder if it doesn't exist
-        if not os.path.exists(destination_folder):
-            os.makedirs(destination_folder)
-        
-        # Save the downloaded ZIP file
-        zip_file_path = os.path.join(destination_folder, 'downloaded.zip')
-        with open(zip_file_path, 'wb') as f:
-            f.write(response.content)
-        print(f"ZIP file downloaded to {zip_file_path}")
-        
-        # Extract the ZIP file
-        try:
-            with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-                zip_ref.extractall(destination_folder)
-                print(f"ZIP file extracted to {destination_folder}")
-        except zipfile.BadZipFile:
-            print(f"Failed to extract ZIP file, not a valid zip file: {zip_file_path}")
-        
-        # Optionally, you can remove the zip file after extraction
+    headers = probe_file(storage_url(url))
+    if headers is None:
+        return None, None
+    version = IngestManifest.dataset_version(headers)
+    if manifest is not None and manifest.is_dataset_done(url, version):
+        print(f"Skipping {url}, already indexed")
+        return None, version
+
+    url = storage_url(url)
+    if 'application/zip' not in headers.get('Content-Type', '') and not url.endswith('.zip'):
+        print(f"Skipping {url}, not a zip file")
+        return None, version
+
+    # Create the destination folder if it doesn't exist
+    if not os.path.exists(destination_folder):
+        os.makedirs(destination_folder)
+
+    zip_file_path = os.path.join(destination_folder, os.path.basename(urlparse(url).path))
+    if download_file(url, zip_file_path, validator=range_validator(headers)) is None:
+        return None, version
+    if not zipfile.is_zipfile(zip_file_path):
+        print(f"Downloaded file is not a valid zip file: {zip_file_path}")
         os.remove(zip_file_path)
-        print(f"Deleted the ZIP file {zip_file_path}")
+        return None, version
+    print(f"ZIP file downloaded to {zip_file_path}")
+    return zip_file_path, version
+
+
+def iter_csv_members(zip_file_path):
+    """
+    Open the CSV files of a zip archive as decompressed binary streams, without extracting them to disk.
+
+    Plain .csv members are read through ZipFile.open, and gzipped
+    .csv.gz members are decompressed on the fly on top of it.
+
+    Attributes:
+      zip_file_path: path of the zip file
+
+    Returns:
+      generator of (file name, binary file object) tuples, each stream is
+      closed once the caller moves to the next member
+    """
+    try:
+        zip_ref = zipfile.ZipFile(zip_file_path, 'r')
+    except zipfile.BadZipFile:
+        print(f"Failed to open ZIP file, not a valid zip file: {zip_file_path}")
+        return
+
+    with zip_ref:
+        for member in zip_ref.infolist():
+            filename = os.path.basename(member.filename)
+            if member.is_dir() or member.filename.startswith("__MACOSX/"):
+                continue
+            if filename.endswith(".csv"):
+                with zip_ref.open(member) as stream:
+                    yield filename, stream
+            elif filename.endswith(".csv.gz"):
+                with zip_ref.open(member) as compressed, gzip.GzipFile(fileobj=compressed) as stream:
+                    yield filename[:-len(".gz")], stream
+
+
+def download_datasets(urls, destination_folder, max_workers=3, manifest=None):
+    """
+    Download several zip files concurrently, yielding each one as soon as it is ready.
+
+    At most max_workers datasets are on disk at a time, downloading, waiting
+    to be consumed or being indexed: the next download only starts once the
+    caller asks for the next dataset, after it indexed and deleted the zip
+    it was given. The network keeps busy while the caller indexes a dataset
+    without filling up the disk.
+
+    Attributes:
+      urls: iterable of google storage urls of zip files
+      destination_folder: folder where the zip files are downloaded
+      max_workers: number of datasets on disk at a time, including the one being indexed
+      manifest: optional IngestManifest, datasets it marks as done are skipped
+
+    Returns:
+      generator of (url, zip file path, dataset version) tuples, the path is
+      None if the dataset was skipped or the download failed
+    """
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit_next():
+            for url in urls:
+                pending[pool.submit(download_zip, url, destination_folder, manifest)] = url
+                return
+
+        for _ in range(max_workers):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                yield (url, *future.result())
+                # The caller is done with the zip it was given, its slot is free
+                submit_next()
+
+
+# Index settings used while bulk loading, see start_bulk_load
+bulk_load_settings = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+
+# Explicit mapping of the tweet CSV columns, anything else is mapped as a keyword
+tweets_mapping = {
+    "dynamic_templates": [
+        {"strings_as_keywords": {"match_mapping_type": "string", "mapping": {"type": "keyword", "ignore_above": 1024}}}
+    ],
+    "properties": {
+        "tweetid": {"type": "long"},
+        "userid": {"type": "keyword"},
+        "user_display_name": {"type": "text"},
+        "user_screen_name": {"type": "keyword"},
+        "user_reported_location": {"type": "keyword", "ignore_above": 1024},
+        "user_profile_description": {"type": "text"},
+        "user_profile_url": {"type": "keyword", "index": False, "doc_values": False},
+        "follower_count": {"type": "integer"},
+        "following_count": {"type": "integer"},
+        "account_creation_date": {"type": "date"},
+        "account_language": {"type": "keyword"},
+        "tweet_language": {"type": "keyword"},
+        "tweet_text": {"type": "text"},
+        "tweet_time": {"type": "date"},
+        "tweet_client_name": {"type": "keyword"},
+        "in_reply_to_userid": {"type": "keyword"},
+        "in_reply_to_tweetid": {"type": "long"},
+        "quoted_tweet_tweetid": {"type": "long"},
+        "is_retweet": {"type": "boolean"},
+        "retweet_userid": {"type": "keyword"},
+        "retweet_tweetid": {"type": "long"},
+        "latitude": {"type": "keyword"},
+        "longitude": {"type": "keyword"},
+        "quote_count": {"type": "integer"},
+        "reply_count": {"type": "integer"},
+        "like_count": {"type": "integer"},
+        "retweet_count": {"type": "integer"},
+        "hashtags": {"type": "keyword"},      # list of hashtags as keywords
+        "urls": {"type": "keyword"},          # list of full URLs as keywords
+        "user_mentions": {"type": "keyword"},
+        "dataset": {"type": "keyword"},       # single keyword field
+        "file_name": {"type": "keyword"},
+        "id_errors": {"type": "keyword"},     # id columns whose value was lost, see coerce_id_column
+        # Near-duplicate cluster, the tweetid of its first tweet. Unique tweets have none, and
+        # leaders only get theirs from build_clusters once the dataset is indexed
+        "cluster_id": {"type": "keyword"}
+    }
+}
+
+# Rollup documents: the number of tweets of a dataset in a time bucket for one value (key)
+# of a field, or every tweet of the bucket when field is "tweets" and key is empty. The
+# "coverage" document of a dataset, without granularity or bucket, counts the tweets its
+# rollups were built from, the API only uses rollups whose coverage matches the index
+rollups_mapping = {
+    "properties": {
+        "dataset": {"type": "keyword"},
+        "granularity": {"type": "keyword"},   # day, week or month
+        "bucket": {"type": "date"},           # start of the time bucket
+        "field": {"type": "keyword"},         # user_screen_name, hashtags, urls, tweets or coverage
+        "key": {"type": "keyword"},
+        "count": {"type": "long"}
+    }
+}
+
+
+class CountingReader(io.RawIOBase):
+    """
+    Wraps a binary file object and counts the bytes read through it, so that
+    ingest throughput can be reported while the file is streamed
+
+    Attributes:
+      raw: binary file object to read from
+      bytes_read: number of bytes read so far
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self.bytes_read += size
+        return size
+
+
+class ThroughputMeter:
+    """
+    Keeps track of the rows and bytes ingested and periodically prints rows/sec and MB/sec
+
+    Attributes:
+      label: name printed alongside the progress (usually the file name)
+      interval: minimum number of seconds between two progress reports
+    """
+
+    def __init__(self, label, interval=10.0):
+        self.label = label
+        self.interval = interval
+        self.rows = 0
+        self.bytes_read = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def update(self, rows=0, bytes_read=None):
+        """
+        Add processed rows and set the total bytes read, reporting if the interval elapsed
+
+        Attributes:
+          rows: number of newly processed rows
+          bytes_read: total number of bytes read from the source so far
+        """
+        self.rows += rows
+        if bytes_read is not None:
+            self.bytes_read = bytes_read
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        """
+        Print the current throughput
+        """
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        status = "done" if final else "progress"
+        print(f"[{self.label}] {status}: {self.rows} rows in {elapsed:.1f}s "
+              f"({self.rows / elapsed:.0f} rows/sec, {self.bytes_read / elapsed / 1e6:.2f} MB/sec)")
+
+
+def parse_list_column(column):
+    """
+    Parse a column of Python list literals such as "['a', 'b']" into lists
+
+    Empty cells become None, indexed as missing rather than as an empty term, and malformed
+    ones an empty list.
+
+    Attributes:
+      column: pandas Series of strings
+    """
+    values = [parse_list_literal(value) if value else None for value in column.tolist()]
+    return pd.Series(values, index=column.index, dtype=object)
+
+
+def coerce_int_column(column):
+    """
+    Cast a column of strings to int, empty and invalid values become None
+
+    Attributes:
+      column: pandas Series of strings
+    """
+    valid = column.str.fullmatch(r"\s*[+-]?[0-9]+\s*", na=False).to_numpy()
+    result = np.full(len(column), None, dtype=object)
+    result[valid] = pd.to_numeric(column[valid].str.strip()).to_numpy().astype(object)
+    return pd.Series(result, index=column.index, dtype=object)
+
+
+def coerce_date_column(column, date_formats=("%Y-%m-%d %H:%M", "%Y-%m-%d")):
+    """
+    Cast a column of dates to ISO 8601 strings, empty and invalid values become None
+
+    Attributes:
+      column: pandas Series of strings
+      date_formats: formats the dates can be written in, tried in order
+        (tweet_time has minutes, account_creation_date is a plain day)
+    """
+    result = np.full(len(column), None, dtype=object)
+    remaining = (column.notna() & (column != "")).to_numpy()
+    for date_format in date_formats:
+        dates = pd.to_datetime(column.where(remaining), format=date_format, errors="coerce")
+        valid = dates.notna().to_numpy()
+        # 'YYYY-MM-DDTHH:MM:SS', numpy formats the whole array at once where strftime goes cell by cell
+        iso = np.datetime_as_string(dates[valid].to_numpy(dtype="datetime64[s]"), unit="s")
+        result[valid] = iso.astype(object)
+        remaining = remaining & ~valid
+    return pd.Series(result, index=column.index, dtype=object)
+
+
+def coerce_bool_column(column):
+    """
+    Cast a column of "True"/"False" strings to bool, anything else becomes None
+
+    Attributes:
+      column: pandas Series of strings
+    """
+    values = column.str.strip().str.lower()
+    result = np.full(len(column), None, dtype=object)
+    result[(values == "true").to_numpy()] = True
+    result[(values == "false").to_numpy()] = False
+    return pd.Series(result, index=column.index, dtype=object)
+
+
+def canonical_id(value):
+    """
+    Exact integer string of an id written as a float (1.5e+3, 1500.0), None if digits were lost
+
+    Floats only hold every integer below 2^53. A bigger id written with a
+    fraction or an exponent went through a float, so its digits can't be
+    trusted even when they all look there: 1281192377277792256.0 was rounded.
+
+    Attributes:
+      value: id written in scientific notation or with a fraction
+    """
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        return None
+    if not number.is_finite() or number != number.to_integral_value():
+        return None
+    integer = int(number)
+    if integer >= 2 ** 53:
+        return None
+    return str(integer)
+
+
+def coerce_id_column(column, numeric=True):
+    """
+    Normalize a column of ids to canonical integer strings, returns (column, mask of the lost ids)
+
+    Ids exported as floats are turned back into integers when they are below
+    2^53, otherwise they become None and are flagged in the mask.
+
+    Attributes:
+      column: pandas Series of strings
+      numeric: ids must be integers (tweet ids), other values are lost. Otherwise
+        (user ids) values that aren't numbers, such as hashes, are kept as is
+    """
+    values = column.where(column.notna(), "").astype(str).str.strip()
+    result = values.to_numpy(dtype=object).copy()
+    lost = np.zeros(len(values), dtype=bool)
+    empty = (values == "").to_numpy()
+    result[empty] = None
+
+    integers = values.str.fullmatch(r"[0-9]+").to_numpy()
+    # Ids are compared as integers, leading zeros are dropped
+    padded = integers & values.str.startswith("0").to_numpy()
+    result[padded] = values[padded].str.lstrip("0").replace("", "0").to_numpy(dtype=object)
+
+    # Float exports of 64 bit ids have at most 20 digits and a 2 digit exponent, longer values are hashes
+    floats = np.zeros(len(values), dtype=bool)
+    rest = ~(empty | integers)
+    if rest.any():
+        floats[rest] = values[rest].str.fullmatch(r"[0-9]{0,20}\.?[0-9]{1,20}([eE][+-]?[0-9]{1,2})?").to_numpy()
+    for i in np.flatnonzero(floats):
+        result[i] = canonical_id(values.iat[i])
+        lost[i] = result[i] is None
+
+    if numeric:
+        others = ~(empty | integers | floats)
+        result[others] = None
+        lost |= others
+    return pd.Series(result, index=column.index, dtype=object), lost
+
+
+def coerce_distinct(values, coerce):
+    """
+    Apply a column coercion to the distinct values of a column only, and map the results back to every cell
+
+    Repeated cells (counts, dates, empty lists, ids of retweeted tweets...) are
+    coerced once. Equal list cells share the same list.
+
+    Attributes:
+      values: numpy object array of the cells, None for missing ones
+      coerce: function coercing a pandas Series of strings into a Series, or
+        into (Series, mask) like coerce_id_column
+
+    Returns:
+      numpy object array of the coerced cells, or (array, mask) for a (Series, mask) coercion
+    """
+    codes, uniques = pd.factorize(values)
+    # Missing cells get the code -1, which takes the None appended last
+    distinct = pd.Series(np.append(np.asarray(uniques, dtype=object), None), dtype=object)
+    coerced = coerce(distinct)
+    if isinstance(coerced, tuple):
+        column, mask = coerced
+        return column.to_numpy(dtype=object)[codes], np.asarray(mask)[codes]
+    return coerced.to_numpy(dtype=object)[codes]
+
+
+def coerce_frame(frame, lsh=False):
+    """
+    Cast a batch of CSV rows to the types expected in ES, one column at a time
+
+    Each column is coerced on its distinct values, then rows are zipped from
+    the column arrays.
+
+    Attributes:
+      frame: pandas DataFrame of strings, as read by pd.read_csv(dtype=str)
+      lsh: add the LSH band keys of tweet_text to each row as _lsh_bands, for
+        ClusterAssigner. Retweets get none, they are copies by definition
+
+    Returns:
+      list of row dicts
+    """
+    columns = {}
+    for col in frame.columns:
+        values = frame[col].to_numpy(dtype=object)
+        # Make sure no NaN reaches ES, missing cells (short rows) are sent as null
+        missing = pd.isna(values)
+        if missing.any():
+            values = values.copy()
+            values[missing] = None
+        columns[col] = values
+
+    # Normalize ids to exact integer strings, listing the id columns of each row whose value was lost
+    id_columns = sorted((tweet_id_columns | user_id_columns).intersection(columns))
+    if id_columns:
+        errors = np.full(len(frame), None, dtype=object)
+        for col in id_columns:
+            numeric = col in tweet_id_columns
+            columns[col], lost = coerce_distinct(columns[col], partial(coerce_id_column, numeric=numeric))
+            for i in np.flatnonzero(lost):
+                errors[i] = (errors[i] or []) + [col]
+        columns[id_errors_column] = errors
+
+    # Ensure appropriate columns inserted as int
+    for col in int_columns.intersection(columns):
+        columns[col] = coerce_distinct(columns[col], coerce_int_column)
+
+    # Ensure appropriate columns inserted as date
+    for col in date_columns.intersection(columns):
+        columns[col] = coerce_distinct(columns[col], coerce_date_column)
+
+    # Ensure appropriate columns inserted as bool
+    for col in bool_columns.intersection(columns):
+        columns[col] = coerce_distinct(columns[col], coerce_bool_column)
+
+    # Parse hashtags, urls, and user_mentions into proper list
+    for col in list_columns.intersection(columns):
+        columns[col] = coerce_distinct(columns[col], parse_list_column)
+
+    names = list(columns)
+    rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+    if lsh and "tweet_text" in columns:
+        # Signatures are computed here so they run on the coercion workers
+        for row in rows:
+            text = row["tweet_text"]
+            row["_lsh_bands"] = lsh_bands(text) if text and row.get("is_retweet") is not True else None
+    return rows
+
+
+def read_csv_batches(file, batch_size=10000, skip_rows=0):
+    """
+    Read a CSV file as DataFrames of strings of at most batch_size rows
+
+    Attributes:
+      file: text file object of the CSV
+      batch_size: number of rows per DataFrame
+      skip_rows: number of rows to drop at the start of the file
+    """
+    try:
+        batches = pd.read_csv(file, dtype=str, keep_default_na=False, na_filter=False,
+                              chunksize=batch_size, on_bad_lines="warn")
+    except pd.errors.EmptyDataError:
+        return
+
+    with batches:
+        for frame in batches:
+            if skip_rows >= len(frame):
+                skip_rows -= len(frame)
+                continue
+            if skip_rows:
+                frame = frame.iloc[skip_rows:]
+                skip_rows = 0
+            yield frame
+
+
+def iter_coerced_rows(batches, executor=None, max_pending=8, lsh=False):
+    """
+    Yield coerced rows in file order, optionally spreading the coercion over a pool of workers.
+
+    At most max_pending batches are in flight at once so memory stays bounded
+    even if the workers are faster than ES.
+
+    Attributes:
+      batches: iterable of DataFrames, as returned by read_csv_batches
+      executor: concurrent.futures executor to coerce batches with, None to coerce inline
+      max_pending: maximum number of batches queued on the executor
+      lsh: add the LSH band keys of tweet_text to each row, see coerce_frame
+    """
+    if executor is None:
+        for frame in batches:
+            yield from coerce_frame(frame, lsh)
+        return
+
+    pending = deque()
+    for frame in batches:
+        pending.append(executor.submit(coerce_frame, frame, lsh))
+        if len(pending) >= max_pending:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def iter_file_rows(file, dataset, executor=None, batch_size=10000, skip_rows=0,
+                   parquet_cache=None, clusters=None, graph=None):
+    """
+    Yield the coerced rows of a CSV to index, given their cluster_id and written to the cache and graph on the way
+
+    When resuming, the rows indexed by a previous run still go through the
+    clusters, Parquet cache and graph, so those hold the whole file, and are
+    only dropped before indexing. Without any of them they aren't even coerced.
+
+    Attributes:
+      file: text file object of the CSV
+      dataset: name of the dataset the CSV belongs to
+      executor: optional process/thread pool used to coerce rows in parallel
+      batch_size: number of CSV rows read and coerced at once
+      skip_rows: number of rows at the start of the file already indexed by a previous run
+      parquet_cache: optional ParquetCacheWriter the coerced rows are also written to
+      clusters: optional ClusterAssigner giving each tweet its near-duplicate cluster_id
+      graph: optional GraphBuilder collecting the retweet, reply and mention edges of the rows
+    """
+    replay = parquet_cache is not None or clusters is not None or graph is not None
+    batches = read_csv_batches(file, batch_size=batch_size, skip_rows=0 if replay else skip_rows)
+    rows = iter_coerced_rows(batches, executor, lsh=clusters is not None)
+    if clusters is not None:
+        rows = clusters.assign(rows, dataset)
+    if parquet_cache is not None:
+        rows = parquet_cache.tee(rows)
+    if graph is not None:
+        rows = graph.tee(rows)
+    if replay and skip_rows:
+        rows = itertools.islice(rows, skip_rows, None)
+    return rows
+
+
+def partition_index_name(index_name, tweet_time):
+    """
+    Name of the yearly index a tweet goes into, ex: ioa-tweets-2019
+
+    Attributes:
+      index_name: base name of the index, also the alias the partitions are read through
+      tweet_time: ISO 8601 time of the tweet
+    """
+    if tweet_time:
+        return f"{index_name}-{tweet_time[:4]}"
+    return f"{index_name}-unknown"
+
+
+def generate_actions(rows, name, index_name, dataset="", partition_by_year=False):
+    """
+    Lazily turn coerced CSV rows into ES bulk actions, so that a file never has to be held in memory
+
+    Documents are given their tweetid as _id, so indexing the same rows
+    again overwrites them instead of creating duplicates.
+
+    Attributes:
+      rows: iterable of coerced row dicts
+      name: name of the file to add as metadata
+      index_name: name of index to be inserted into
+      dataset: name of the dataset stored in Google Storage (ex: Venezuela, Russia)
+      partition_by_year: route each tweet to the yearly index of its tweet_time instead of index_name
+    """
+    for row in rows:
+        action = {
+            "_index": partition_index_name(index_name, row.get("tweet_time")) if partition_by_year else index_name,
+            "_source": {
+                **row,
+                "dataset": dataset,
+                "file_name": name
+              }
+        }
+        if row.get("tweetid"):
+            action["_id"] = row["tweetid"]
+        yield action
+
+
+def bulk_index_rows(rows, name, index_name, dataset="", chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                    bulk_threads=1, skip_rows=0, on_progress=None, partition_by_year=False,
+                    meter=None, bytes_read=None, written_indices=None):
+    """
+    Send coerced rows to Elasticsearch in bulk requests, returns (inserted, failed)
+
+    Attributes:
+      rows: iterable of coerced row dicts
+      name: name of the file to add as metadata
+      index_name: name of index to be inserted into
+      dataset: name of the dataset stored in Google Storage (ex: Venezuela, Russia)
+      chunk_size: number of documents sent per bulk request
+      max_chunk_bytes: maximum size in bytes of a single bulk request
+      bulk_threads: number of threads sending bulk requests concurrently
+      skip_rows: number of rows of the file indexed before these ones, added to the progress reported
+      on_progress: optional callback called with the number of rows acknowledged by ES
+        (counted from the start of the file) after every chunk
+      partition_by_year: insert tweets into yearly indices (index_name-YYYY) instead of index_name
+      meter: optional ThroughputMeter updated for every acknowledged row
+      bytes_read: optional function returning the number of bytes read from the source so far
+      written_indices: optional set the names of the indices documents were written to are added to
+    """
+    inserted = 0
+    failed = 0
+    actions = generate_actions(rows, name, index_name, dataset, partition_by_year=partition_by_year)
+    if bulk_threads > 1:
+        results = helpers.parallel_bulk(client, actions,
+                                        thread_count=bulk_threads,
+                                        queue_size=bulk_threads,
+                                        chunk_size=chunk_size,
+                                        max_chunk_bytes=max_chunk_bytes,
+                                        raise_on_error=False)
     else:
-        print(f"Failed to download the file. Status code: {response.status_code}")
+        results = helpers.streaming_bulk(client, actions,
+                                         chunk_size=chunk_size,
+                                         max_chunk_bytes=max_chunk_bytes,
+                                         raise_on_error=False)
+    for ok, item in results:
+        if ok:
+            inserted += 1
+            if written_indices is not None:
+                written_indices.add(next(iter(item.values()))["_index"])
+        else:
+            failed += 1
+            print(f"Failed to index document: {item}")
+        if meter is not None:
+            meter.update(rows=1, bytes_read=bytes_read() if bytes_read is not None else None)
+        # Bulk results come back in order, so every row up to here has been acknowledged
+        if on_progress is not None and (inserted + failed) % chunk_size == 0:
+            on_progress(skip_rows + inserted + failed)
+    return inserted, failed
 
 
-def csv_to_elastic(csv_file, name, index_name="tweets_test", dataset=""):
+def csv_to_elastic(csv_file, name, index_name="tweets_test", dataset="",
+                   chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                   executor=None, bulk_threads=1, skip_rows=0, on_progress=None,
+                   batch_size=10000, partition_by_year=False, parquet_cache=None, clusters=None, graph=None,
+                   written_indices=None):
     """
-    Reads a CSV file and inserts structured tweet data into Elasticsearch.
+    Streams a CSV file and inserts structured tweet data into Elasticsearch.
+
+    Rows are read in batches of batch_size, coerced column by column and
+    sent in bulk requests of at most chunk_size documents / max_chunk_bytes
+    bytes, so peak memory does not depend on the size of the file. With an
+    executor, batches are coerced on its workers, and with bulk_threads > 1
+    several bulk requests are sent at once over the client's connection pool.
     
     Attributes:
-      csv_file: csv file to add to ES
+      csv_file: csv file to add to ES, either a path or a binary file object
       name: name of the file to add as metadata
       index_name: name of index to be inserted into
       dataset: name of the dataset stored in Google Storage (ex: Venezuela, Russia)
+      chunk_size: number of documents sent per bulk request
+      max_chunk_bytes: maximum size in bytes of a single bulk request
+      executor: optional process/thread pool used to coerce rows in parallel
+      bulk_threads: number of threads sending bulk requests concurrently
+      skip_rows: number of rows at the start of the file already indexed by a previous run
+      on_progress: optional callback called with the number of rows acknowledged by ES
+        (counted from the start of the file) after every chunk
+      batch_size: number of CSV rows read and coerced at once
+      partition_by_year: insert tweets into yearly indices (index_name-YYYY) instead of index_name
+      parquet_cache: optional ParquetCacheWriter the coerced rows are also written to
+      clusters: optional ClusterAssigner giving each tweet its near-duplicate cluster_id
+      graph: optional GraphBuilder collecting the retweet, reply and mention edges of the rows
+      written_indices: optional set the names of the indices documents were written to are added to
+
+    Returns:
+      number of rows of the file acknowledged by ES, including the skipped ones
     """
+    if hasattr(csv_file, "read"):
+        source = contextlib.nullcontext(csv_file)
+    else:
+        source = open(csv_file, mode="rb")
 
-    int_columns = {"follower_count", "following_count", "like_count", "quote_count", "reply_count", "retweet_count"}
-    date_columns = {"account_creation_date", "tweet_time"}
-
-    with open(csv_file, mode="r", encoding="utf-8") as file:
-        reader = csv.DictReader(file)
-        actions = []
-        
-        for row in reader:
-            # Ensure appropriate columns inserted as int
-            for col in int_columns:
-                if col in row and row[col]:
-                    try:
-                        row[col] = int(row[col])
-                    except:
-                        row[col] = None
-
-            # Ensure appropriate columns inserted as date
-            for col in date_columns:
-              if col in row and row[col]:
-                try:
-                    # Parse the date and convert to ISO 8601
-                    dt = datetime.strptime(row[col], "%Y-%m-%d %H:%M")
-                    row[col] = dt.isoformat()  # 'YYYY-MM-DDTHH:MM:SS'
-                except ValueError:
-                    row[col] = None  # or handle as needed
-            
-            # Parse hashtags, urls, and user_mentions into proper list
-            if 'hashtags' in row and row['hashtags']:
-              try:
-                row['hashtags'] = ast.literal_eval(row['hashtags'])
-              except Exception:
-                row['hashtags'] = []
-            if 'urls' in row and row['urls']:
-              try:
-                row['urls'] = ast.literal_eval(row['urls'])
-              except Exception:
-                row['urls'] = []
-            if 'user_mentions' in row and row['user_mentions']:
-              try:
-                row['user_mentions'] = ast.literal_eval(row['user_mentions'])
-              except Exception:
-                row['user_mentions'] = []
-            
-            action = {
-                "_index": index_name,
-                "_source": {
-                    **row,
-                    "dataset": dataset,
-                    "file_name": name
-                  }
-            }
-            actions.append(action)
+    with source as raw_file:
+        counter = CountingReader(raw_file)
+        file = io.TextIOWrapper(io.BufferedReader(counter), encoding="utf-8", newline="")
+        meter = ThroughputMeter(name)
+        if skip_rows:
+            print(f"Resuming {name} after {skip_rows} rows already indexed")
+
+        rows = iter_file_rows(file, dataset, executor=executor, batch_size=batch_size, skip_rows=skip_rows,
+                              parquet_cache=parquet_cache, clusters=clusters, graph=graph)
+        inserted, failed = bulk_index_rows(rows, name, index_name, dataset,
+                                           chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                           bulk_threads=bulk_threads, skip_rows=skip_rows,
+                                           on_progress=on_progress, partition_by_year=partition_by_year,
+                                           meter=meter, bytes_read=lambda: counter.bytes_read,
+                                           written_indices=written_indices)
+        meter.report(final=True)
+
+    if inserted:
+        print(f"✅ Inserted {inserted} rows from {name} into Elasticsearch ({failed} failed).")
+    elif not skip_rows:
+        print(f"⚠️ No valid data found in {name}.")
+    return skip_rows + inserted + failed
 
-        if actions:
-            helpers.bulk(client, actions)
-            print(f"✅ Inserted data from {csv_file} into Elasticsearch.")
-        else:
-            print(f"⚠️ No valid data found in {csv_file}.")
 
+def csv_to_sqlite(csv_file, name, backend, dataset="", executor=None, skip_rows=0,
+                  on_progress=None, batch_size=10000, commit_size=5000, parquet_cache=None, clusters=None,
+                  graph=None):
+    """
+    Streams a CSV file into a local SQLite search database, the offline counterpart of csv_to_elastic
 
-def empty_directory_if_exists(directory_path):
+    Attributes:
+      csv_file: csv file to add, either a path or a binary file object
+      name: name of the file to add as metadata
+      backend: SQLiteBackend to insert into
+      dataset: name of the dataset stored in Google Storage (ex: Venezuela, Russia)
+      executor: optional process/thread pool used to coerce rows in parallel
+      skip_rows: number of rows at the start of the file already inserted by a previous run
+      on_progress: optional callback called with the number of rows committed
+        (counted from the start of the file) after every transaction
+      batch_size: number of CSV rows read and coerced at once
+      commit_size: number of rows inserted per transaction
+      parquet_cache: optional ParquetCacheWriter the coerced rows are also written to
+      clusters: optional ClusterAssigner giving each tweet its near-duplicate cluster_id
+      graph: optional GraphBuilder collecting the retweet, reply and mention edges of the rows
+
+    Returns:
+      number of rows of the file inserted, including the skipped ones
     """
-    Empties the specified directory if it exists.
-    If the directory does not exist, it does nothing.
+    inserted = 0
+
+    if hasattr(csv_file, "read"):
+        source = contextlib.nullcontext(csv_file)
+    else:
+        source = open(csv_file, mode="rb")
 
-    Args:
-        directory_path: The path to the directory to empty.
+    with source as raw_file:
+        counter = CountingReader(raw_file)
+        file = io.TextIOWrapper(io.BufferedReader(counter), encoding="utf-8", newline="")
+        meter = ThroughputMeter(name)
+        if skip_rows:
+            print(f"Resuming {name} after {skip_rows} rows already inserted")
+
+        rows = iter_file_rows(file, dataset, executor=executor, batch_size=batch_size, skip_rows=skip_rows,
+                              parquet_cache=parquet_cache, clusters=clusters, graph=graph)
+        docs = []
+        for row in rows:
+            docs.append({**row, "dataset": dataset, "file_name": name})
+            if len(docs) == commit_size:
+                backend.index_documents(docs)
+                inserted += len(docs)
+                meter.update(rows=len(docs), bytes_read=counter.bytes_read)
+                docs = []
+                if on_progress is not None:
+                    on_progress(skip_rows + inserted)
+        if docs:
+            backend.index_documents(docs)
+            inserted += len(docs)
+            meter.update(rows=len(docs), bytes_read=counter.bytes_read)
+        meter.report(final=True)
+
+    if inserted:
+        print(f"✅ Inserted {inserted} rows from {name} into {backend.path}.")
+    elif not skip_rows:
+        print(f"⚠️ No valid data found in {name}.")
+    return skip_rows + inserted
+
+
+def parquet_cache_path(parquet_folder, dataset, file_name):
     """
-    if os.path.exists(directory_path):
-        try:
-            shutil.rmtree(directory_path)  # Remove the directory and its contents
-            os.makedirs(directory_path)   # Recreate the directory
-        except Exception as e:
-            print(f"Error emptying directory: {e}")
-
-# CONNECT TO ES
-# TODO: get credentials from VM or .env file
-es_host = None
-es_port = None
-es_username = None
-es_password = None
-
-# Create the Elasticsearch client with HTTPS and authentication
-client = Elasticsearch([f'https://{es_host}:{es_port}'], 
-                   basic_auth=(es_username, es_password),
-                   verify_certs=False)
-
-
-print("Connection to ES Server successful!\n\n")
-
-# Create a new index
-print("Creating a new index and mapping\n\n")
-index_name = "ioa-tweets"
-mapping = {
-    "mappings": {
-        "properties": {
-            "dataset": {"type": "keyword"},      # single keyword field
-            "hashtags": {"type": "keyword"},     # list of hashtags as keywords
-            "urls": {"type": "keyword"}          # list of full URLs as keywords
-        }
+    Path of the Parquet file caching a CSV, partitioned by dataset: parquet_folder/dataset=<dataset>/<file>.parquet
+
+    Attributes:
+      parquet_folder: root folder of the Parquet cache
+      dataset: name of the dataset the CSV belongs to
+      file_name: name of the CSV in the dataset zip
+    """
+    base_name = os.path.basename(file_name)
+    if base_name.endswith(".csv"):
+        base_name = base_name[:-len(".csv")]
+    return os.path.join(parquet_folder, f"dataset={dataset}", f"{base_name}.parquet")
+
+
+def missing_parquet_files(manifest, parquet_folder):
+    """
+    Paths of the Parquet cache of the files the manifest records as indexed that weren't cached
+
+    Reindexing from the cache would leave the tweets of these files out.
+
+    Attributes:
+      manifest: IngestManifest of the index
+      parquet_folder: root folder of the Parquet cache
+    """
+    paths = {
+        parquet_cache_path(parquet_folder, file_name.split("_", 1)[0], file_name)
+        for _, _, file_name in manifest.indexed_files()
     }
-}
-client.indices.create(index=index_name, body=mapping, ignore=400)
+    return sorted(path for path in paths if not os.path.exists(path))
+
+
+def save_zip_graph(graph, graph_folder, manifest, url, version):
+    """
+    Save the graph of a dataset built from the files of one zip, merged into the graph of its other zips
+
+    The manifest records the zips whose edges are in the saved graph, so each
+    one is merged once, even across runs. A graph holding the edges of another
+    version of the zip isn't updated, they can't be told apart from the others.
+
+    Attributes:
+      graph: GraphBuilder fed with every file of the dataset in the zip
+      graph_folder: root folder of the graphs
+      manifest: IngestManifest of the index
+      url: url of the zip
+      version: version of the zip returned by dataset_version
+
+    Returns:
+      (number of accounts, number of distinct edges), None if the graph wasn't saved
+    """
+    sources = manifest.graph_sources(graph.dataset)
+    if sources.get(url) == version:
+        # Saved by a run stopped before the zip was marked as done
+        print(f"Skipping the graph of {graph.dataset}, the edges of {url} are already in it")
+        return None
+    others = {other: other_version for other, other_version in sources.items() if other != url}
+    if url in sources and others:
+        print(f"⚠️ The graph of {graph.dataset} holds the edges of another version of {url}, it wasn't saved. "
+              f"Rebuild it with reindex_from_parquet")
+        return None
+    counts = graph.save(graph_folder, merge=bool(others))
+    manifest.set_graph_sources(graph.dataset, {**others, url: version})
+    return counts
+
+
+class ParquetCacheWriter:
+    """
+    Writes coerced rows to a Parquet file while they are being indexed, one row group per batch
+
+    Used as a context manager: the file is written as <path>.part and only
+    moved to path once every row was written, so a cached file is always a
+    whole CSV. If indexing fails, the partial file is removed.
+
+    Attributes:
+      path: path of the Parquet file, see parquet_cache_path
+      file_name: name of the CSV in the dataset zip, kept in the file metadata
+      batch_size: number of rows per row group
+    """
+
+    def __init__(self, path, file_name, batch_size=10000):
+        self.path = path
+        self.file_name = file_name
+        self.part_path = f"{path}.part"
+        self.batch_size = batch_size
+        self.rows = []
+        self.columns = None
+        self.writer = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if exc_type is None and self.writer is not None:
+            os.replace(self.part_path, self.path)
+        elif os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def tee(self, rows):
+        """
+        Yield rows unchanged, writing them to the Parquet file along the way
+
+        Attributes:
+          rows: iterable of coerced row dicts
+        """
+        for row in rows:
+            self.rows.append(row)
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+            yield row
+
+    def flush(self):
+        """
+        Write the buffered rows as a row group
+        """
+        import pyarrow.parquet as pq
+
+        if not self.rows:
+            return
+        if self.columns is None:
+            self.columns = list(self.rows[0])
+
+        table = parquet_table(self.rows, self.columns)
+        if self.writer is None:
+            schema = table.schema.with_metadata({"file_name": self.file_name})
+            self.writer = pq.ParquetWriter(self.part_path, schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.rows = []
+
+
+def iter_parquet_rows(path, batch_size=10000):
+    """
+    Yield the rows of a cached Parquet file, typed as coerce_frame returns them
+
+    Dates are formatted back to ISO strings, so rows can go straight to generate_actions.
+
+    Attributes:
+      path: path of a Parquet file written by ParquetCacheWriter
+      batch_size: number of rows read at once
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        table = pa.Table.from_batches([batch])
+        for column in date_columns.intersection(table.column_names):
+            index = table.schema.get_field_index(column)
+            # Parquet stores second timestamps as milliseconds
+            dates = table[column].cast(pa.timestamp("s"))
+            table = table.set_column(index, column, pc.strftime(dates, format="%Y-%m-%dT%H:%M:%S"))
+        yield from table.to_pylist()
+
+
+def parquet_to_elastic(path, index_name, dataset="", chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                       bulk_threads=1, batch_size=10000, partition_by_year=False, graph=None, written_indices=None):
+    """
+    Index a cached Parquet file into Elasticsearch, without downloading or parsing the CSV again
+
+    Attributes:
+      path: path of a Parquet file written by ParquetCacheWriter
+      index_name: name of index to be inserted into
+      dataset: name of the dataset the CSV belongs to
+      chunk_size: number of documents sent per bulk request
+      max_chunk_bytes: maximum size in bytes of a single bulk request
+      bulk_threads: number of threads sending bulk requests concurrently
+      batch_size: number of rows read from the Parquet file at once
+      partition_by_year: insert tweets into yearly indices (index_name-YYYY) instead of index_name
+      graph: optional GraphBuilder collecting the retweet, reply and mention edges of the rows
+      written_indices: optional set the names of the indices documents were written to are added to
+
+    Returns:
+      number of rows acknowledged by ES
+    """
+    import pyarrow.parquet as pq
+
+    # Name of the CSV the rows come from, added to the documents as file_name
+    name = pq.read_schema(path).metadata[b"file_name"].decode("utf-8")
+    meter = ThroughputMeter(name)
+    rows = iter_parquet_rows(path, batch_size)
+    if graph is not None:
+        rows = graph.tee(rows)
+    inserted, failed = bulk_index_rows(rows, name, index_name, dataset,
+                                       chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                       bulk_threads=bulk_threads, partition_by_year=partition_by_year,
+                                       meter=meter, written_indices=written_indices)
+    meter.report(final=True)
+    print(f"✅ Reindexed {inserted} rows of {name} from {path} ({failed} failed).")
+    return inserted + failed
+
+
+def put_tweets_template(client, index_name, settings=None):
+    """
+    Create or update the index template of the yearly tweet indices.
+
+    Indices matching index_name-* get the tweets mapping and are added to
+    the index_name alias, which is what searches read from.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: base name of the yearly indices and name of the read alias
+      settings: optional index settings new yearly indices are created with
+    """
+    template = {
+        "mappings": tweets_mapping,
+        "aliases": {index_name: {}}
+    }
+    if settings:
+        template["settings"] = settings
+    client.indices.put_index_template(name=f"{index_name}-template",
+                                      index_patterns=[f"{index_name}-*"],
+                                      template=template)
+
+
+def start_bulk_load(client, index_name):
+    """
+    Switch indices to a bulk load profile: no refresh and no replicas until finish_bulk_load is called
+
+    The settings in place before are saved in each index _meta, so they can
+    be restored even if a previous load was interrupted before finishing.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or wildcard pattern of the indices being loaded
+    """
+    mappings = client.indices.get_mapping(index=index_name)
+    settings = client.indices.get_settings(index=index_name)
+    for name, mapping in mappings.items():
+        meta = mapping["mappings"].get("_meta", {})
+        if "bulk_load_restore" in meta:
+            continue
+        index_settings = settings[name]["settings"]["index"]
+        meta["bulk_load_restore"] = {
+            "refresh_interval": index_settings.get("refresh_interval"),
+            "number_of_replicas": index_settings.get("number_of_replicas")
+        }
+        client.indices.put_mapping(index=name, meta=meta)
+
+    if mappings:
+        client.indices.put_settings(index=index_name, settings=bulk_load_settings)
+    print(f"Bulk load profile enabled on {index_name}")
+
+
+def finish_bulk_load(client, index_name, force_merge=True, max_num_segments=1, merge_indices=None):
+    """
+    Restore the settings saved by start_bulk_load, refresh the indices and optionally force merge them
+
+    Indices created during the load with bulk_load_settings have nothing
+    saved, their settings are reset to the defaults.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or wildcard pattern of the loaded indices
+      force_merge: whether to force merge the indices, should only be done once the load succeeded
+      max_num_segments: number of segments per shard to merge down to
+      merge_indices: names of the indices written by the load, the only ones force merged,
+        None to force merge every index matching index_name
+    """
+    mappings = client.indices.get_mapping(index=index_name)
+    for name, mapping in mappings.items():
+        meta = mapping["mappings"].get("_meta", {})
+        restore = meta.pop("bulk_load_restore", {})
+        # None resets a setting to its default
+        client.indices.put_settings(index=name, settings={
+            "index": {
+                "refresh_interval": restore.get("refresh_interval"),
+                "number_of_replicas": restore.get("number_of_replicas")
+            }
+        })
+        client.indices.put_mapping(index=name, meta=meta)
+    if not mappings:
+        return
+
+    client.indices.refresh(index=index_name)
+    print(f"Bulk load profile disabled on {index_name}")
+
+    if merge_indices is not None:
+        # Indices the load didn't write to were already merged by the run that loaded them
+        merge_indices = sorted(name for name in merge_indices if name in mappings)
+        force_merge = force_merge and bool(merge_indices)
+        index_name = ",".join(merge_indices)
+    if force_merge:
+        print(f"Force merging {index_name}...")
+        client.options(request_timeout=6 * 3600).indices.forcemerge(index=index_name, max_num_segments=max_num_segments)
+
+
+def bump_index_generation(client, meta_index_name="ioa-meta"):
+    """
+    Increment the index generation counter, so the search API knows its cached responses are stale
+
+    Attributes:
+      client: Elasticsearch client
+      meta_index_name: index holding the generation counter
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    client.update(index=meta_index_name, id="generation",
+                  script={
+                      "source": "ctx._source.generation += 1; ctx._source.updated_at = params.now",
+                      "params": {"now": now}
+                  },
+                  upsert={"generation": 1, "updated_at": now},
+                  refresh=True)
+
+
+def iter_composite_buckets(client, index_name, query, sources, aggs=None, page_size=100):
+    """
+    Yield every bucket of a composite aggregation over the tweets, paging through them with after_key
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      query: query selecting the tweets aggregated
+      sources: sources of the composite aggregation, the keys of the buckets
+      aggs: optional sub-aggregations computed for every bucket
+      page_size: number of buckets per request
+    """
+    aggregation = {"composite": {"size": page_size, "sources": sources}}
+    if aggs:
+        aggregation["aggs"] = aggs
+    while True:
+        results = client.search(index=index_name, size=0, track_total_hits=False,
+                                query=query, aggs={"buckets": aggregation})
+        buckets = results["aggregations"]["buckets"]
+        yield from buckets["buckets"]
+
+        after = buckets.get("after_key")
+        if after is None or len(buckets["buckets"]) < page_size:
+            return
+        aggregation["composite"]["after"] = after
+
+
+def replace_dataset_documents(client, target_index, dataset, actions, chunk_size=1000):
+    """
+    Replace the documents of a dataset in an index built from the tweets, returns (inserted, errors)
+
+    The documents of the dataset are deleted before the new ones are
+    indexed, so rebuilding them after the dataset is indexed again doesn't
+    leave stale ones behind.
 
+    Attributes:
+      client: Elasticsearch client
+      target_index: index the documents are written to, with a dataset keyword field
+      dataset: dataset the documents are built from
+      actions: iterable of bulk actions indexing the new documents
+      chunk_size: number of documents sent per bulk request
+    """
+    client.delete_by_query(index=target_index, query={"term": {"dataset": dataset}},
+                           refresh=True, conflicts="proceed")
+    inserted, errors = helpers.bulk(client, actions, chunk_size=chunk_size, raise_on_error=False)
+    return inserted, errors
+
+
+def iter_rollups(client, index_name, dataset, granularity, fields=("user_screen_name", "hashtags", "urls"),
+                 top_k=rollup_top_k, page_size=50):
+    """
+    Yield the rollup documents of a dataset at one granularity, computed with ES aggregations
+
+    Time buckets are paged through with a composite aggregation, each one
+    getting the top_k values of every field.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      dataset: dataset to roll up
+      granularity: calendar interval of the time buckets (day, week or month)
+      fields: keyword fields to count the top values of
+      top_k: number of values kept per field and time bucket
+      page_size: number of time buckets per request
+    """
+    buckets = iter_composite_buckets(
+        client, index_name,
+        query={"term": {"dataset": dataset}},
+        sources=[{"bucket": {"date_histogram": {"field": "tweet_time", "calendar_interval": granularity}}}],
+        aggs={field: {"terms": {"field": field, "size": top_k}} for field in fields},
+        page_size=page_size)
+    for bucket in buckets:
+        start = bucket["key"]["bucket"]
+        yield {"dataset": dataset, "granularity": granularity, "bucket": start,
+               "field": "tweets", "key": "", "count": bucket["doc_count"]}
+        for field in fields:
+            for term in bucket[field]["buckets"]:
+                yield {"dataset": dataset, "granularity": granularity, "bucket": start,
+                       "field": field, "key": str(term["key"]), "count": term["doc_count"]}
+
+
+def build_rollups(client, index_name, datasets, rollup_index_name="ioa-rollups",
+                  granularities=("day", "week", "month"), top_k=rollup_top_k):
+    """
+    Precompute the top users, hashtags and urls of each dataset per day, week and month
+
+    /insights answers dataset and date filtered requests from them, as long as
+    the coverage document of every dataset in scope counts as many tweets as the index.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      datasets: datasets to build the rollups of, their previous rollups are replaced
+      rollup_index_name: index the rollups are written to
+      granularities: calendar intervals to roll up by
+      top_k: number of values kept per field and time bucket
+    """
+    client.indices.create(index=rollup_index_name, mappings=rollups_mapping, ignore=400)
+
+    for dataset in sorted(datasets):
+        def actions():
+            for granularity in granularities:
+                for doc in iter_rollups(client, index_name, dataset, granularity, top_k=top_k):
+                    doc_id = f"{dataset}|{granularity}|{doc['bucket']}|{doc['field']}|{doc['key']}"
+                    yield {"_index": rollup_index_name,
+                           "_id": hashlib.sha1(doc_id.encode("utf-8")).hexdigest(),
+                           "_source": doc}
+
+        tweets = client.count(index=index_name, query={"term": {"dataset": dataset}})["count"]
+        inserted, errors = replace_dataset_documents(client, rollup_index_name, dataset, actions())
+        print(f"✅ Built {inserted} rollups for {dataset} ({len(errors)} failed).")
+        if errors:
+            print(f"⚠️ The rollups of {dataset} are incomplete, /insights aggregates it live")
+            continue
+        # Written once every rollup of the dataset is, replace_dataset_documents removed the previous one
+        client.index(index=rollup_index_name, id=hashlib.sha1(f"{dataset}|coverage".encode("utf-8")).hexdigest(),
+                     document={"dataset": dataset, "field": "coverage", "key": "", "count": tweets})
+
+    client.indices.refresh(index=rollup_index_name)
+
+
+def iter_touched_users(client, index_name, datasets, page_size=1000):
+    """
+    Yield the userids with tweets in the given datasets
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      datasets: datasets to find the accounts of
+      page_size: number of userids per request
+    """
+    buckets = iter_composite_buckets(client, index_name,
+                                     query={"terms": {"dataset": sorted(datasets)}},
+                                     sources=[{"userid": {"terms": {"field": "userid"}}}],
+                                     page_size=page_size)
+    for bucket in buckets:
+        yield bucket["key"]["userid"]
+
+
+def build_accounts(client, index_name, datasets, accounts_index_name="ioa-accounts", batch_size=500):
+    """
+    Precompute the summary of every account with tweets in the given datasets, one document per userid
+
+    The accounts touched by the datasets are found first, then their
+    activity is aggregated over all their tweets, so accounts seen in
+    several datasets are summarized from every one of them. /user/<id>
+    serves the summaries with a single document GET.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      datasets: datasets indexed since the summaries were last built
+      accounts_index_name: index the summaries are written to
+      batch_size: number of accounts aggregated per request
+    """
+    client.indices.create(index=accounts_index_name, mappings=accounts_mapping, ignore=400)
+    updated_at = datetime.now(timezone.utc).isoformat()
+
+    def actions():
+        userids = iter_touched_users(client, index_name, datasets)
+        while True:
+            batch = list(itertools.islice(userids, batch_size))
+            if not batch:
+                return
+            results = client.search(index=index_name, size=0, track_total_hits=False,
+                                    query={"terms": {"userid": batch}},
+                                    aggs={"accounts": {
+                                        "terms": {"field": "userid", "size": len(batch)},
+                                        "aggs": account_aggs()
+                                    }})
+            for bucket in results["aggregations"]["accounts"]["buckets"]:
+                yield {"_index": accounts_index_name, "_id": bucket["key"],
+                       "_source": account_document(bucket, updated_at)}
+
+    inserted, errors = helpers.bulk(client, actions(), chunk_size=1000, raise_on_error=False)
+    print(f"✅ Built {inserted} account summaries ({len(errors)} failed).")
+    client.indices.refresh(index=accounts_index_name)
+
+
+def iter_cascades(client, index_name, dataset, min_size=2, page_size=200):
+    """
+    Yield the retweet cascades of a dataset, computed with ES aggregations
+
+    The retweets of the dataset are grouped by original tweet with a
+    composite aggregation, paged through page_size tweets at a time.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      dataset: dataset to find the cascades of
+      min_size: smallest number of retweets of a cascade
+      page_size: number of original tweets per request
+    """
+    buckets = iter_composite_buckets(client, index_name,
+                                     query={"bool": {"filter": [{"term": {"dataset": dataset}},
+                                                                {"term": {"is_retweet": True}}]}},
+                                     sources=[{"tweetid": {"terms": {"field": "retweet_tweetid"}}}],
+                                     aggs=cascade_aggs(),
+                                     page_size=page_size)
+    for bucket in buckets:
+        if bucket["doc_count"] >= min_size:
+            yield cascade_document(bucket, str(bucket["key"]["tweetid"]), dataset)
+
+
+def build_cascades(client, index_name, datasets, cascades_index_name="ioa-cascades", min_size=2):
+    """
+    Precompute the retweet cascades of each dataset: per original tweet, its retweets over time
+
+    /cascades serves them without going through the retweets.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      datasets: datasets to build the cascades of, their previous cascades are replaced
+      cascades_index_name: index the cascades are written to
+      min_size: smallest number of retweets of a cascade
+    """
+    client.indices.create(index=cascades_index_name, mappings=cascades_mapping, ignore=400)
+
+    for dataset in sorted(datasets):
+        def actions():
+            for doc in iter_cascades(client, index_name, dataset, min_size=min_size):
+                yield {"_index": cascades_index_name, "_id": f"{dataset}|{doc['tweetid']}", "_source": doc}
+
+        inserted, errors = replace_dataset_documents(client, cascades_index_name, dataset, actions(), chunk_size=500)
+        print(f"✅ Built {inserted} retweet cascades for {dataset} ({len(errors)} failed).")
+
+    client.indices.refresh(index=cascades_index_name)
+
+
+def backfill_cluster_leaders(client, index_name, dataset, page_size=1000):
+    """
+    Set the cluster_id of the leaders of the near-duplicate clusters of a dataset, returns the number updated
 
+    ClusterAssigner leaves the first tweet of a cluster without a cluster_id,
+    since no copy joined it yet when it is indexed: the tweets whose tweetid
+    became the cluster_id of other tweets get their own.
 
-# TODO: fill in folder where zips should be downloaded to
-download_folder = ""
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      dataset: dataset to back-fill the leaders of
+      page_size: number of clusters per request
+    """
+    buckets = iter_composite_buckets(client, index_name,
+                                     query={"term": {"dataset": dataset}},
+                                     sources=[{"cluster_id": {"terms": {"field": "cluster_id"}}}],
+                                     page_size=page_size)
+    cluster_ids = (str(bucket["key"]["cluster_id"]) for bucket in buckets)
+    updated = 0
+    while True:
+        chunk = list(itertools.islice(cluster_ids, page_size))
+        if not chunk:
+            return updated
+        results = client.update_by_query(
+            index=index_name, conflicts="proceed",
+            query={"bool": {"filter": [{"term": {"dataset": dataset}}, {"terms": {"tweetid": chunk}}],
+                            "must_not": [{"exists": {"field": "cluster_id"}}]}},
+            script={"source": "ctx._source.cluster_id = ctx._source.tweetid", "lang": "painless"})
+        updated += results["updated"]
+
+
+def iter_clusters(client, index_name, dataset, min_size=2, page_size=500):
+    """
+    Yield the near-duplicate clusters of a dataset, computed with ES aggregations
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      dataset: dataset to find the clusters of
+      min_size: smallest number of tweets of a cluster
+      page_size: number of clusters per request
+    """
+    buckets = iter_composite_buckets(client, index_name,
+                                     query={"term": {"dataset": dataset}},
+                                     sources=[{"cluster_id": {"terms": {"field": "cluster_id"}}}],
+                                     aggs=cluster_aggs(),
+                                     page_size=page_size)
+    for bucket in buckets:
+        if bucket["doc_count"] >= min_size:
+            yield cluster_document(bucket, str(bucket["key"]["cluster_id"]), dataset)
+
+
+def build_clusters(client, index_name, datasets, clusters_index_name="ioa-clusters", min_size=2):
+    """
+    Precompute the near-duplicate clusters of each dataset: their size, accounts and first tweet
+
+    The leaders of the clusters are back-filled first. /clusters answers
+    dataset filtered requests from the summaries, as long as the coverage
+    document of every dataset in scope counts as many tweets as the index.
+
+    Attributes:
+      client: Elasticsearch client
+      index_name: name or alias of the tweet indices
+      datasets: datasets to build the clusters of, their previous clusters are replaced
+      clusters_index_name: index the clusters are written to
+      min_size: smallest number of tweets of a cluster
+    """
+    client.indices.create(index=clusters_index_name, mappings=clusters_mapping, ignore=400)
+
+    for dataset in sorted(datasets):
+        leaders = backfill_cluster_leaders(client, index_name, dataset)
+        client.indices.refresh(index=index_name)
+
+        def actions():
+            for doc in iter_clusters(client, index_name, dataset, min_size=min_size):
+                yield {"_index": clusters_index_name, "_id": f"{dataset}|{doc['cluster_id']}", "_source": doc}
+
+        tweets = client.count(index=index_name, query={"term": {"dataset": dataset}})["count"]
+        inserted, errors = replace_dataset_documents(client, clusters_index_name, dataset, actions())
+        print(f"✅ Built {inserted} near-duplicate clusters for {dataset}, "
+              f"{leaders} leaders back-filled ({len(errors)} failed).")
+        if errors:
+            print(f"⚠️ The clusters of {dataset} are incomplete, /clusters aggregates it live")
+            continue
+        # Written once every cluster of the dataset is, replace_dataset_documents removed the previous one
+        client.index(index=clusters_index_name, id=f"{dataset}|coverage",
+                     document={"dataset": dataset, "coverage": True, "size": tweets})
+
+    client.indices.refresh(index=clusters_index_name)
+
+
+if __name__ == "__main__":
+    # CONNECT TO ES
+    # TODO: get credentials from VM or .env file
+    es_host = None
+    es_port = None
+    es_username = None
+    es_password = None
+
+    # Parallel indexing settings: row coercion runs on num_workers processes
+    # ("process") or threads ("thread"), bulk requests are sent by bulk_threads
+    # threads sharing the client's connection pool. num_workers = 1 and
+    # bulk_threads = 1 index sequentially.
+    num_workers = os.cpu_count() or 1
+    worker_mode = "process"
+    bulk_threads = 4
+
+    # Where tweets are indexed: "elasticsearch", or "sqlite" to build a local database
+    # searched by the API with SEARCH_BACKEND=sqlite, for air-gapped single boxes
+    search_backend = "elasticsearch"
+    local_db_path = "./ioa_local.sqlite"
+
+    index_name = "ioa-tweets"
+
+    # Split tweets into yearly indices (ioa-tweets-2019...) read through the ioa-tweets alias, so date
+    # bounded searches only hit the years they cover. Set PARTITION_BY_YEAR=false to turn it off,
+    # the search API reads the same variable
+    partition_by_year = os.getenv("PARTITION_BY_YEAR", "true").lower() != "false"
+
+    # Turn refresh and replicas off while loading, they are restored once the ingest is over
+    bulk_load_profile = True
+
+    local_backend = None
+    if search_backend == "sqlite":
+        local_backend = SQLiteBackend(local_db_path)
+        bulk_load_profile = False
+    else:
+        # Create the Elasticsearch client with HTTPS and authentication
+        client = Elasticsearch([f'https://{es_host}:{es_port}'], 
+                           basic_auth=(es_username, es_password),
+                           verify_certs=False,
+                           connections_per_node=max(bulk_threads, 10))
+
+
+        print("Connection to ES Server successful!\n\n")
+
+        # Create a new index
+        print("Creating a new index and mapping\n\n")
+        if partition_by_year:
+            put_tweets_template(client, index_name)
+            load_index = f"{index_name}-*"
+        else:
+            mapping = {
+                "mappings": tweets_mapping
+            }
+            client.indices.create(index=index_name, body=mapping, ignore=400)
+            load_index = index_name
+
+
+
+    # Folder where zips are downloaded to, partial downloads left there are resumed
+    download_folder = "./downloaded_files"
+
+    # Number of dataset zips on disk at a time: downloading, waiting, or being indexed
+    download_workers = 3
+
+    # SQLite file recording the datasets and files already indexed, one per backend
+    manifest_path = "./ingest_manifest.sqlite" if local_backend is None else f"{local_db_path}.manifest"
+
+    # Bulk settings, bounds the memory used while streaming a CSV into ES
+    bulk_chunk_size = 500
+    bulk_max_chunk_bytes = 10 * 1024 * 1024
+
+    # Index of the top users/hashtags/urls per dataset and day/week/month, rebuilt for every dataset indexed
+    rollup_index_name = "ioa-rollups"
+
+    # Index of one summary per account (first/last tweet, counts, top hashtags, latest profile),
+    # rebuilt for the accounts of every dataset indexed
+    accounts_index_name = "ioa-accounts"
 
-# 1) DOWNLOAD FILES
-print("Starting Files Download\n\n")
-# TODO: Fill in file containing twitter zip files
-file_table_path = "../Twitter_IOs.csv"
-df = pd.read_csv(file_table_path)
+    # Index of the retweet cascades of every dataset indexed, one per original tweet retweeted cascade_min_size times
+    cascades_index_name = "ioa-cascades"
+    cascade_min_size = 2
 
-# Filter for only tweet files
-tweet_files = df[df['filename'].str.contains('tweets_csv', na=False)]
+    # Index of the near-duplicate clusters of every dataset indexed, one per cluster of cluster_min_size tweets
+    clusters_index_name = "ioa-clusters"
+    cluster_min_size = 2
 
-# Loop through the tweet files and download them
-empty_directory_if_exists("./extracted_files")
-for index, row in tqdm(tweet_files.iterrows(), total=len(tweet_files)):
-    # Correctly construct the file URL (remove redundant filename addition)
-    file_url = row["Link"]  # The link in the CSV is already correct
-    response = requests.get(file_url)
-    if 'application/zip' in response.headers.get('Content-Type', '') or file_url.endswith('.zip'):
-        print(f"Downloading file from {file_url}")
-        download_and_extract_zip(file_url, "./extracted_files")
+    # Parsed and typed CSVs are cached as Parquet partitioned by dataset (parquet_folder/dataset=<name>/),
+    # which can be read directly for offline analytics. With reindex_from_parquet, the index is
+    # rebuilt from the cache instead of downloading and parsing the CSVs again (Elasticsearch only),
+    # ex: after a mapping change
+    parquet_folder = "./parquet_cache"
+    write_parquet_cache = True
+    reindex_from_parquet = False
+    # Reindex even if files recorded in the manifest have no Parquet cache, their tweets are left out
+    allow_partial_reindex = False
 
-        # Insert into ES index
-        print("Inserting into ES...\n\n")
-        for filename in os.listdir(download_folder):
-          if filename.endswith(".csv"):  # Ensure we're processing only tweet CSV files
-            csv_to_elastic(os.path.join(download_folder, filename), filename, index_name, filename.split("_", 1)[0])
+    # Group near-duplicate tweets (copypasta) of each dataset under a cluster_id with MinHash LSH,
+    # remembering the band keys of at most max_cluster_leaders recent clusters per dataset
+    cluster_near_duplicates = True
+    max_cluster_leaders = 200000
+    clusters = ClusterAssigner(max_leaders=max_cluster_leaders) if cluster_near_duplicates else None
 
-        # Delete extracted file
-        empty_directory_if_exists("./extracted_files")
+    # Retweet/reply/mention graph of each dataset, saved as memory mapped CSR arrays
+    # (graph_folder/dataset=<name>/) the search API serves /network from
+    graph_folder = "./graph_store"
+    build_interaction_graphs = True
+
+    # 1) DOWNLOAD FILES
+    print("Starting Files Download\n\n")
+    # TODO: Fill in file containing twitter zip files
+    file_table_path = "../Twitter_IOs.csv"
+    df = pd.read_csv(file_table_path)
+
+    # Filter for only tweet files
+    tweet_files = df[df['filename'].str.contains('tweets_csv', na=False)]
+
+    # Pool used to coerce rows in parallel
+    executor = None
+    if num_workers > 1:
+        if worker_mode == "process":
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    # Keeps track of what has been indexed, so re-runs skip finished datasets and resume partial ones
+    manifest = IngestManifest(manifest_path)
+
+    if reindex_from_parquet and local_backend is None:
+        missing_files = missing_parquet_files(manifest, parquet_folder)
+        if missing_files:
+            print(f"⚠️ {len(missing_files)} indexed files have no Parquet cache, reindexing would leave them out:")
+            for path in missing_files:
+                print(f"  {path}")
+            if not allow_partial_reindex:
+                manifest.close()
+                sys.exit("Ingest their datasets again with a new manifest, or set allow_partial_reindex")
+
+    if bulk_load_profile:
+        start_bulk_load(client, load_index)
+        if partition_by_year:
+            # Yearly indices created during the load start with the bulk load settings
+            put_tweets_template(client, index_name, settings=bulk_load_settings)
+
+    ingest_succeeded = False
+    # Indices written by this run, the only ones force merged once it is over
+    written_indices = set()
+    # Datasets fully indexed by this run, their rollups are rebuilt at the end
+    completed_datasets = set()
+    try:
+        if reindex_from_parquet and local_backend is None:
+            # Rebuild the index from the Parquet cache, nothing is downloaded or parsed
+            parquet_files = sorted(glob.glob(os.path.join(parquet_folder, "dataset=*", "*.parquet")))
+            graphs = {}
+            for parquet_path in tqdm(parquet_files):
+                dataset = os.path.basename(os.path.dirname(parquet_path))[len("dataset="):]
+                graph = None
+                if build_interaction_graphs:
+                    graph = graphs.setdefault(dataset, GraphBuilder(dataset))
+                parquet_to_elastic(parquet_path, index_name, dataset,
+                                   chunk_size=bulk_chunk_size, max_chunk_bytes=bulk_max_chunk_bytes,
+                                   bulk_threads=bulk_threads, partition_by_year=partition_by_year, graph=graph,
+                                   written_indices=written_indices)
+                completed_datasets.add(dataset)
+            # The graphs now hold the edges of every cached file, whichever zip it came from
+            graph_sources = {}
+            for file_url, version, file_name in manifest.indexed_files():
+                graph_sources.setdefault(file_name.split("_", 1)[0], {})[file_url] = version
+            for dataset, graph in graphs.items():
+                accounts, edges = graph.save(graph_folder)
+                manifest.set_graph_sources(dataset, graph_sources.get(dataset, {}))
+                print(f"✅ Saved the graph of {dataset}: {accounts} accounts, {edges} edges.")
+        else:
+            # Download several datasets at once, and index each one as soon as it is ready
+            datasets = download_datasets(tweet_files["Link"], download_folder,
+                                         max_workers=download_workers, manifest=manifest)
+            for file_url, zip_file_path, version in tqdm(datasets, total=len(tweet_files)):
+                if zip_file_path is None:
+                    continue
+
+                # Insert into ES index, reading the CSVs straight out of the zip
+                print(f"Inserting {file_url} into ES...\n\n")
+                zip_datasets = set()
+                graphs = {}
+                for filename, stream in iter_csv_members(zip_file_path):
+                    dataset = filename.split("_", 1)[0]
+                    zip_datasets.add(dataset)
+                    graph = None
+                    if build_interaction_graphs:
+                        graph = graphs.setdefault(dataset, GraphBuilder(dataset))
+                    rows_indexed, status = manifest.file_progress(file_url, version, filename)
+                    cache_path = parquet_cache_path(parquet_folder, dataset, filename)
+                    if status == "done":
+                        if graph is None and (not write_parquet_cache or os.path.exists(cache_path)):
+                            print(f"Skipping {filename}, already indexed")
+                            continue
+                        # Indexed by a previous run, read again for the graph and cache of the dataset only
+                        print(f"Reading {filename} again, already indexed")
+
+                    on_progress = partial(manifest.update_file, file_url, version, filename)
+                    # Resumed files are read from the start for the cache, see iter_file_rows
+                    parquet_cache = contextlib.nullcontext()
+                    if write_parquet_cache:
+                        parquet_cache = ParquetCacheWriter(cache_path, filename)
+                    with parquet_cache as cache_writer:
+                        if local_backend is not None:
+                            rows_indexed = csv_to_sqlite(stream, filename, local_backend, dataset,
+                                                         executor=executor, skip_rows=rows_indexed,
+                                                         on_progress=on_progress, parquet_cache=cache_writer,
+                                                         clusters=clusters, graph=graph)
+                        else:
+                            rows_indexed = csv_to_elastic(stream, filename, index_name, dataset,
+                                                          chunk_size=bulk_chunk_size,
+                                                          max_chunk_bytes=bulk_max_chunk_bytes,
+                                                          executor=executor, bulk_threads=bulk_threads,
+                                                          skip_rows=rows_indexed, on_progress=on_progress,
+                                                          partition_by_year=partition_by_year,
+                                                          parquet_cache=cache_writer, clusters=clusters,
+                                                          graph=graph, written_indices=written_indices)
+                    manifest.update_file(file_url, version, filename, rows_indexed, status="done")
+                # Graphs are saved before the zip is marked as done, a zip done is never read again
+                for dataset, graph in graphs.items():
+                    counts = save_zip_graph(graph, graph_folder, manifest, file_url, version)
+                    if counts is not None:
+                        print(f"✅ Saved the graph of {dataset}: {counts[0]} accounts, {counts[1]} edges.")
+                manifest.mark_dataset_done(file_url, version)
+                completed_datasets.update(zip_datasets)
+                if clusters is not None:
+                    for dataset in zip_datasets:
+                        clusters.forget(dataset)
+
+                # Delete downloaded file
+                os.remove(zip_file_path)
+        ingest_succeeded = True
+    finally:
+        if bulk_load_profile:
+            if partition_by_year:
+                put_tweets_template(client, index_name)
+            finish_bulk_load(client, load_index, force_merge=ingest_succeeded, merge_indices=written_indices)
+        if local_backend is not None:
+            if completed_datasets:
+                accounts = local_backend.build_accounts(completed_datasets)
+                print(f"✅ Built {accounts} account summaries.")
+                if cluster_near_duplicates:
+                    leaders = local_backend.backfill_cluster_leaders(completed_datasets)
+                    print(f"✅ Back-filled {leaders} near-duplicate cluster leaders.")
+            # Invalidate the search API caches
+            local_backend.bump_generation()
+            local_backend.close()
+        else:
+            if completed_datasets:
+                client.indices.refresh(index=index_name)
+                build_rollups(client, index_name, completed_datasets, rollup_index_name)
+                build_accounts(client, index_name, completed_datasets, accounts_index_name)
+                build_cascades(client, index_name, completed_datasets, cascades_index_name, cascade_min_size)
+                if cluster_near_duplicates:
+                    build_clusters(client, index_name, completed_datasets, clusters_index_name, cluster_min_size)
+            # Invalidate the search API caches
+            bump_index_generation(client)
 
+    manifest.close()
+    if executor is not None:
+        executor.shutdown()
@@ -0,0 +1,85 @@
+# Index of one summary document per account (userid), built by populate_IOA.py after every ingest
+accounts_index_name = "ioa-accounts"
+
+# Profile fields of an account, repeated on every tweet, the summary keeps the ones of its latest tweet
+profile_fields = [
+  "user_screen_name",
+  "user_display_name",
+  "user_reported_location",
+  "user_profile_description",
+  "user_profile_url",
+  "follower_count",
+  "following_count",
+  "account_creation_date",
+  "account_language"
+]
+
+# Number of top hashtags and languages kept per account
+top_values_size = 10
+
+# Account summaries: the latest profile fields, plus activity computed over every tweet of the account
+accounts_mapping = {
+  "dynamic": False,
+  "properties": {
+    "userid": {"type": "keyword"},
+    "user_screen_name": {"type": "keyword"},
+    "user_display_name": {"type": "text"},
+    "user_reported_location": {"type": "keyword", "ignore_above": 1024},
+    "user_profile_description": {"type": "text"},
+    "follower_count": {"type": "integer"},
+    "following_count": {"type": "integer"},
+    "account_creation_date": {"type": "date"},
+    "account_language": {"type": "keyword"},
+    "first_tweet_time": {"type": "date"},
+    "last_tweet_time": {"type": "date"},
+    "tweet_count": {"type": "long"},
+    "retweet_tweet_count": {"type": "long"},
+    "datasets": {"type": "keyword"},
+    "updated_at": {"type": "date"}
+  }
+}
+
+
+def account_aggs():
+  """
+  Aggregations computing the activity of an account, run per userid bucket
+  """
+  return {
+    "first_tweet_time": {"min": {"field": "tweet_time"}},
+    "last_tweet_time": {"max": {"field": "tweet_time"}},
+    "retweets": {"filter": {"term": {"is_retweet": True}}},
+    "top_hashtags": {"terms": {"field": "hashtags", "size": top_values_size}},
+    "languages": {"terms": {"field": "tweet_language", "size": top_values_size}},
+    "datasets": {"terms": {"field": "dataset", "size": 100}},
+    "latest": {
+      "top_hits": {
+        "size": 1,
+        "sort": [{"tweet_time": {"order": "desc"}}],
+        "_source": {"includes": profile_fields}
+      }
+    }
+  }
+
+
+def account_document(bucket, updated_at):
+  """
+  Build the summary document of an account from its userid bucket of account_aggs
+
+  Attributes:
+    bucket: terms bucket of the ES search response, keyed by userid
+    updated_at: ISO 8601 time the summary is built at
+  """
+  hits = bucket["latest"]["hits"]["hits"]
+  profile = hits[0]["_source"] if hits else {}
+  return {
+    "userid": bucket["key"],
+    **{field: profile.get(field) for field in profile_fields},
+    "first_tweet_time": bucket["first_tweet_time"].get("value_as_string"),
+    "last_tweet_time": bucket["last_tweet_time"].get("value_as_string"),
+    "tweet_count": bucket["doc_count"],
+    "retweet_tweet_count": bucket["retweets"]["doc_count"],
+    "top_hashtags": [{"key": b["key"], "doc_count": b["doc_count"]} for b in bucket["top_hashtags"]["buckets"]],
+    "languages": [{"key": b["key"], "doc_count": b["doc_count"]} for b in bucket["languages"]["buckets"]],
+    "datasets": [b["key"] for b in bucket["datasets"]["buckets"]],
+    "updated_at": updated_at
+  }
@@ -0,0 +1,160 @@
+# Index of the retweet cascades of every dataset, one document per original tweet, built by populate_IOA.py
+cascades_index_name = "ioa-cascades"
+
+# Maximum number of retweeting accounts, languages and hashtags kept per cascade
+max_participants = 1000
+top_values_size = 10
+
+# Retweet cascades: the retweets of an original tweet within a dataset, with their hourly timeline
+cascades_mapping = {
+  "dynamic": False,
+  "properties": {
+    "tweetid": {"type": "keyword"},           # id of the original tweet
+    "userid": {"type": "keyword"},            # author of the original tweet
+    "dataset": {"type": "keyword"},
+    "text": {"type": "text"},                 # text of the first retweet
+    "first_seen": {"type": "date"},
+    "last_seen": {"type": "date"},
+    "size": {"type": "long"},                 # number of retweets
+    "accounts": {"type": "long"},             # number of retweeting accounts
+    "duration_hours": {"type": "float"},
+    "velocity": {"type": "float"},            # retweets per hour
+    "peak_hourly": {"type": "long"},
+    "hours_to_half": {"type": "float"},       # hours until half of the retweets were posted
+    "participants": {"type": "keyword"},
+    "languages": {"type": "keyword"},
+    "hashtags": {"type": "keyword"},
+    "timeline": {"type": "object", "enabled": False}
+  }
+}
+
+# Sort options of /cascades, biggest first
+sort_fields = {
+  "size": "size",
+  "accounts": "accounts",
+  "velocity": "velocity",
+  "time": "first_seen"
+}
+
+
+def cascade_aggs():
+  """
+  Aggregations describing a cascade, run per original tweet bucket of the retweets
+  """
+  return {
+    "first_seen": {"min": {"field": "tweet_time"}},
+    "last_seen": {"max": {"field": "tweet_time"}},
+    "accounts": {"cardinality": {"field": "userid", "precision_threshold": max_participants}},
+    "participants": {"terms": {"field": "userid", "size": max_participants}},
+    "original_user": {"terms": {"field": "retweet_userid", "size": 1}},
+    "languages": {"terms": {"field": "tweet_language", "size": top_values_size}},
+    "hashtags": {"terms": {"field": "hashtags", "size": top_values_size}},
+    "timeline": {"date_histogram": {"field": "tweet_time", "fixed_interval": "1h", "min_doc_count": 1}},
+    "first_retweet": {
+      "top_hits": {"size": 1, "sort": [{"tweet_time": {"order": "asc"}}], "_source": {"includes": ["tweet_text"]}}
+    }
+  }
+
+
+def cascade_document(bucket, tweetid, dataset):
+  """
+  Build the document of a cascade from its original tweet bucket of cascade_aggs
+
+  Attributes:
+    bucket: bucket of the ES search response, holding the retweets of one tweet
+    tweetid: id of the original tweet
+    dataset: dataset the retweets belong to
+  """
+  timeline = [{"hour": b["key_as_string"], "count": b["doc_count"]} for b in bucket["timeline"]["buckets"]]
+  first = bucket["first_seen"].get("value")
+  last = bucket["last_seen"].get("value")
+  duration_hours = (last - first) / 3600000 if first is not None and last is not None else 0.0
+
+  # Hours from the first retweet to the hour bucket reaching half of them
+  hours_to_half = 0.0
+  seen = 0
+  for hour in bucket["timeline"]["buckets"]:
+    seen += hour["doc_count"]
+    if seen * 2 >= bucket["doc_count"]:
+      hours_to_half = max(hour["key"] - first, 0) / 3600000
+      break
+
+  hits = bucket["first_retweet"]["hits"]["hits"]
+  original_user = bucket["original_user"]["buckets"]
+  return {
+    "tweetid": tweetid,
+    "userid": original_user[0]["key"] if original_user else None,
+    "dataset": dataset,
+    "text": hits[0]["_source"].get("tweet_text") if hits else None,
+    "first_seen": bucket["first_seen"].get("value_as_string"),
+    "last_seen": bucket["last_seen"].get("value_as_string"),
+    "size": bucket["doc_count"],
+    "accounts": bucket["accounts"]["value"],
+    "duration_hours": duration_hours,
+    # Cascades shorter than an hour count as lasting one
+    "velocity": bucket["doc_count"] / max(duration_hours, 1.0),
+    "peak_hourly": max((hour["count"] for hour in timeline), default=0),
+    "hours_to_half": hours_to_half,
+    "participants": [b["key"] for b in bucket["participants"]["buckets"]],
+    "languages": [b["key"] for b in bucket["languages"]["buckets"]],
+    "hashtags": [b["key"] for b in bucket["hashtags"]["buckets"]],
+    "timeline": timeline
+  }
+
+
+def cascades_query(args):
+  """
+  Build the cascades index query answering a /cascades request, returns (index, body)
+
+  The /search filters apply to the cascades: dates select the cascades
+  active in the range, language and hashtags the ones where they are among
+  the top_values_size most common of the retweets, user the ones started
+  or retweeted by the account (among the max_participants retweeting it the most).
+
+  Attributes:
+    args: request arguments (request.args), size is the number of cascades returned (default 10, up to 100)
+  """
+  size = min(int(args.get('size', 10)), 100)
+  filters = []
+  must = []
+  if args.get('query'):
+    must.append({"match": {"text": {"query": args.get('query'), "fuzziness": "AUTO"}}})
+  if args.get('dataset'):
+    filters.append({"term": {"dataset": args.get('dataset')}})
+  if args.get('from'):
+    filters.append({"range": {"last_seen": {"gte": args.get('from')}}})
+  if args.get('to'):
+    filters.append({"range": {"first_seen": {"lte": args.get('to')}}})
+  if args.get('language'):
+    filters.append({"term": {"languages": args.get('language')}})
+  for hashtag in args.getlist('hashtags'):
+    if hashtag:
+      filters.append({"term": {"hashtags": hashtag}})
+  if args.get('user'):
+    filters.append({"bool": {"should": [
+      {"term": {"userid": args.get('user')}},
+      {"term": {"participants": args.get('user')}}
+    ], "minimum_should_match": 1}})
+
+  sort_field = sort_fields.get(args.get('sort_by'), "size")
+  body = {
+    "query": {"bool": {"must": must, "filter": filters}},
+    "size": size,
+    "track_total_hits": True,
+    "sort": [{sort_field: {"order": "desc"}}, {"tweetid": {"order": "asc"}}],
+    "_source": {"excludes": [] if args.get('participants') == 'true' else ["participants"]}
+  }
+  return cascades_index_name, body
+
+
+def cascades_response(results):
+  """
+  Extract the /cascades response from the ES results of cascades_query
+
+  Attributes:
+    results: ES search response
+  """
+  return {
+    "total": results['hits']['total']['value'],
+    "cascades": [hit['_source'] for hit in results['hits']['hits']]
+  }
@@ -0,0 +1,128 @@
+# Index of the near-duplicate clusters of every dataset, one document per cluster, built by populate_IOA.py
+from rollups import covers, max_datasets
+
+clusters_index_name = "ioa-clusters"
+
+# Fields of the first tweet of a cluster returned by /clusters
+first_tweet_fields = ["tweetid", "tweet_text", "tweet_time", "user_screen_name", "dataset"]
+
+# Request arguments the summaries can't answer, any of them means a live aggregation
+live_only_args = ("query", "user", "language", "hashtags", "from", "to")
+
+# Near-duplicate clusters: the tweets of a dataset sharing a cluster_id. The "coverage"
+# document of a dataset counts the tweets its clusters were built from, the API only
+# uses clusters whose coverage matches the index
+clusters_mapping = {
+  "dynamic": False,
+  "properties": {
+    "cluster_id": {"type": "keyword"},        # tweetid of the first tweet of the cluster
+    "dataset": {"type": "keyword"},
+    "size": {"type": "long"},                 # number of tweets, or of tweets indexed for coverage documents
+    "accounts": {"type": "long"},             # number of accounts posting them
+    "coverage": {"type": "boolean"},
+    "first_tweet": {"type": "object", "enabled": False}
+  }
+}
+
+
+def cluster_aggs():
+  """
+  Aggregations describing a cluster, run per cluster_id bucket of the tweets
+  """
+  return {
+    "accounts": {"cardinality": {"field": "userid"}},
+    "first_tweet": {
+      "top_hits": {"size": 1, "sort": [{"tweet_time": {"order": "asc"}}], "_source": {"includes": first_tweet_fields}}
+    }
+  }
+
+
+def cluster_document(bucket, cluster_id, dataset):
+  """
+  Build the document of a cluster from its cluster_id bucket of cluster_aggs
+
+  Attributes:
+    bucket: bucket of the ES search response, holding the tweets of one cluster
+    cluster_id: id of the cluster
+    dataset: dataset the tweets belong to
+  """
+  hits = bucket["first_tweet"]["hits"]["hits"]
+  return {
+    "cluster_id": cluster_id,
+    "dataset": dataset,
+    "size": bucket["doc_count"],
+    "accounts": bucket["accounts"]["value"],
+    "first_tweet": hits[0]["_source"] if hits else None
+  }
+
+
+def can_use_cluster_summaries(args):
+  """
+  Whether a /clusters request only filters on dataset, so it can be answered from the cluster summaries
+
+  Attributes:
+    args: request arguments (request.args)
+  """
+  return not any(args.get(arg) for arg in live_only_args)
+
+
+def cluster_summaries_query(args):
+  """
+  Build the clusters index query answering a /clusters request, returns (index, body)
+
+  Attributes:
+    args: request arguments (request.args), see can_use_cluster_summaries
+  """
+  size = min(int(args.get('size', 10)), 100)
+  min_size = max(int(args.get('min_size', 2)), 1)
+  filters = [{"range": {"size": {"gte": min_size}}}]
+  if args.get('dataset'):
+    filters.append({"term": {"dataset": args.get('dataset')}})
+
+  body = {
+    "query": {"bool": {"filter": filters, "must_not": [{"term": {"coverage": True}}]}},
+    "size": size,
+    "track_total_hits": False,
+    # Same order as the terms aggregation of a live /clusters request
+    "sort": [{"size": {"order": "desc"}}, {"cluster_id": {"order": "asc"}}],
+    "aggs": {
+      # Coverage markers are found whatever the filters
+      "coverage": {
+        "global": {},
+        "aggs": {
+          "markers": {
+            "filter": {"term": {"coverage": True}},
+            "aggs": {
+              "datasets": {
+                "terms": {"field": "dataset", "size": max_datasets},
+                "aggs": {"count": {"max": {"field": "size"}}}
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+  return clusters_index_name, body
+
+
+def cluster_summaries_response(results, coverage_results):
+  """
+  Extract the /clusters response from the ES results of cluster_summaries_query, None if they don't cover it
+
+  Every dataset in scope needs a coverage marker counting as many tweets as
+  the tweet indices hold, otherwise its clusters are missing or outdated and
+  the request is aggregated live.
+
+  Attributes:
+    results: ES search response of cluster_summaries_query
+    coverage_results: ES search response of rollups.coverage_query
+  """
+  if not covers(results['aggregations']['coverage'], coverage_results):
+    return None
+  return {
+    "clusters": [
+      {field: hit['_source'].get(field) for field in ("cluster_id", "size", "accounts", "first_tweet")}
+      for hit in results['hits']['hits']
+    ]
+  }
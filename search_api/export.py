@@ -0,0 +1,204 @@
+import csv
+import io
+import json
+import queue
+import threading
+from tweet_columns import parquet_column_type, parquet_table, tweet_columns
+
+# Columns written to CSV and Parquet exports, in order
+export_columns = tweet_columns
+
+
+def iter_hits(client, query_body, slices=1, batch_size=1000, keep_alive="2m"):
+  """
+  Yield batches of hits matching a query, paging through a point in time with search_after
+
+  With slices > 1 the point in time is split into sliced searches run by
+  as many threads. Batches go through a bounded queue, so memory stays
+  constant whatever the number of results.
+
+  Attributes:
+    client: Elasticsearch client
+    query_body: ESQueryBuilder with the filters of the export
+    slices: number of slices searched in parallel
+    batch_size: number of hits fetched per request
+    keep_alive: how long ES keeps the point in time open between two requests
+  """
+  pit = client.open_point_in_time(index=query_body.get_index(), keep_alive=keep_alive, ignore_unavailable=True)
+  pit_id = pit["id"]
+  query = query_body.get_query()["query"]
+
+  try:
+    if slices <= 1:
+      yield from _iter_slice(client, query, pit_id, None, batch_size, keep_alive)
+      return
+
+    batches = queue.Queue(maxsize=2 * slices)
+    stop = threading.Event()
+    done = object()
+
+    def run_slice(slice_id):
+      try:
+        for batch in _iter_slice(client, query, pit_id, {"id": slice_id, "max": slices}, batch_size, keep_alive):
+          if not _put(batches, batch, stop):
+            return
+        _put(batches, done, stop)
+      except Exception as e:
+        _put(batches, e, stop)
+
+    threads = [threading.Thread(target=run_slice, args=(i,), daemon=True) for i in range(slices)]
+    for thread in threads:
+      thread.start()
+    try:
+      remaining = slices
+      while remaining:
+        batch = batches.get()
+        if batch is done:
+          remaining -= 1
+        elif isinstance(batch, Exception):
+          raise batch
+        else:
+          yield batch
+    finally:
+      stop.set()
+      for thread in threads:
+        thread.join()
+  finally:
+    client.close_point_in_time(id=pit_id)
+
+
+def _iter_slice(client, query, pit_id, slice_, batch_size, keep_alive):
+  """
+  Yield batches of hits of one slice of a point in time
+  """
+  search_after = None
+  while True:
+    body = {
+      "query": query,
+      "size": batch_size,
+      "pit": {"id": pit_id, "keep_alive": keep_alive},
+      # _shard_doc is the cheapest sort to page through a point in time
+      "sort": [{"_shard_doc": "asc"}],
+      "track_total_hits": False
+    }
+    if slice_ is not None:
+      body["slice"] = slice_
+    if search_after is not None:
+      body["search_after"] = search_after
+
+    hits = client.search(body=body)["hits"]["hits"]
+    if not hits:
+      return
+    yield [hit["_source"] for hit in hits]
+    if len(hits) < batch_size:
+      return
+    search_after = hits[-1]["sort"]
+
+
+def _put(batches, item, stop):
+  """
+  Put an item on the queue unless the export was stopped, returns whether it was put
+  """
+  while not stop.is_set():
+    try:
+      batches.put(item, timeout=0.5)
+      return True
+    except queue.Full:
+      continue
+  return False
+
+
+def ndjson_chunks(batches):
+  """
+  Encode batches of documents as newline delimited JSON, one chunk per batch
+
+  Attributes:
+    batches: iterable of lists of _source dicts
+  """
+  for batch in batches:
+    yield "".join(json.dumps(doc, ensure_ascii=False) + "\n" for doc in batch).encode("utf-8")
+
+
+def csv_chunks(batches, columns=export_columns):
+  """
+  Encode batches of documents as CSV rows, list columns are written as JSON arrays
+
+  Attributes:
+    batches: iterable of lists of _source dicts
+    columns: columns to write, in order
+  """
+  buffer = io.StringIO()
+  writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+  writer.writeheader()
+  for batch in batches:
+    for doc in batch:
+      writer.writerow({
+        key: json.dumps(value, ensure_ascii=False) if isinstance(value, list) else value
+        for key, value in doc.items()
+      })
+    yield buffer.getvalue().encode("utf-8")
+    buffer.seek(0)
+    buffer.truncate()
+  if buffer.tell():
+    yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+  """
+  Write-only file object collecting what the Parquet writer writes, drained after every row group
+  """
+
+  def __init__(self):
+    self.chunks = []
+    self.position = 0
+    self.closed = False
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    self.position += len(data)
+    return len(data)
+
+  def tell(self):
+    return self.position
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.closed = True
+
+  def drain(self):
+    data = b"".join(self.chunks)
+    self.chunks = []
+    return data
+
+
+def parquet_chunks(batches, columns=export_columns):
+  """
+  Encode batches of documents as a Parquet file streamed one row group per batch
+
+  Columns have the types of the Parquet cache of populate_IOA.py, see parquet_column_type.
+
+  Attributes:
+    batches: iterable of lists of _source dicts
+    columns: columns to write, in order
+  """
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  schema = pa.schema([(column, parquet_column_type(column)) for column in columns])
+  sink = _ChunkSink()
+  writer = pq.ParquetWriter(sink, schema)
+  for batch in batches:
+    writer.write_table(parquet_table(batch, columns))
+    yield sink.drain()
+  writer.close()
+  yield sink.drain()
+
+
+# Encoders and content types of the supported export formats
+export_formats = {
+  "ndjson": (ndjson_chunks, "application/x-ndjson"),
+  "csv": (csv_chunks, "text/csv"),
+  "parquet": (parquet_chunks, "application/vnd.apache.parquet")
+}
@@ -0,0 +1,333 @@
+import os
+import shutil
+from array import array
+
+import numpy as np
+
+# Kinds of interaction edges, an edge goes from the account interacting to the one it interacts with.
+# Quotes aren't edges: quoted_tweet_tweetid is a tweet id, the quoted account isn't in the CSVs
+edge_kinds = ("retweet", "reply", "mention")
+
+# Layout of the per account counts in stats.npy: [out weight, out degree, in weight, in degree] x edge kind
+OUT_WEIGHT, OUT_DEGREE, IN_WEIGHT, IN_DEGREE = range(4)
+
+# Arrays of a saved graph, one .npy file each
+graph_arrays = ("users", "out_indptr", "out_indices", "out_weights", "out_kinds",
+                "in_indptr", "in_indices", "in_weights", "in_kinds", "stats")
+
+
+def graph_path(graph_folder, dataset):
+  """
+  Folder holding the interaction graph of a dataset: graph_folder/dataset=<name>/
+
+  Attributes:
+    graph_folder: root folder of the graphs
+    dataset: name of the dataset
+  """
+  return os.path.join(graph_folder, f"dataset={dataset}")
+
+
+class GraphBuilder:
+  """
+    Collects the retweet, reply and mention edges of a dataset from the rows being indexed
+
+    Accounts are interned to int ids as they are seen and edges are kept in
+    compact arrays, so collecting holds about 9 bytes per edge. save() turns
+    them into CSR adjacency arrays (out and in edges, duplicates merged into
+    a weight) written as .npy files the API memory maps.
+
+    Attributes:
+      dataset: name of the dataset the edges belong to
+    """
+
+  def __init__(self, dataset):
+    self.dataset = dataset
+    self.user_ids = {}
+    self.sources = array("i")
+    self.targets = array("i")
+    self.kinds = array("b")
+
+  def _intern(self, userid):
+    index = self.user_ids.get(userid)
+    if index is None:
+      index = self.user_ids[userid] = len(self.user_ids)
+    return index
+
+  def add_edge(self, source, target, kind):
+    """
+    Record an interaction of the account source with the account target
+
+    Attributes:
+      source: userid of the account interacting
+      target: userid of the account interacted with
+      kind: index of the kind of interaction in edge_kinds
+    """
+    if not source or not target or source == target:
+      return
+    self.sources.append(self._intern(source))
+    self.targets.append(self._intern(target))
+    self.kinds.append(kind)
+
+  def tee(self, rows):
+    """
+    Yield rows unchanged, recording their edges on the way
+
+    Attributes:
+      rows: iterable of coerced row dicts
+    """
+    retweet, reply, mention = range(len(edge_kinds))
+    for row in rows:
+      userid = row.get("userid")
+      if userid:
+        if row.get("is_retweet") is True:
+          self.add_edge(userid, row.get("retweet_userid"), retweet)
+        self.add_edge(userid, row.get("in_reply_to_userid"), reply)
+        for mentioned in row.get("user_mentions") or []:
+          self.add_edge(userid, str(mentioned), mention)
+      yield row
+
+  def save(self, graph_folder, merge=False):
+    """
+    Write the graph of the dataset, replacing the saved one
+
+    The graph is written to a .part folder first and swapped in once
+    complete, so the API never maps a half written graph.
+
+    Attributes:
+      graph_folder: root folder of the graphs
+      merge: add the edges to the saved graph of the dataset instead of
+        replacing it, for datasets split over several zips
+
+    Returns:
+      (number of accounts, number of distinct edges)
+    """
+    names = np.array(list(self.user_ids), dtype=str) if self.user_ids else np.array([], dtype="U1")
+    sources = np.frombuffer(self.sources, dtype=np.int32) if self.sources else np.array([], dtype=np.int32)
+    targets = np.frombuffer(self.targets, dtype=np.int32) if self.targets else np.array([], dtype=np.int32)
+    kinds = np.frombuffer(self.kinds, dtype=np.int8) if self.kinds else np.array([], dtype=np.int8)
+    weights = np.ones(len(sources), dtype=np.int64)
+
+    path = graph_path(graph_folder, self.dataset)
+    if merge and os.path.exists(os.path.join(path, "users.npy")):
+      saved = InteractionGraph(path)
+      saved_sources = np.repeat(np.arange(len(saved.users), dtype=np.int64), np.diff(saved.out_indptr))
+      offset = len(names)
+      names = np.concatenate([names, np.asarray(saved.users)])
+      sources = np.concatenate([sources, saved_sources + offset])
+      targets = np.concatenate([targets, np.asarray(saved.out_indices, dtype=np.int64) + offset])
+      kinds = np.concatenate([kinds, saved.out_kinds])
+      weights = np.concatenate([weights, saved.out_weights])
+
+    # Sorted user ids, so the API finds an account with a binary search on the memory mapped array
+    users, user_index = np.unique(names, return_inverse=True)
+    sources = user_index[sources].astype(np.int64)
+    targets = user_index[targets].astype(np.int64)
+    arrays = {"users": users}
+    arrays.update(_csr(sources, targets, kinds, weights, len(users)))
+
+    # Interaction counts of every account, so top accounts are found without going through the edges
+    stats = np.zeros((len(users), 4, len(edge_kinds)), dtype=np.int64)
+    out_sources = np.repeat(np.arange(len(users)), np.diff(arrays["out_indptr"]))
+    in_targets = np.repeat(np.arange(len(users)), np.diff(arrays["in_indptr"]))
+    for kind in range(len(edge_kinds)):
+      out_edges = arrays["out_kinds"] == kind
+      stats[:, OUT_WEIGHT, kind] = np.bincount(out_sources[out_edges], arrays["out_weights"][out_edges], len(users))
+      stats[:, OUT_DEGREE, kind] = np.bincount(out_sources[out_edges], minlength=len(users))
+      in_edges = arrays["in_kinds"] == kind
+      stats[:, IN_WEIGHT, kind] = np.bincount(in_targets[in_edges], arrays["in_weights"][in_edges], len(users))
+      stats[:, IN_DEGREE, kind] = np.bincount(in_targets[in_edges], minlength=len(users))
+    arrays["stats"] = stats
+
+    part_path = f"{path}.part"
+    shutil.rmtree(part_path, ignore_errors=True)
+    os.makedirs(part_path)
+    for name, values in arrays.items():
+      np.save(os.path.join(part_path, f"{name}.npy"), values)
+    if os.path.exists(path):
+      old_path = f"{path}.old"
+      shutil.rmtree(old_path, ignore_errors=True)
+      os.replace(path, old_path)
+      os.replace(part_path, path)
+      shutil.rmtree(old_path, ignore_errors=True)
+    else:
+      os.replace(part_path, path)
+    return len(users), len(arrays["out_indices"])
+
+
+def _csr(sources, targets, kinds, weights, num_users):
+  """
+  Out and in CSR arrays of weighted edges, edges with the same ends and kind merged
+  """
+  num_kinds = len(edge_kinds)
+  keys = (sources * num_users + targets) * num_kinds + kinds
+  keys, inverse = np.unique(keys, return_inverse=True)
+  merged_weights = np.bincount(inverse, weights, len(keys)).astype(np.int64)
+  merged_kinds = (keys % num_kinds).astype(np.int8)
+  pairs = keys // num_kinds
+  merged_sources = pairs // num_users
+  merged_targets = (pairs % num_users).astype(np.int32)
+
+  arrays = {
+    "out_indptr": np.concatenate([[0], np.cumsum(np.bincount(merged_sources, minlength=num_users))]).astype(np.int64),
+    "out_indices": merged_targets,
+    "out_weights": merged_weights,
+    "out_kinds": merged_kinds
+  }
+  order = np.argsort(merged_targets, kind="stable")
+  arrays.update({
+    "in_indptr": np.concatenate([[0], np.cumsum(np.bincount(merged_targets, minlength=num_users))]).astype(np.int64),
+    "in_indices": merged_sources[order].astype(np.int32),
+    "in_weights": merged_weights[order],
+    "in_kinds": merged_kinds[order]
+  })
+  return arrays
+
+
+def _gather(indptr, nodes):
+  """
+  Positions in the CSR indices of the edges of the given nodes
+  """
+  starts = indptr[nodes]
+  lengths = indptr[nodes + 1] - starts
+  total = int(lengths.sum())
+  if not total:
+    return np.array([], dtype=np.int64)
+  # Each position is its node's start plus its rank among the node's edges
+  offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+  return np.repeat(starts, lengths) + np.arange(total) - offsets
+
+
+class InteractionGraph:
+  """
+    Interaction graph of a dataset, memory mapped from the files written by GraphBuilder.save
+
+    Attributes:
+      path: folder of the graph, see graph_path
+    """
+
+  def __init__(self, path):
+    self.path = path
+    for name in graph_arrays:
+      setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+
+  def index_of(self, userid):
+    """
+    Int id of an account in the graph, None if it has no edges
+    """
+    index = int(np.searchsorted(self.users, userid))
+    if index < len(self.users) and self.users[index] == userid:
+      return index
+    return None
+
+  def neighborhood(self, userid, hops=1, kinds=edge_kinds, direction="both", max_nodes=500):
+    """
+    Accounts within hops interactions of an account and the edges between them, None if it is unknown
+
+    Attributes:
+      userid: account at the center of the neighborhood
+      hops: number of interactions away accounts can be
+      kinds: kinds of edges followed, see edge_kinds
+      direction: "out" follows the interactions of the accounts, "in" the
+        interactions with them, "both" either
+      max_nodes: maximum number of accounts returned, the closest ones first
+    """
+    start = self.index_of(userid)
+    if start is None:
+      return None
+    allowed = [edge_kinds.index(kind) for kind in kinds]
+    csrs = []
+    if direction in ("out", "both"):
+      csrs.append((self.out_indptr, self.out_indices, self.out_kinds))
+    if direction in ("in", "both"):
+      csrs.append((self.in_indptr, self.in_indices, self.in_kinds))
+
+    visited = np.array([start], dtype=np.int64)
+    distances = [0]
+    frontier = visited
+    truncated = False
+    for hop in range(1, hops + 1):
+      neighbors = []
+      for indptr, indices, indices_kinds in csrs:
+        positions = _gather(indptr, frontier)
+        positions = positions[np.isin(indices_kinds[positions], allowed)]
+        neighbors.append(np.asarray(indices[positions], dtype=np.int64))
+      frontier = np.setdiff1d(np.concatenate(neighbors), visited)
+      if len(visited) + len(frontier) > max_nodes:
+        frontier = frontier[:max_nodes - len(visited)]
+        truncated = True
+      visited = np.concatenate([visited, frontier])
+      distances += [hop] * len(frontier)
+      if truncated or not len(frontier):
+        break
+
+    # Edges between the accounts of the neighborhood
+    positions = _gather(self.out_indptr, visited)
+    sources = np.repeat(visited, self.out_indptr[visited + 1] - self.out_indptr[visited])
+    targets = np.asarray(self.out_indices[positions])
+    keep = np.isin(targets, visited) & np.isin(self.out_kinds[positions], allowed)
+    edges = [
+      {"source": str(self.users[source]), "target": str(self.users[target]),
+       "kind": edge_kinds[kind], "weight": int(weight)}
+      for source, target, kind, weight in zip(sources[keep], targets[keep],
+                                              self.out_kinds[positions][keep], self.out_weights[positions][keep])
+    ]
+    return {
+      "userid": userid,
+      "hops": hops,
+      "accounts": [{"userid": str(self.users[node]), "hop": distance} for node, distance in zip(visited, distances)],
+      "edges": edges,
+      "truncated": truncated
+    }
+
+  def top_accounts(self, size=10, kinds=("retweet",), direction="out"):
+    """
+    Accounts with the most interactions of the given kinds
+
+    With direction "out", the accounts amplifying others the most (ex:
+    retweeting), with "in" the accounts amplified the most (ex: retweeted).
+
+    Attributes:
+      size: number of accounts returned
+      kinds: kinds of edges counted, see edge_kinds
+      direction: "out" or "in"
+    """
+    allowed = [edge_kinds.index(kind) for kind in kinds]
+    weight, degree = (OUT_WEIGHT, OUT_DEGREE) if direction == "out" else (IN_WEIGHT, IN_DEGREE)
+    counts = self.stats[:, weight, allowed].sum(axis=1)
+    size = min(size, len(counts))
+    if not size:
+      return []
+    top = np.argpartition(-counts, size - 1)[:size]
+    top = top[np.lexsort((top, -counts[top]))]
+    accounts = self.stats[:, degree, allowed].sum(axis=1)
+    return [
+      {"userid": str(self.users[node]), "interactions": int(counts[node]), "accounts": int(accounts[node])}
+      for node in top if counts[node]
+    ]
+
+
+class GraphStore:
+  """
+    Loads the interaction graphs of the datasets on demand, reloading one when populate_IOA.py replaces it
+
+    Attributes:
+      graph_folder: root folder of the graphs
+    """
+
+  def __init__(self, graph_folder):
+    self.graph_folder = graph_folder
+    self.graphs = {}
+
+  def get(self, dataset):
+    """
+    Interaction graph of a dataset, None if it has none
+    """
+    path = graph_path(self.graph_folder, dataset)
+    try:
+      modified = os.stat(os.path.join(path, "users.npy")).st_mtime_ns
+    except FileNotFoundError:
+      return None
+    cached = self.graphs.get(dataset)
+    if cached is None or cached[0] != modified:
+      cached = self.graphs[dataset] = (modified, InteractionGraph(path))
+    return cached[1]
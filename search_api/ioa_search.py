@@ -1,12 +1,17 @@
 
 # A very simple Flask Hello World app for you to get started with...
 from elasticsearch import Elasticsearch, helpers
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from mock_data import mock_tweets
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
-from query_builder import ESQueryBuilder
+from response_cache import ResponseCache
+from route_flows import cascades_flow, clusters_flow, dashboard_flow, insights_flow, run_flow, search_flow
+from search_backend import ElasticsearchBackend, SQLiteBackend
+from export import export_formats, iter_hits
+from graph_store import GraphStore
+from search_params import filtered_query, index_name, meta_index_name, network_result
 
 load_dotenv()
 
@@ -19,7 +24,24 @@ client = Elasticsearch([f'https://{os.getenv("ES_HOST")}:{os.getenv("ES_PORT")}'
                    basic_auth=(os.getenv("ES_USER"), os.getenv("ES_PASSWORD")),
                    verify_certs=False)
 
-index_name = 'ioa-tweets'
+
+# Where searches run: "elasticsearch", or "sqlite" for a local database built by populate_IOA.py
+# on single box deployments. Cursor pagination, exports and rollups need Elasticsearch
+search_backend_name = os.getenv("SEARCH_BACKEND", "elasticsearch")
+if search_backend_name == "sqlite":
+  backend = SQLiteBackend(os.getenv("SQLITE_PATH", "../ioa_local.sqlite"))
+else:
+  backend = ElasticsearchBackend(client, meta_index_name)
+
+
+# Interaction graphs of the datasets, built by populate_IOA.py and memory mapped on first use
+graph_store = GraphStore(os.getenv("GRAPH_FOLDER", "../graph_store"))
+
+
+# The archive is read-only between ingests, so insights are cached until the next one
+insights_cache = ResponseCache(maxsize=int(os.getenv("INSIGHTS_CACHE_SIZE", 512)),
+                               ttl=int(os.getenv("INSIGHTS_CACHE_TTL", 3600)),
+                               generation=backend.generation)
 
 @app.route('/')
 def hello_world():
@@ -66,49 +88,61 @@ def search_query():
     tweet_language: relevant language for results (en, es, etc)
     hashtags: keyword match for hashtags contained in tweets
     user: keyword match for userId
+    dataset: dataset the tweets come from (Venezuela, Russia, etc)
     sort_param: how results should be sorted (likes, retweets, time, etc)
+    fields: comma separated (or repeated) fields to return for each tweet, by
+      default every field but the profile description and display name
+    paginate: set to "cursor" to page with a continuation token instead of page numbers
+    cursor: continuation token returned by the previous page, the other
+      arguments must be the same as for the first page
 
   Returns:
     JSON data of total number of results, and a paginated set of tweets
-    based on the page number and relevant filters
+    based on the page number (or cursor) and relevant filters. In cursor
+    mode, next_cursor is the token of the next page, null on the last page,
+    and an error is returned with 400 if the cursor is malformed or 410 if it expired
   '''
-  query = request.args.get('query', '')
+  response, status = run_flow(
+    search_flow(request.args, index_name, cursors=search_backend_name == "elasticsearch"), backend)
+  return jsonify(response), status
 
-  page = int(request.args.get('page', 1))  # Default to page 1
-  size = int(request.args.get('size', 10))  # Default page size is 10
-  from_index = (page - 1) * size # Calculate 'from' for pagination
 
-  from_date = request.args.get('from')
-  to_date = request.args.get('to')
-  tweet_language = request.args.get('language')
-  hashtags = request.args.getlist('hashtags')
-  user = request.args.get('user')
-  sort_param = request.args.get('sort_by')
+@app.route('/export', methods=["GET"])
+def export_query():
+  '''
+  Stream every tweet matching a query and filters as a file
 
-  query_body = ESQueryBuilder()
+  Args:
+    query: string to match to tweet text or other features (hashtags, users)
+    from_date: YYYY-MM-DD date of when tweets should appear after
+    to_date: YYYY-MM-DD date of when tweets should appear before
+    tweet_language: relevant language for results (en, es, etc)
+    hashtags: keyword match for hashtags contained in tweets
+    user: keyword match for userId
+    dataset: dataset the tweets come from (Venezuela, Russia, etc)
+    format: ndjson (default), csv or parquet
+    slices: number of slices exported in parallel (default 1)
 
-  query_body = (
-    query_body
-    .paginate(from_index, size)
-    .add_query(query)
-    .filter_user(user)
-    .filter_language(tweet_language)
-    .filter_date(to_date, from_date)
-    .filter_hashtags(hashtags)
-    .sort_by(sort_param)
-  )
+  Returns:
+    Chunked download of all the matching tweets, read through a point in
+    time so memory stays constant whatever the number of results
+  '''
+  if search_backend_name != "elasticsearch":
+    return jsonify({"error": "Exports need the elasticsearch backend"}), 400
+  export_format = request.args.get('format', 'ndjson')
+  slices = max(1, min(int(request.args.get('slices', 1)), 16))
 
+  if export_format not in export_formats:
+    return jsonify({"error": f"Unknown format {export_format}, expected one of {list(export_formats)}"}), 400
+  encoder, mimetype = export_formats[export_format]
 
-  results = client.search(index=index_name, body=query_body.get_query())
+  query_body = filtered_query(request.args, index_name)
 
-  tweets = [hit['_source'] for hit in results['hits']['hits']]
-  return jsonify({
-      "total": results['hits']['total']['value'],
-      "page": page,
-      "size": size,
-      "tweets": tweets,
+  chunks = encoder(iter_hits(client, query_body, slices=slices))
+  return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+    "Content-Disposition": f"attachment; filename=ioa-export.{export_format}"
   })
-  
+
 
 @app.route('/insights', methods=["GET"])
 def get_insights():
@@ -122,42 +156,136 @@ def get_insights():
     tweet_language: relevant language for results (en, es, etc)
     hashtags: keyword match for hashtags contained in tweets
     user: keyword match for userId
+    dataset: dataset the tweets come from (Venezuela, Russia, etc)
     interval: how large the histogram buckets should be (year, month, week, etc)
+    mode: "fast" to aggregate a random sample of the tweets and add unique
+      user/hashtag/url counts, trading exact counts for speed
+    sample: share of the tweets sampled in fast mode (default 0.1, up to 0.5, or 1)
 
   Returns:
     JSON data of top hashtags, users, and urls + histogram data for number
-    of tweets over time (in buckets)
-  '''
-  query = request.args.get('query', '')
-
-  from_date = request.args.get('from')
-  to_date = request.args.get('to')
-  tweet_language = request.args.get('language')
-  hashtags = request.args.getlist('hashtags')
-  user = request.args.get('user')
-  interval = request.args.get('interval')
-
-  query_body = ESQueryBuilder()
-
-  query_body = (
-    query_body
-    .add_query(query)
-    .filter_user(user)
-    .filter_language(tweet_language)
-    .filter_date(to_date, from_date)
-    .filter_hashtags(hashtags)
-    .agg_users()
-    .agg_hashtags()
-    .agg_urls()
-    .agg_histogram(interval=interval)
-  )
-  
-  results = client.search(index=index_name, body=query_body.get_query())
+    of tweets over time (in buckets). Requests only filtering on dataset and
+    dates are answered from the precomputed rollups when every dataset they
+    cover has up to date rollups, "approximation" then reports how many top
+    values were kept per time bucket. In fast mode, counts are estimates and
+    "approximation" reports their error
+  '''
+  response, status = run_flow(
+    insights_flow(request.args, insights_cache, index_name, rollups=search_backend_name == "elasticsearch"), backend)
+  return jsonify(response), status
 
-  tweets = [hit['_source'] for hit in results['hits']['hits']]
-  return jsonify({
-    "tweets_over_time": results['aggregations']['tweets_over_time']['buckets'],
-    "top_users": results['aggregations']['top_users']['buckets'],
-    "top_hashtags": results['aggregations']['top_hashtags']['buckets'],
-    "top_urls": results['aggregations']['top_urls']['buckets']
-  })
\ No newline at end of file
+
+@app.route('/clusters', methods=["GET"])
+def get_clusters():
+  '''
+  Largest clusters of near-duplicate tweets (copypasta) matching a search query
+
+  Args:
+    query, from, to, language, hashtags, user, dataset: same filters as /search
+    size: number of clusters (default 10, up to 100)
+    min_size: smallest number of tweets in a cluster (default 2)
+
+  Returns:
+    JSON data of the clusters, largest first, with their number of tweets,
+    number of accounts and earliest tweet. Requests only filtering on dataset
+    are answered from the precomputed cluster summaries when every dataset
+    they cover has up to date summaries
+  '''
+  response, status = run_flow(
+    clusters_flow(request.args, insights_cache, index_name, summaries=search_backend_name == "elasticsearch"), backend)
+  return jsonify(response), status
+
+
+@app.route('/user/<userid>', methods=["GET"])
+def get_user(userid):
+  '''
+  Summary of an account, precomputed by populate_IOA.py
+
+  Args:
+    userid: id of the account
+
+  Returns:
+    JSON data of the latest profile of the account (screen name, followers,
+    description...), its first and last tweet times, tweet and retweet
+    counts, top hashtags, languages and datasets. 404 if the account is unknown
+  '''
+  account = backend.account(userid)
+  if account is None:
+    return jsonify({"error": f"Unknown account: {userid}"}), 404
+  return jsonify(account)
+
+
+@app.route('/network', methods=["GET"])
+def get_network():
+  '''
+  Interaction network (retweets, replies, mentions) of the accounts of a dataset
+
+  Args:
+    dataset: dataset the network is built from (Venezuela, Russia, etc)
+    user: userid to return the neighborhood of
+    hops: how many interactions away neighbors can be (default 1, up to 3)
+    kinds: comma separated kinds of interactions followed and counted
+      (retweet, reply, mention), default to every kind for neighborhoods and
+      to retweets for amplifiers
+    direction: follow the interactions of the accounts ("out"), with them ("in") or both (default)
+    size: number of top amplifiers (default 10, up to 100)
+    max_nodes: maximum number of accounts in the neighborhood (default 500)
+
+  Returns:
+    JSON data of the accounts amplifying others the most (amplifiers) and
+    the most amplified ones (amplified), with their number of interactions
+    and of distinct accounts. With user, the accounts of its neighborhood
+    with their distance in hops and the weighted edges between them
+  '''
+  network, status = network_result(graph_store, request.args)
+  return jsonify(network), status
+
+
+@app.route('/cascades', methods=["GET"])
+def get_cascades():
+  '''
+  Top retweet cascades (original tweets amplified by retweets), precomputed by populate_IOA.py
+
+  Args:
+    query, from, to, language, hashtags, user, dataset: same filters as /search,
+      applied to the text, active dates, retweets and accounts of the cascades
+    size: number of cascades (default 10, up to 100)
+    sort_by: size (default), accounts, velocity or time
+    participants: "true" to return the retweeting accounts of each cascade
+
+  Returns:
+    JSON data of the total number of cascades and the top ones, with their
+    first/last retweet times, size, accounts, velocity (retweets per hour)
+    and hourly timeline
+  '''
+  if search_backend_name != "elasticsearch":
+    return jsonify({"error": "Cascades need the elasticsearch backend"}), 400
+
+  response, status = run_flow(cascades_flow(request.args, insights_cache), backend)
+  return jsonify(response), status
+
+
+@app.route('/dashboard', methods=["GET"])
+def get_dashboard():
+  '''
+  A page of tweets and the insights of the same query and filters in one round trip
+
+  Args:
+    Same as /search (page numbers only, no cursor) and /insights
+
+  Returns:
+    JSON data of the /search response merged with the /insights response
+  '''
+  response, status = run_flow(dashboard_flow(request.args, insights_cache, index_name), backend)
+  return jsonify(response), status
+
+
+@app.route('/cache_stats', methods=["GET"])
+def cache_stats():
+  '''
+  Hit/miss statistics of the insights cache
+
+  Returns:
+    JSON data of the cache size, hits, misses, evictions and current index generation
+  '''
+  return jsonify(insights_cache.stats())
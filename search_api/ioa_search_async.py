@@ -0,0 +1,169 @@
+# Async version of the IOA search API, serves /search and /insights with Quart on an ASGI server:
+#   hypercorn ioa_search_async:app --workers 2
+# It only searches Elasticsearch, SEARCH_BACKEND=sqlite deployments run the Flask app (ioa_search.py).
+# Routes run the same flows as the Flask app, see route_flows.py
+import asyncio
+import os
+from elasticsearch import AsyncElasticsearch
+from quart import Quart, request, jsonify
+from quart_cors import cors
+from dotenv import load_dotenv
+from graph_store import GraphStore
+from response_cache import ResponseCache
+from route_flows import (cascades_flow, clusters_flow, dashboard_flow, insights_flow, run_flow_async,
+                         search_flow)
+from search_backend import AsyncElasticsearchBackend
+from search_params import index_name, meta_index_name, network_result
+
+load_dotenv()
+
+if os.getenv("SEARCH_BACKEND", "elasticsearch") != "elasticsearch":
+  raise RuntimeError("The async API only searches Elasticsearch, run ioa_search.py for SEARCH_BACKEND="
+                     f"{os.getenv('SEARCH_BACKEND')}")
+
+app = Quart(__name__)
+app = cors(app, allow_origin="http://localhost:3000")
+
+
+# Create the async Elasticsearch client with HTTPS and authentication. Connections are
+# kept alive and pooled, sized for the number of requests served concurrently per process
+client = AsyncElasticsearch([f'https://{os.getenv("ES_HOST")}:{os.getenv("ES_PORT")}'],
+                   basic_auth=(os.getenv("ES_USER"), os.getenv("ES_PASSWORD")),
+                   verify_certs=False,
+                   connections_per_node=int(os.getenv("ES_CONNECTIONS", 100)),
+                   request_timeout=float(os.getenv("ES_REQUEST_TIMEOUT", 30)),
+                   http_compress=True,
+                   retry_on_timeout=True,
+                   max_retries=2)
+
+# Timeout of a single search, a slow query fails fast instead of holding a connection
+search_timeout = float(os.getenv("ES_SEARCH_TIMEOUT", 10))
+backend = AsyncElasticsearchBackend(client.options(request_timeout=search_timeout), meta_index_name)
+
+# Insights cache, cleared when the index generation polled by a background task changes,
+# so lookups never wait on ES
+insights_cache = ResponseCache(maxsize=int(os.getenv("INSIGHTS_CACHE_SIZE", 512)),
+                               ttl=int(os.getenv("INSIGHTS_CACHE_TTL", 3600)))
+generation_check_interval = 30
+
+graph_store = GraphStore(os.getenv("GRAPH_FOLDER", "../graph_store"))
+
+
+async def watch_generation():
+  """
+  Clear the insights cache whenever the index generation changes
+  """
+  while True:
+    try:
+      insights_cache.set_generation(await backend.generation())
+    except Exception as e:
+      app.logger.warning(f"Failed to check the index generation: {e}")
+    await asyncio.sleep(generation_check_interval)
+
+
+@app.before_serving
+async def start_generation_watch():
+  insights_cache.current_generation = await backend.generation()
+  app.add_background_task(watch_generation)
+
+
+@app.after_serving
+async def close_client():
+  await client.close()
+
+
+@app.route('/')
+async def hello_world():
+    return 'Welcome to IOA!'
+
+
+@app.route('/search', methods=["GET"])
+async def search_query():
+  '''
+  Paginated tweet results based on query and filters, same arguments and response as the Flask API
+
+  Returns:
+    JSON data of total number of results, and a paginated set of tweets
+    based on the page number (or cursor) and relevant filters
+  '''
+  response, status = await run_flow_async(search_flow(request.args, index_name), backend)
+  return jsonify(response), status
+
+
+@app.route('/insights', methods=["GET"])
+async def get_insights():
+  '''
+  ES aggregations for statistics based on a search query, same arguments and response as the Flask API
+
+  Returns:
+    JSON data of top hashtags, users, and urls + histogram data for number
+    of tweets over time (in buckets)
+  '''
+  response, status = await run_flow_async(insights_flow(request.args, insights_cache, index_name), backend)
+  return jsonify(response), status
+
+
+@app.route('/clusters', methods=["GET"])
+async def get_clusters():
+  '''
+  Largest clusters of near-duplicate tweets matching a search query, same arguments and response as the Flask API
+
+  Returns:
+    JSON data of the clusters, largest first, with their number of tweets,
+    number of accounts and earliest tweet
+  '''
+  response, status = await run_flow_async(clusters_flow(request.args, insights_cache, index_name), backend)
+  return jsonify(response), status
+
+
+@app.route('/user/<userid>', methods=["GET"])
+async def get_user(userid):
+  '''
+  Summary of an account, precomputed by populate_IOA.py, same response as the Flask API
+  '''
+  account = await backend.account(userid)
+  if account is None:
+    return jsonify({"error": f"Unknown account: {userid}"}), 404
+  return jsonify(account)
+
+
+@app.route('/network', methods=["GET"])
+async def get_network():
+  '''
+  Interaction network of the accounts of a dataset, same arguments and response as the Flask API
+
+  Graphs are memory mapped and queries take milliseconds, so they run on the event loop.
+  '''
+  network, status = network_result(graph_store, request.args)
+  return jsonify(network), status
+
+
+@app.route('/cascades', methods=["GET"])
+async def get_cascades():
+  '''
+  Top retweet cascades, precomputed by populate_IOA.py, same arguments and response as the Flask API
+  '''
+  response, status = await run_flow_async(cascades_flow(request.args, insights_cache), backend)
+  return jsonify(response), status
+
+
+@app.route('/dashboard', methods=["GET"])
+async def get_dashboard():
+  '''
+  A page of tweets and the insights of the same query and filters in one round trip,
+  same arguments and response as the Flask API
+  '''
+  response, status = await run_flow_async(dashboard_flow(request.args, insights_cache, index_name), backend)
+  return jsonify(response), status
+
+
+@app.route('/cache_stats', methods=["GET"])
+async def cache_stats():
+  '''
+  Hit/miss statistics of the insights cache
+  '''
+  return jsonify(insights_cache.stats())
+
+
+if __name__ == "__main__":
+  app.run()
@@ -1,4 +1,62 @@
-from elasticsearch import Elasticsearch
+import base64
+import hashlib
+import json
+import logging
+import re
+from datetime import date
+from elasticsearch import Elasticsearch, NotFoundError
+
+logger = logging.getLogger(__name__)
+
+# Date ranges over more years than this search the yearly indices through their alias instead of listing them
+max_partition_years = 5
+
+# Search templates built so far, keyed by query shape: (template id, mustache source).
+# Shapes only depend on which builder methods ran, so there are few of them, the cap is a safeguard
+_template_cache = {}
+max_templates = 256
+# Ids of the templates stored in the cluster by this process
+registered_templates = set()
+
+
+# Template params are put in the body as instances of these subclasses: they serialize like the
+# value they wrap, and being distinct objects they can be found in the body to build the template
+class _StrParam(str):
+  pass
+
+
+class _IntParam(int):
+  pass
+
+
+class _FloatParam(float):
+  pass
+
+
+class _ListParam(list):
+  pass
+
+
+_param_types = {str: _StrParam, int: _IntParam, float: _FloatParam, list: _ListParam}
+
+
+def _with_placeholders(value, names):
+  """
+  Copy of a query body with its template params replaced by @@name@@ placeholders
+
+  Attributes:
+    value: query body, or part of it
+    names: dict of id of a param in the body to its name
+  """
+  name = names.get(id(value))
+  if name is not None:
+    return f"@@{name}@@"
+  if isinstance(value, dict):
+    return {key: _with_placeholders(item, names) for key, item in value.items()}
+  if isinstance(value, list):
+    return [_with_placeholders(item, names) for item in value]
+  return value
+
 
 class ESQueryBuilder:
   """
@@ -7,18 +65,25 @@ class ESQueryBuilder:
     Attributes:
       index_name: relevant index name for query
       body: main body for the ES query  
+      partitioned: whether index_name is an alias over yearly indices (index_name-YYYY)
 
     Each function returns the class so that it can be method-chained.
     """
 
-  def __init__(self, index_name="ioa-tweets"):
+  def __init__(self, index_name="ioa-tweets", partitioned=False):
     """
     Initialize the main query body to be built upon
 
     Attributes:
       index_name: relevant index name for query
+      partitioned: whether index_name is an alias over yearly indices (index_name-YYYY)
     """
     self.index_name = index_name
+    self.partitioned = partitioned
+    self.years = None
+    # What the builder added to the body, and the request values sent as template params, see get_template
+    self.shape = []
+    self.params = {}
     self.body = {
       "query": {
         "bool": {
@@ -39,19 +104,82 @@ class ESQueryBuilder:
       from_index: Starting position for the results
       size: number of results needed
     """
-    self.body["from"] = from_index
+    self.shape.append(("paginate",))
+    self.body["from"] = self._param("from", from_index)
+    self.body["size"] = self._param("size", size)
+    return self
+
+  def aggregations_only(self):
+    """
+    Don't return any hits, used for aggregation-only queries
+    """
+    self.shape.append(("aggregations_only",))
+    self.body.pop("from", None)
+    self.body["size"] = 0
+    return self
+
+  def track_total_hits(self, track=True):
+    """
+    Set how the total number of hits is counted
+
+    Attributes:
+      track: True to count every hit, False to skip counting, or an int to count up to that number
+    """
+    self.shape.append(("track_total_hits", track))
+    self.body["track_total_hits"] = track
+    return self
+
+  def source(self, includes=None, excludes=None):
+    """
+    Only return some fields of the _source of each hit
+
+    Attributes:
+      includes: list of fields to return (wildcards allowed), None for all fields
+      excludes: list of fields not to return
+    """
+    self.shape.append(("source", bool(includes), tuple(excludes or ())))
+    source = {}
+    if includes:
+      source["includes"] = self._param("includes", list(includes))
+    if excludes:
+      source["excludes"] = excludes
+    if source:
+      self.body["_source"] = source
+    else:
+      self.body.pop("_source", None)
+    return self
+
+  def paginate_after(self, pit_id, search_after=None, size=10, keep_alive="5m"):
+    """
+    Set cursor based pagination on a point in time, used to page deep into results
+
+    Every page costs the same, and isn't limited by index.max_result_window
+    like from/size. Results are sorted with a tiebreak on tweetid so the
+    order is stable across pages.
+
+    Attributes:
+      pit_id: id of the point in time to search
+      search_after: sort values of the last hit of the previous page, None for the first page
+      size: number of results needed
+      keep_alive: how long ES should keep the point in time open after this request
+    """
+    self.body.pop("from", None)
     self.body["size"] = size
+    self.body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+    if search_after:
+      self.body["search_after"] = search_after
     return self
 
-  def agg_users(self, field: str = "user_screen_name.keyword", size: int = 10, agg_name: str = "top_users"):
+  def agg_users(self, field: str = "user_screen_name", size: int = 10, agg_name: str = "top_users"):
     """
     Add aggregate of the top users to the query
 
     Attributes:
-      field: what to aggregate on, default to user_screen_name keyword
+      field: what to aggregate on, default to user_screen_name (keyword type)
       size: number of results, default to top 10 user names
       agg_name: name for aggregation result
     """
+    self.shape.append(("agg_users", field, size, agg_name))
     self.body["aggs"][agg_name] = {
       "terms": {
         "field": field,
@@ -70,6 +198,7 @@ class ESQueryBuilder:
       size: number of results, default to top 10 urls
       agg_name: name for aggregation result
     """
+    self.shape.append(("agg_urls", field, size, agg_name))
     self.body["aggs"][agg_name] = {
       "terms": {
         "field": field,
@@ -88,6 +217,7 @@ class ESQueryBuilder:
       size: number of results, default to top 10 hashtags
       agg_name: name for aggregation results
     """
+    self.shape.append(("agg_hashtags", field, size, agg_name))
     self.body["aggs"][agg_name] = {
       "terms": {
         "field": field,
@@ -108,10 +238,82 @@ class ESQueryBuilder:
     """
     if interval is None:
       interval = "year"
+    self.shape.append(("agg_histogram", field, agg_name))
     self.body["aggs"][agg_name] = {
       "date_histogram": {
         "field": field,
-        "calendar_interval": interval
+        "calendar_interval": self._param(f"{agg_name}_interval", interval)
+      }
+    }
+    return self
+
+  def agg_cardinality(self, field: str, agg_name: str, precision_threshold: int = 3000):
+    """
+    Add an approximate count of the unique values of a field to the query
+
+    Attributes:
+      field: what to count the unique values of (keyword type)
+      agg_name: name for aggregation results
+      precision_threshold: counts below it are close to exact, higher values use more memory
+    """
+    self.shape.append(("agg_cardinality", field, agg_name, precision_threshold))
+    self.body["aggs"][agg_name] = {
+      "cardinality": {
+        "field": field,
+        "precision_threshold": precision_threshold
+      }
+    }
+    return self
+
+  def sample_aggs(self, probability: float = 0.1, seed: int = 42, agg_name: str = "sample"):
+    """
+    Run the aggregations added so far on a random sample of the matching documents
+
+    Counts are scaled back by ES, so they estimate the counts over every
+    document. Aggregations added afterwards run on every document.
+
+    Attributes:
+      probability: probability of a document being sampled, between 0 and 0.5, or 1
+      seed: seed of the sampling, the same seed gives the same sample
+      agg_name: name for the sampler aggregation results
+    """
+    self.shape.append(("sample_aggs", seed, agg_name))
+    self.body["aggs"] = {
+      agg_name: {
+        "random_sampler": {"probability": self._param(f"{agg_name}_probability", probability), "seed": seed},
+        "aggs": self.body["aggs"]
+      }
+    }
+    return self
+
+  def agg_clusters(self, size: int = 10, min_doc_count: int = 2, agg_name: str = "top_clusters"):
+    """
+    Add aggregate of the largest near-duplicate clusters to the query
+
+    Each cluster comes with its number of accounts and its first tweet.
+
+    Attributes:
+      size: number of clusters, default to the top 10
+      min_doc_count: smallest cluster returned, default leaves out unique tweets
+      agg_name: name for aggregation result
+    """
+    self.shape.append(("agg_clusters", agg_name))
+    self.body["aggs"][agg_name] = {
+      "terms": {
+        "field": "cluster_id",
+        "size": self._param(f"{agg_name}_size", size),
+        "min_doc_count": self._param(f"{agg_name}_min_doc_count", min_doc_count),
+        "order": {"_count": "desc"}
+      },
+      "aggs": {
+        "accounts": {"cardinality": {"field": "userid"}},
+        "first_tweet": {
+          "top_hits": {
+            "size": 1,
+            "sort": [{"tweet_time": {"order": "asc"}}],
+            "_source": {"includes": ["tweetid", "tweet_text", "tweet_time", "user_screen_name", "dataset"]}
+          }
+        }
       }
     }
     return self
@@ -124,10 +326,11 @@ class ESQueryBuilder:
       query: adds search query to the body
     """
     if query:
+      self.shape.append(("add_query",))
       self.body['query']['bool']['must'].append({
               "multi_match": {
-                  "query": query,
-                  "fields": ["text", "user", "hashtags"],
+                  "query": self._param("query", query),
+                  "fields": ["tweet_text", "user_screen_name", "hashtags"],
                   "fuzziness": "AUTO"
               }
           })
@@ -141,8 +344,9 @@ class ESQueryBuilder:
       userid: userid to filter tweets by
     """
     if userid:
+      self.shape.append(("filter_user",))
       self.body['query']['bool']['filter'].append({
-        "term": {"userid.keyword": userid}
+        "term": {"userid": self._param("userid", userid)}
       })
     return self
 
@@ -154,8 +358,9 @@ class ESQueryBuilder:
       language: language to filter by
     """
     if language:
+      self.shape.append(("filter_language",))
       self.body["query"]["bool"]["filter"].append({
-        "term": {"tweet_language.keyword": language}
+        "term": {"tweet_language": self._param("language", language)}
       })
     return self
 
@@ -168,17 +373,38 @@ class ESQueryBuilder:
       from_date: ending date
     """
     if to_date or from_date:
+      self.shape.append(("filter_date", bool(from_date), bool(to_date)))
       date_range = {}
       if from_date:
-        date_range["gte"] = from_date
+        date_range["gte"] = self._param("from_date", from_date)
       if to_date:
-        date_range["lte"] = to_date
+        date_range["lte"] = self._param("to_date", to_date)
       
       self.body['query']['bool']['filter'].append({
         "range": {
           "tweet_time": date_range
         }
       })
+
+      # Years covered by the range, used to only search the matching yearly indices
+      from_year = _year(from_date)
+      to_year = _year(to_date) if to_date else date.today().year
+      if from_year and to_year and 0 <= to_year - from_year < max_partition_years:
+        self.years = range(from_year, to_year + 1)
+    return self
+
+  def filter_dataset(self, dataset):
+    """
+    Filter the results by a dataset only
+
+    Attributes:
+      dataset: dataset to filter by (ex: Venezuela, Russia)
+    """
+    if dataset:
+      self.shape.append(("filter_dataset",))
+      self.body["query"]["bool"]["filter"].append({
+        "term": {"dataset": self._param("dataset", dataset)}
+      })
     return self
 
   def filter_hashtags(self, hashtags):
@@ -188,9 +414,12 @@ class ESQueryBuilder:
     Attributes:
       hashtags: list of hashtags to filter by (AND, results will include all hashtags provided)
     """
-    for hashtag in hashtags:
+    # One clause holding every hashtag, so any number of hashtags shares a template
+    terms = [{"term": {"hashtags": hashtag}} for hashtag in hashtags if hashtag]
+    if terms:
+      self.shape.append(("filter_hashtags",))
       self.body["query"]["bool"]["filter"].append({
-        "term": {"hashtags": hashtag}
+        "bool": {"filter": self._param("hashtag_filters", terms)}
       })
     return self
 
@@ -202,7 +431,6 @@ class ESQueryBuilder:
       sort_param: parameter for search to be sorted by
     """
     if sort_param:
-      print(sort_param)
       sort_mapping = {
         'accuracy': '_score',
         'time': 'tweet_time',
@@ -211,14 +439,156 @@ class ESQueryBuilder:
       }
 
       self.body['sort'] = [{str(sort_mapping[sort_param]): {'order': 'desc'}}]
-      print(self.body['sort'])
+      self.shape.append(("sort_by", sort_param))
+      logger.debug("Sorting by %s: %s", sort_param, self.body['sort'])
     return self
   
   def get_query(self):
     """
     Return the current query body, to be used to call ES
     """
-    return self.body
+    if "pit" not in self.body:
+      return self.body
 
-  
-  
\ No newline at end of file
+    # search_after needs a unique sort, tweetid breaks ties between equal values
+    body = dict(self.body)
+    body["sort"] = self.body.get("sort", [{"_score": {"order": "desc"}}]) + [{"tweetid": {"order": "asc"}}]
+    return body
+
+  def get_template(self):
+    """
+    Return the query as a search template: (template id, mustache source, params)
+
+    Queries built with the same calls share a template, with the values of
+    the request sent as params, so a template only depends on fixed choices
+    of the code and not on the values of the request. Templates are built
+    once per shape and cached for the life of the process.
+    """
+    if "pit" in self.body:
+      raise ValueError("Point in time searches can't be sent as search templates")
+
+    signature = tuple(self.shape)
+    template = _template_cache.get(signature)
+    if template is None:
+      # Swap the params of the body for placeholders, then turn them into mustache tags
+      names = {id(value): name for name, value in self.params.items()}
+      source = json.dumps(_with_placeholders(self.body, names), separators=(",", ":"))
+      source = re.sub(r'"@@(\w+)@@"', r"{{#toJson}}\1{{/toJson}}", source)
+      template_id = "ioa-search-" + hashlib.sha1(source.encode()).hexdigest()[:16]
+      if len(_template_cache) >= max_templates:
+        del _template_cache[next(iter(_template_cache))]
+      template = _template_cache[signature] = (template_id, source)
+    return template[0], template[1], self.params
+
+  def _param(self, key, value):
+    """
+    Record a template param, returns the value to build the query with
+    """
+    name = key
+    suffix = 1
+    while name in self.params:
+      name = f"{key}_{suffix}"
+      suffix += 1
+    value = self.params[name] = _param_types[type(value)](value)
+    return value
+
+  def get_index(self):
+    """
+    Return the indices the query should run on, to be used to call ES with ignore_unavailable
+
+    When the index is partitioned by year and the query has a date range
+    of at most max_partition_years years, only the yearly indices
+    overlapping the range are returned, otherwise the whole alias.
+    """
+    if not self.partitioned or self.years is None:
+      return self.index_name
+    return ",".join(f"{self.index_name}-{year}" for year in self.years)
+
+
+def _year(value):
+  """
+  Year of a YYYY-MM-DD date, None if the date doesn't start with a year
+  """
+  if value and value[:4].isascii() and value[:4].isdigit():
+    return int(value[:4])
+  return None
+
+
+def search_with_template(client, query_body, **kwargs):
+  """
+  Run a query as a stored search template, storing the template first if this process hasn't yet
+
+  Attributes:
+    client: Elasticsearch client
+    query_body: ESQueryBuilder to run
+    kwargs: other arguments of the search_template API
+  """
+  template_id, source, params = query_body.get_template()
+  for attempt in range(2):
+    if template_id not in registered_templates:
+      client.put_script(id=template_id, script={"lang": "mustache", "source": source})
+      registered_templates.add(template_id)
+    try:
+      return client.search_template(index=query_body.get_index(), id=template_id, params=params,
+                                    ignore_unavailable=True, **kwargs)
+    except NotFoundError:
+      # The stored script was deleted from the cluster, store it again
+      if attempt:
+        raise
+      registered_templates.discard(template_id)
+
+
+async def async_search_with_template(client, query_body, **kwargs):
+  """
+  search_with_template for an AsyncElasticsearch client
+
+  Attributes:
+    client: AsyncElasticsearch client
+    query_body: ESQueryBuilder to run
+    kwargs: other arguments of the search_template API
+  """
+  template_id, source, params = query_body.get_template()
+  for attempt in range(2):
+    if template_id not in registered_templates:
+      await client.put_script(id=template_id, script={"lang": "mustache", "source": source})
+      registered_templates.add(template_id)
+    try:
+      return await client.search_template(index=query_body.get_index(), id=template_id, params=params,
+                                          ignore_unavailable=True, **kwargs)
+    except NotFoundError:
+      if attempt:
+        raise
+      registered_templates.discard(template_id)
+
+
+
+def encode_cursor(pit_id, search_after):
+  """
+  Build the opaque continuation token returned to clients for cursor pagination
+
+  Attributes:
+    pit_id: id of the point in time being paged through
+    search_after: sort values of the last hit returned
+  """
+  payload = json.dumps({"pit": pit_id, "after": search_after}, separators=(",", ":"))
+  return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+  """
+  Read a continuation token built by encode_cursor, returns (pit_id, search_after)
+
+  Raises ValueError if the token is malformed.
+
+  Attributes:
+    cursor: token sent back by the client
+  """
+  try:
+    payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    pit_id, search_after = payload["pit"], payload["after"]
+  except (ValueError, TypeError, KeyError) as e:
+    # binascii, JSON and UTF-8 errors are ValueErrors, TypeError is a payload that isn't an object
+    raise ValueError("Invalid cursor") from e
+  if not isinstance(pit_id, str) or not isinstance(search_after, list):
+    raise ValueError("Invalid cursor")
+  return pit_id, search_after
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+  """
+    An in-process LRU cache of API responses with a TTL
+
+    Entries are keyed on the normalized ES query, and the whole cache is
+    dropped when the index generation (bumped by populate_IOA.py at the
+    end of every ingest) changes.
+
+    Attributes:
+      maxsize: maximum number of responses kept, least recently used ones are evicted first
+      ttl: number of seconds a response stays valid
+      generation: optional function returning the current index generation
+      generation_check_interval: minimum number of seconds between two generation checks
+    """
+
+  def __init__(self, maxsize=256, ttl=600, generation=None, generation_check_interval=30):
+    """
+    Initialize an empty cache
+
+    Attributes:
+      maxsize: maximum number of responses kept, least recently used ones are evicted first
+      ttl: number of seconds a response stays valid
+      generation: optional function returning the current index generation
+      generation_check_interval: minimum number of seconds between two generation checks
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.generation = generation
+    self.generation_check_interval = generation_check_interval
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.current_generation = None
+    self.last_generation_check = None
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  @staticmethod
+  def make_key(index, body):
+    """
+    Build a cache key from the indices and body of an ES query, independent of key order
+
+    Attributes:
+      index: indices the query runs on
+      body: ES query body
+    """
+    return json.dumps([index, body], sort_keys=True, separators=(",", ":"), default=str)
+
+  def get(self, key):
+    """
+    Return the cached response for a key, None if it is missing or expired
+
+    Attributes:
+      key: key returned by make_key
+    """
+    self._check_generation()
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+          del self.entries[key]
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value, invalidations=None):
+    """
+    Cache a response, evicting the least recently used one if the cache is full
+
+    Callers pass the invalidations count read when their lookup missed, so
+    a response computed before the cache was cleared is not written back.
+
+    Attributes:
+      key: key returned by make_key
+      value: response to cache
+      invalidations: value of self.invalidations when the lookup missed, None to always cache the response
+    """
+    with self.lock:
+      if invalidations is not None and invalidations != self.invalidations:
+        return
+      self.entries[key] = (time.monotonic() + self.ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    """
+    Drop every cached response
+    """
+    with self.lock:
+      self.entries.clear()
+      self.invalidations += 1
+
+  def stats(self):
+    """
+    Return hit/miss statistics of the cache
+    """
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "size": len(self.entries),
+        "maxsize": self.maxsize,
+        "ttl": self.ttl,
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0.0,
+        "evictions": self.evictions,
+        "invalidations": self.invalidations,
+        "generation": self.current_generation
+      }
+
+  def _check_generation(self):
+    """
+    Clear the cache if the index generation changed since the last check
+    """
+    if self.generation is None:
+      return
+    now = time.monotonic()
+    first_check = self.last_generation_check is None
+    if not first_check and now - self.last_generation_check < self.generation_check_interval:
+      return
+    self.last_generation_check = now
+
+    generation = self.generation()
+    if first_check:
+      self.current_generation = generation
+    else:
+      self.set_generation(generation)
+
+  def set_generation(self, generation):
+    """
+    Set the current index generation, clearing the cache if it changed
+
+    Attributes:
+      generation: current index generation
+    """
+    if generation != self.current_generation:
+      self.current_generation = generation
+      self.clear()
@@ -0,0 +1,192 @@
+# Index of the top users/hashtags/urls per dataset and day/week/month, built by populate_IOA.py
+rollup_index_name = "ioa-rollups"
+
+# Rolled up field of each /insights terms aggregation
+rollup_fields = {
+  "top_users": "user_screen_name",
+  "top_hashtags": "hashtags",
+  "top_urls": "urls"
+}
+
+# Number of top values of each field kept per time bucket by populate_IOA.py
+rollup_top_k = 100
+
+# Histogram intervals that can be summed from rollup buckets
+rollup_intervals = {"day", "1d", "week", "1w", "month", "1M", "quarter", "1q", "year", "1y"}
+
+# Field of the coverage marker of a dataset: a document whose count is the number of tweets
+# of the dataset its rollups were built from, they only answer requests while it matches
+coverage_field = "coverage"
+
+# Maximum number of datasets whose coverage is checked in one request
+max_datasets = 10000
+
+# Request arguments rollups can't answer, any of them means a live aggregation
+live_only_args = ("query", "user", "language", "hashtags")
+
+
+def can_use_rollups(args):
+  """
+  Whether an /insights request only filters on dataset and dates, so it can be answered from the rollups
+
+  Attributes:
+    args: request arguments (request.args)
+  """
+  if any(args.get(arg) for arg in live_only_args) or args.get('mode') == 'fast':
+    return False
+  return args.get('interval', 'year') in rollup_intervals
+
+
+def rollup_granularity(args):
+  """
+  Coarsest rolled up granularity an /insights request can be answered from
+
+  Day buckets line up with any date range, weeks and months are only used
+  for unbounded requests with a histogram at least that wide.
+
+  Attributes:
+    args: request arguments (request.args)
+  """
+  interval = args.get('interval', 'year')
+  if args.get('from') or args.get('to') or interval in ("day", "1d"):
+    return "day"
+  if interval in ("week", "1w"):
+    return "week"
+  return "month"
+
+
+def rollup_query(args, size=10):
+  """
+  Build the rollup index query answering an /insights request, returns (index, body)
+
+  Top values are the sum of the top values of every time bucket, so they
+  are approximate when a value only makes the top of some buckets.
+
+  Attributes:
+    args: request arguments (request.args), see can_use_rollups
+    size: number of top users/hashtags/urls returned
+  """
+  filters = [{"term": {"granularity": rollup_granularity(args)}}]
+  if args.get('dataset'):
+    filters.append({"term": {"dataset": args.get('dataset')}})
+  date_range = {}
+  if args.get('from'):
+    date_range["gte"] = args.get('from')
+  if args.get('to'):
+    date_range["lte"] = args.get('to')
+  if date_range:
+    filters.append({"range": {"bucket": date_range}})
+
+  aggs = {
+    "tweets_over_time": {
+      "filter": {"term": {"field": "tweets"}},
+      "aggs": {
+        "buckets": {
+          "date_histogram": {"field": "bucket", "calendar_interval": args.get('interval') or "year"},
+          "aggs": {"count": {"sum": {"field": "count"}}}
+        }
+      }
+    }
+  }
+  for agg_name, field in rollup_fields.items():
+    aggs[agg_name] = {
+      "filter": {"term": {"field": field}},
+      "aggs": {
+        "buckets": {
+          "terms": {"field": "key", "size": size, "order": {"count": "desc"}},
+          "aggs": {"count": {"sum": {"field": "count"}}}
+        }
+      }
+    }
+  # Coverage markers have no granularity or bucket, they are found whatever the filters
+  aggs["coverage"] = {
+    "global": {},
+    "aggs": {
+      "markers": {
+        "filter": {"term": {"field": coverage_field}},
+        "aggs": {
+          "datasets": {
+            "terms": {"field": "dataset", "size": max_datasets},
+            "aggs": {"count": {"max": {"field": "count"}}}
+          }
+        }
+      }
+    }
+  }
+
+  body = {
+    "query": {"bool": {"filter": filters}},
+    "size": 0,
+    "track_total_hits": False,
+    "aggs": aggs
+  }
+  return rollup_index_name, body
+
+
+def coverage_query(args):
+  """
+  Build the tweet indices query counting the tweets of every dataset an /insights or /clusters request covers
+
+  Attributes:
+    args: request arguments (request.args), see can_use_rollups
+  """
+  filters = []
+  if args.get('dataset'):
+    filters.append({"term": {"dataset": args.get('dataset')}})
+  return {
+    "query": {"bool": {"filter": filters}},
+    "size": 0,
+    "track_total_hits": False,
+    "aggs": {"datasets": {"terms": {"field": "dataset", "size": max_datasets}}}
+  }
+
+
+def covers(coverage, coverage_results):
+  """
+  Whether the coverage markers of precomputed documents count as many tweets as the tweet indices hold, per dataset
+
+  Attributes:
+    coverage: global aggregation of the markers, datasets buckets with the count of tweets they were built from
+    coverage_results: ES search response of coverage_query
+  """
+  covered = {bucket['key']: bucket['count']['value'] for bucket in coverage['markers']['datasets']['buckets']}
+  return all(
+    covered.get(bucket['key']) == bucket['doc_count']
+    for bucket in coverage_results['aggregations']['datasets']['buckets']
+  )
+
+
+def rollup_insights_response(results, coverage_results):
+  """
+  Extract the /insights response from the ES results of rollup_query, None if the rollups don't cover it
+
+  Every dataset in scope needs a coverage marker counting as many tweets as
+  the tweet indices hold, otherwise its rollups are missing or outdated and
+  the request is aggregated live. Counts are put back in doc_count so the
+  response has the same shape as a live /insights response, with an
+  "approximation" flag since top values are summed from per bucket tops.
+
+  Attributes:
+    results: ES search response of rollup_query
+    coverage_results: ES search response of coverage_query
+  """
+  aggregations = results['aggregations']
+  if not aggregations['tweets_over_time']['doc_count']:
+    return None
+  if not covers(aggregations['coverage'], coverage_results):
+    return None
+
+  def buckets(agg_name):
+    return [
+      {**{key: value for key, value in bucket.items() if key != "count"}, "doc_count": int(bucket["count"]["value"])}
+      for bucket in aggregations[agg_name]['buckets']['buckets']
+    ]
+
+  return {
+    "tweets_over_time": buckets("tweets_over_time"),
+    "top_users": buckets("top_users"),
+    "top_hashtags": buckets("top_hashtags"),
+    "top_urls": buckets("top_urls"),
+    # Top values only count the buckets where they made the top_k_per_bucket
+    "approximation": {"source": "rollups", "top_k_per_bucket": rollup_top_k}
+  }
@@ -0,0 +1,273 @@
+# Control flow of the routes shared by the Flask (ioa_search.py) and async (ioa_search_async.py) apps.
+#
+# A flow is a generator: it yields the backend calls it needs as (method name, *args) and gets
+# their results sent back, or their exception thrown in, then returns (JSON response, HTTP status).
+# run_flow runs it on a SearchBackend, run_flow_async on an AsyncElasticsearchBackend, so both
+# apps go through the same steps and only differ in how a call is awaited.
+from elasticsearch import NotFoundError
+from cascades import cascades_query, cascades_response
+from clusters import can_use_cluster_summaries, cluster_summaries_query, cluster_summaries_response
+from query_builder import decode_cursor
+from rollups import can_use_rollups, coverage_query, rollup_insights_response, rollup_query
+from search_params import (clusters_query, clusters_response, cursor_response, expired_cursor_error,
+                           insights_query, insights_response, msearch_error, paginated_query, search_response,
+                           with_insights_aggs)
+
+
+def run_flow(flow, backend):
+  """
+  Run a flow with a backend whose methods return their results, returns what the flow returns
+
+  Attributes:
+    flow: generator returned by one of the *_flow functions
+    backend: SearchBackend the calls are made on
+  """
+  try:
+    call = next(flow)
+    while True:
+      name, *args = call
+      try:
+        result = getattr(backend, name)(*args)
+      except Exception as e:
+        call = flow.throw(e)
+      else:
+        call = flow.send(result)
+  except StopIteration as stop:
+    return stop.value
+
+
+async def run_flow_async(flow, backend):
+  """
+  run_flow for a backend whose methods are coroutines
+
+  Attributes:
+    flow: generator returned by one of the *_flow functions
+    backend: AsyncElasticsearchBackend the calls are made on
+  """
+  try:
+    call = next(flow)
+    while True:
+      name, *args = call
+      try:
+        result = await getattr(backend, name)(*args)
+      except Exception as e:
+        call = flow.throw(e)
+      else:
+        call = flow.send(result)
+  except StopIteration as stop:
+    return stop.value
+
+
+def search_flow(args, index_name, cursors=True):
+  """
+  Answer a /search request, with page numbers or a cursor
+
+  Attributes:
+    args: request arguments (request.args)
+    index_name: relevant index name for query
+    cursors: whether the backend supports cursor pagination (Elasticsearch only)
+  """
+  cursor = args.get('cursor')
+  query_body, page, size = paginated_query(args, index_name)
+
+  if cursor is not None or args.get('paginate') == 'cursor':
+    if not cursors:
+      return {"error": "Cursor pagination needs the elasticsearch backend"}, 400
+    return (yield from cursor_search_flow(query_body, cursor, size))
+
+  results = yield ("search", query_body)
+  return search_response(results, page, size), 200
+
+
+def cursor_search_flow(query_body, cursor, size, keep_alive="5m"):
+  """
+  Run a search page with point in time + search_after pagination
+
+  400 if the cursor is malformed, 410 if it expired.
+
+  Attributes:
+    query_body: ESQueryBuilder with the filters and sort of the search
+    cursor: continuation token of the previous page, None for the first page
+    size: number of tweets per page
+    keep_alive: how long the point in time stays open between two pages
+  """
+  if cursor:
+    try:
+      pit_id, search_after = decode_cursor(cursor)
+    except ValueError as e:
+      return {"error": str(e)}, 400
+  else:
+    pit = yield ("open_point_in_time", query_body.get_index(), keep_alive)
+    pit_id, search_after = pit['id'], None
+
+  query_body.paginate_after(pit_id, search_after, size, keep_alive)
+  try:
+    results = yield ("search_index", None, query_body.get_query())
+  except NotFoundError:
+    if not cursor:
+      raise
+    # The point in time was closed or wasn't used for longer than keep_alive
+    return {"error": expired_cursor_error}, 410
+
+  response, finished_pit_id = cursor_response(results, pit_id, size)
+  if finished_pit_id is not None:
+    yield ("close_point_in_time", finished_pit_id)
+  return response, 200
+
+
+def insights_flow(args, cache, index_name, rollups=True):
+  """
+  Answer an /insights request, from the cache, the rollups or a live aggregation, 400 if sample is invalid
+
+  Attributes:
+    args: request arguments (request.args)
+    cache: ResponseCache of the insights
+    index_name: relevant index name for query
+    rollups: whether the backend has rollups (Elasticsearch only)
+  """
+  try:
+    query_body = insights_query(args, index_name)
+  except ValueError as e:
+    return {"error": str(e)}, 400
+
+  cache_key = cache.make_key(query_body.get_index(), query_body.get_query())
+  insights = cache.get(cache_key)
+  if insights is None:
+    # Read on the miss, a response computed while the cache gets cleared isn't cached
+    invalidations = cache.invalidations
+    if rollups and can_use_rollups(args):
+      insights = yield from rollup_insights_flow(args, index_name)
+    if insights is None:
+      results = yield ("search", query_body)
+      insights = insights_response(results)
+    cache.set(cache_key, insights, invalidations)
+  return insights, 200
+
+
+def rollup_insights_flow(args, index_name):
+  """
+  Answer an /insights request from the rollups built by populate_IOA.py
+
+  Returns the /insights response, None unless up to date rollups cover every dataset of the request.
+
+  Attributes:
+    args: request arguments, only filtering on dataset and dates
+    index_name: relevant index name for query
+  """
+  rollup_index, body = rollup_query(args)
+  try:
+    results = yield ("search_index", rollup_index, body)
+  except NotFoundError:
+    return None
+  coverage_results = yield ("search_index", index_name, coverage_query(args), True)
+  return rollup_insights_response(results, coverage_results)
+
+
+def clusters_flow(args, cache, index_name, summaries=True):
+  """
+  Answer a /clusters request, from the cache, the cluster summaries or a live aggregation
+
+  Attributes:
+    args: request arguments (request.args)
+    cache: ResponseCache of the insights
+    index_name: relevant index name for query
+    summaries: whether the backend has cluster summaries (Elasticsearch only)
+  """
+  query_body = clusters_query(args, index_name)
+
+  cache_key = cache.make_key(query_body.get_index(), query_body.get_query())
+  clusters = cache.get(cache_key)
+  if clusters is None:
+    # Read on the miss, a response computed while the cache gets cleared isn't cached
+    invalidations = cache.invalidations
+    if summaries and can_use_cluster_summaries(args):
+      clusters = yield from cluster_summaries_flow(args, index_name)
+    if clusters is None:
+      results = yield ("search", query_body)
+      clusters = clusters_response(results)
+    cache.set(cache_key, clusters, invalidations)
+  return clusters, 200
+
+
+def cluster_summaries_flow(args, index_name):
+  """
+  Answer a /clusters request from the cluster summaries built by populate_IOA.py
+
+  Returns the /clusters response, None unless up to date summaries cover every dataset of the request.
+
+  Attributes:
+    args: request arguments, only filtering on dataset
+    index_name: relevant index name for query
+  """
+  clusters_index, body = cluster_summaries_query(args)
+  try:
+    results = yield ("search_index", clusters_index, body)
+  except NotFoundError:
+    return None
+  coverage_results = yield ("search_index", index_name, coverage_query(args), True)
+  return cluster_summaries_response(results, coverage_results)
+
+
+def cascades_flow(args, cache):
+  """
+  Answer a /cascades request, 404 if no cascades were built
+
+  Attributes:
+    args: request arguments (request.args)
+    cache: ResponseCache of the insights
+  """
+  cascades_index, body = cascades_query(args)
+  cache_key = cache.make_key(cascades_index, body)
+  cascades = cache.get(cache_key)
+  if cascades is None:
+    # Read on the miss, a response computed while the cache gets cleared isn't cached
+    invalidations = cache.invalidations
+    try:
+      results = yield ("search_index", cascades_index, body)
+    except NotFoundError:
+      return {"error": "No cascades were built yet"}, 404
+    cascades = cascades_response(results)
+    cache.set(cache_key, cascades, invalidations)
+  return cascades, 200
+
+
+def dashboard_flow(args, cache, index_name):
+  """
+  Answer a /dashboard request: a page of tweets and the insights of the same query, 400 if sample is invalid
+
+  Attributes:
+    args: request arguments (request.args)
+    cache: ResponseCache of the insights
+    index_name: relevant index name for query
+  """
+  query_body, page, size = paginated_query(args, index_name)
+  try:
+    aggs_body = insights_query(args, index_name)
+  except ValueError as e:
+    return {"error": str(e)}, 400
+  cache_key = cache.make_key(aggs_body.get_index(), aggs_body.get_query())
+  insights = cache.get(cache_key)
+  # Read on the miss, a response computed while the cache gets cleared isn't cached
+  invalidations = cache.invalidations
+
+  if insights is not None:
+    # Insights are cached, only the hits are needed
+    results = yield ("search", query_body)
+  elif page == 1:
+    # One search returns both the first page of hits and the aggregations
+    query_body = with_insights_aggs(query_body, args)
+    results = yield ("search", query_body)
+    insights = insights_response(results)
+    cache.set(cache_key, insights, invalidations)
+  else:
+    # Deeper pages send the aggregations as their own size 0 search in the same _msearch,
+    # so they stay identical across pages and can be served from the ES request cache
+    responses = yield ("msearch", [query_body, aggs_body])
+    error = msearch_error(responses)
+    if error is not None:
+      return error
+    results = responses[0]
+    insights = insights_response(responses[1])
+    cache.set(cache_key, insights, invalidations)
+
+  return {**search_response(results, page, size), **insights}, 200
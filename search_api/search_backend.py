@@ -0,0 +1,720 @@
+import abc
+import fnmatch
+import json
+import re
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from accounts import accounts_index_name, profile_fields, top_values_size
+from query_builder import async_search_with_template, search_with_template
+from search_params import msearch_searches
+
+
+class SearchBackend(abc.ABC):
+  """
+    A store the search API runs ESQueryBuilder queries on
+
+    Backends take the query built by ESQueryBuilder and return a response
+    shaped like an Elasticsearch search response (hits, total, aggregations),
+    so the routes don't depend on where the tweets are stored.
+    """
+
+  @abc.abstractmethod
+  def search(self, query_body):
+    """
+    Run a query, returns an ES shaped search response
+
+    Attributes:
+      query_body: ESQueryBuilder to run
+    """
+
+  def msearch(self, query_bodies):
+    """
+    Run several queries, returns the list of their responses in order
+
+    Attributes:
+      query_bodies: list of ESQueryBuilder to run
+    """
+    return [self.search(query_body) for query_body in query_bodies]
+
+  @abc.abstractmethod
+  def account(self, userid):
+    """
+    Summary of an account built by populate_IOA.py, None if there is none
+
+    Attributes:
+      userid: id of the account
+    """
+
+  def generation(self):
+    """
+    Current index generation, changes every time populate_IOA.py finishes an ingest
+    """
+    return None
+
+  def close(self):
+    """
+    Release the resources held by the backend
+    """
+
+
+class ElasticsearchBackend(SearchBackend):
+  """
+    Runs queries on an Elasticsearch cluster, as stored search templates
+
+    Attributes:
+      client: Elasticsearch client
+      meta_index_name: index holding the generation counter bumped by populate_IOA.py
+    """
+
+  def __init__(self, client, meta_index_name="ioa-meta"):
+    self.client = client
+    self.meta_index_name = meta_index_name
+
+  def search(self, query_body):
+    return search_with_template(self.client, query_body)
+
+  def msearch(self, query_bodies):
+    return self.client.msearch(searches=msearch_searches(query_bodies))["responses"]
+
+  def search_index(self, index, body, request_cache=False):
+    """
+    Run a plain search body, for the indices ESQueryBuilder doesn't build queries of (rollups, cascades)
+
+    Attributes:
+      index: indices to search, None for a point in time search
+      body: ES search body
+      request_cache: serve the search from the ES request cache when possible
+    """
+    return self.client.search(index=index, body=body, **({"request_cache": True} if request_cache else {}))
+
+  def open_point_in_time(self, index, keep_alive):
+    return self.client.open_point_in_time(index=index, keep_alive=keep_alive, ignore_unavailable=True)
+
+  def close_point_in_time(self, pit_id):
+    return self.client.close_point_in_time(id=pit_id)
+
+  def account(self, userid):
+    from elasticsearch import NotFoundError
+    try:
+      return self.client.get(index=accounts_index_name, id=userid)["_source"]
+    except NotFoundError:
+      return None
+
+  def generation(self):
+    from elasticsearch import NotFoundError
+    try:
+      return self.client.get(index=self.meta_index_name, id="generation")["_source"]["generation"]
+    except NotFoundError:
+      return None
+
+
+class AsyncElasticsearchBackend:
+  """
+    ElasticsearchBackend for an AsyncElasticsearch client, the same methods as coroutines
+
+    Attributes:
+      client: AsyncElasticsearch client
+      meta_index_name: index holding the generation counter bumped by populate_IOA.py
+    """
+
+  def __init__(self, client, meta_index_name="ioa-meta"):
+    self.client = client
+    self.meta_index_name = meta_index_name
+
+  async def search(self, query_body):
+    return await async_search_with_template(self.client, query_body)
+
+  async def msearch(self, query_bodies):
+    return (await self.client.msearch(searches=msearch_searches(query_bodies)))["responses"]
+
+  async def search_index(self, index, body, request_cache=False):
+    return await self.client.search(index=index, body=body, **({"request_cache": True} if request_cache else {}))
+
+  async def open_point_in_time(self, index, keep_alive):
+    return await self.client.open_point_in_time(index=index, keep_alive=keep_alive, ignore_unavailable=True)
+
+  async def close_point_in_time(self, pit_id):
+    return await self.client.close_point_in_time(id=pit_id)
+
+  async def account(self, userid):
+    from elasticsearch import NotFoundError
+    try:
+      return (await self.client.get(index=accounts_index_name, id=userid))["_source"]
+    except NotFoundError:
+      return None
+
+  async def generation(self):
+    from elasticsearch import NotFoundError
+    try:
+      return (await self.client.get(index=self.meta_index_name, id="generation"))["_source"]["generation"]
+    except NotFoundError:
+      return None
+
+
+class SQLiteBackend(SearchBackend):
+  """
+    Runs queries on a local SQLite database with an FTS5 full text index, for single box deployments
+
+    Tweets are stored as JSON next to the columns filters, sorts and
+    aggregations run on. List columns (hashtags, urls, user_mentions) get one
+    row per value in tweet_terms. The ES query body built by ESQueryBuilder
+    is translated to SQL: multi_match becomes an FTS5 match ranked with
+    bm25 (terms are ORed, fuzziness is ignored), term and range filters,
+    sorts, from/size, _source filtering and the terms (with sub-aggregations),
+    date_histogram, cardinality, top_hits and random_sampler (run on every
+    tweet) aggregations.
+
+    Attributes:
+      path: path of the SQLite database, created if missing
+    """
+
+  # Columns stored next to the JSON document, any other field is read from the JSON
+  columns = {
+    "tweetid": "TEXT UNIQUE",
+    "userid": "TEXT",
+    "user_screen_name": "TEXT",
+    "tweet_language": "TEXT",
+    "tweet_time": "TEXT",
+    "is_retweet": "INTEGER",
+    "retweet_tweetid": "TEXT",
+    "like_count": "INTEGER",
+    "retweet_count": "INTEGER",
+    "reply_count": "INTEGER",
+    "quote_count": "INTEGER",
+    "dataset": "TEXT",
+    "file_name": "TEXT",
+    "cluster_id": "TEXT"
+  }
+  list_columns = ("hashtags", "urls", "user_mentions")
+  text_columns = ("tweet_text", "user_screen_name", "hashtags")
+
+  def __init__(self, path):
+    self.path = path
+    self.local = threading.local()
+    self.write_lock = threading.Lock()
+    with self.connection() as connection:
+      column_definitions = ", ".join(f"{name} {kind}" for name, kind in self.columns.items())
+      connection.executescript(f"""
+        CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, {column_definitions}, source TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS tweets_userid ON tweets (userid);
+        CREATE INDEX IF NOT EXISTS tweets_language ON tweets (tweet_language);
+        CREATE INDEX IF NOT EXISTS tweets_time ON tweets (tweet_time);
+        CREATE INDEX IF NOT EXISTS tweets_dataset ON tweets (dataset);
+        CREATE TABLE IF NOT EXISTS tweet_terms (tweet INTEGER NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS tweet_terms_value ON tweet_terms (field, value, tweet);
+        CREATE INDEX IF NOT EXISTS tweet_terms_tweet ON tweet_terms (tweet);
+        CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5({", ".join(self.text_columns)});
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE TABLE IF NOT EXISTS accounts (userid TEXT PRIMARY KEY, source TEXT NOT NULL);
+      """)
+      # Databases created by an older version miss the columns added since
+      existing = {row[1] for row in connection.execute("PRAGMA table_info(tweets)")}
+      for name, kind in self.columns.items():
+        if name not in existing:
+          connection.execute(f"ALTER TABLE tweets ADD COLUMN {name} {kind.replace(' UNIQUE', '')}")
+      connection.execute("CREATE INDEX IF NOT EXISTS tweets_cluster ON tweets (cluster_id)")
+
+  def connection(self):
+    """
+    SQLite connection of the current thread, WAL mode lets threads read while another one writes
+    """
+    connection = getattr(self.local, "connection", None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, check_same_thread=False)
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute("PRAGMA synchronous=NORMAL")
+      self.local.connection = connection
+    return connection
+
+  def index_documents(self, docs):
+    """
+    Insert or replace a batch of tweets, documents with the tweetid of a stored tweet replace it
+
+    Attributes:
+      docs: list of tweet dicts, as indexed into ES by populate_IOA.py
+    """
+    connection = self.connection()
+    with self.write_lock, connection:
+      tweetids = [doc["tweetid"] for doc in docs if doc.get("tweetid")]
+      for start in range(0, len(tweetids), 500):
+        chunk = tweetids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        ids = [row[0] for row in connection.execute(
+          f"SELECT id FROM tweets WHERE tweetid IN ({placeholders})", chunk)]
+        if ids:
+          id_placeholders = ",".join("?" * len(ids))
+          connection.execute(f"DELETE FROM tweet_terms WHERE tweet IN ({id_placeholders})", ids)
+          connection.execute(f"DELETE FROM tweets_fts WHERE rowid IN ({id_placeholders})", ids)
+          connection.execute(f"DELETE FROM tweets WHERE id IN ({id_placeholders})", ids)
+
+      insert = (f"INSERT INTO tweets ({', '.join(self.columns)}, source) "
+                f"VALUES ({', '.join('?' * (len(self.columns) + 1))})")
+      terms = []
+      texts = []
+      for doc in docs:
+        values = [doc.get(column) for column in self.columns]
+        tweet = connection.execute(insert, values + [json.dumps(doc, ensure_ascii=False)]).lastrowid
+        for field in self.list_columns:
+          for value in doc.get(field) or []:
+            terms.append((tweet, field, str(value)))
+        texts.append((tweet, doc.get("tweet_text") or "", doc.get("user_screen_name") or "",
+                      " ".join(str(value) for value in doc.get("hashtags") or [])))
+      connection.executemany("INSERT INTO tweet_terms (tweet, field, value) VALUES (?, ?, ?)", terms)
+      connection.executemany(
+        f"INSERT INTO tweets_fts (rowid, {', '.join(self.text_columns)}) VALUES (?, ?, ?, ?)", texts)
+
+  def build_accounts(self, datasets, batch_size=500):
+    """
+    Rebuild the summaries of the accounts with tweets in the given datasets, from every tweet they posted
+
+    Summaries have the same fields as the ioa-accounts documents built for Elasticsearch.
+
+    Attributes:
+      datasets: datasets indexed since the summaries were last built
+      batch_size: number of accounts summarized per query
+
+    Returns:
+      number of accounts summarized
+    """
+    connection = self.connection()
+    datasets = sorted(datasets)
+    placeholders = ",".join("?" * len(datasets))
+    userids = [row[0] for row in connection.execute(
+      f"SELECT DISTINCT userid FROM tweets WHERE dataset IN ({placeholders}) AND userid IS NOT NULL", datasets)]
+    updated_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+    for start in range(0, len(userids), batch_size):
+      batch = userids[start:start + batch_size]
+      placeholders = ",".join("?" * len(batch))
+      accounts = {}
+      for userid, first, last, count, retweets in connection.execute(
+          f"SELECT userid, MIN(tweet_time), MAX(tweet_time), COUNT(*), SUM(is_retweet = 1) FROM tweets "
+          f"WHERE userid IN ({placeholders}) GROUP BY userid", batch):
+        accounts[userid] = {"userid": userid, "first_tweet_time": first, "last_tweet_time": last,
+                            "tweet_count": count, "retweet_tweet_count": retweets or 0,
+                            "top_hashtags": [], "languages": [], "datasets": []}
+
+      # Profile fields of the latest tweet of each account
+      for userid, source in connection.execute(
+          f"SELECT userid, source FROM (SELECT userid, source, ROW_NUMBER() OVER (PARTITION BY userid "
+          f"ORDER BY tweet_time IS NULL, tweet_time DESC, id DESC) AS position FROM tweets "
+          f"WHERE userid IN ({placeholders})) WHERE position = 1", batch):
+        profile = json.loads(source)
+        accounts[userid].update({field: profile.get(field) for field in profile_fields})
+
+      top_values = (
+        ("top_hashtags", "SELECT t.userid, tt.value, COUNT(*) AS doc_count FROM tweet_terms tt "
+                         "JOIN tweets t ON t.id = tt.tweet WHERE tt.field = 'hashtags' AND t.userid IN ({}) "
+                         "GROUP BY t.userid, tt.value"),
+        ("languages", "SELECT userid, tweet_language, COUNT(*) AS doc_count FROM tweets "
+                      "WHERE userid IN ({}) AND tweet_language IS NOT NULL GROUP BY userid, tweet_language"),
+        ("datasets", "SELECT userid, dataset, COUNT(*) AS doc_count FROM tweets "
+                     "WHERE userid IN ({}) AND dataset IS NOT NULL GROUP BY userid, dataset")
+      )
+      for field, sql in top_values:
+        for userid, value, doc_count in connection.execute(
+            f"SELECT * FROM ({sql.format(placeholders)}) ORDER BY doc_count DESC, 2 ASC", batch):
+          values = accounts[userid][field]
+          if field == "datasets":
+            values.append(value)
+          elif len(values) < top_values_size:
+            values.append({"key": value, "doc_count": doc_count})
+
+      with self.write_lock, connection:
+        connection.executemany(
+          "INSERT OR REPLACE INTO accounts (userid, source) VALUES (?, ?)",
+          [(userid, json.dumps({**account, "updated_at": updated_at}, ensure_ascii=False))
+           for userid, account in accounts.items()])
+    return len(userids)
+
+  def backfill_cluster_leaders(self, datasets):
+    """
+    Set the cluster_id of the leaders of the near-duplicate clusters of the given datasets
+
+    ClusterAssigner leaves the first tweet of a cluster without a cluster_id,
+    since no copy joined it yet when it is indexed: the tweets whose tweetid
+    became the cluster_id of other tweets get their own.
+
+    Attributes:
+      datasets: datasets indexed since the leaders were last back-filled
+
+    Returns:
+      number of leaders updated
+    """
+    connection = self.connection()
+    datasets = sorted(datasets)
+    placeholders = ",".join("?" * len(datasets))
+    with self.write_lock, connection:
+      return connection.execute(
+        f"UPDATE tweets SET cluster_id = tweetid, source = json_set(source, '$.cluster_id', tweetid) "
+        f"WHERE cluster_id IS NULL AND dataset IN ({placeholders}) AND tweetid IN "
+        f"(SELECT cluster_id FROM tweets WHERE dataset IN ({placeholders}) AND cluster_id IS NOT NULL)",
+        datasets + datasets).rowcount
+
+  def account(self, userid):
+    row = self.connection().execute("SELECT source FROM accounts WHERE userid = ?", (userid,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def bump_generation(self):
+    """
+    Increment the generation counter, so the search API knows its cached responses are stale
+    """
+    connection = self.connection()
+    with self.write_lock, connection:
+      connection.execute("INSERT INTO meta (key, value) VALUES ('generation', 1) "
+                         "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+  def generation(self):
+    row = self.connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    return row[0] if row else None
+
+  def close(self):
+    connection = getattr(self.local, "connection", None)
+    if connection is not None:
+      connection.close()
+      self.local.connection = None
+
+  def search(self, query_body):
+    body = query_body.get_query() if hasattr(query_body, "get_query") else query_body
+    if "pit" in body:
+      raise ValueError("Point in time searches aren't supported by the SQLite backend")
+    started = time.perf_counter()
+    connection = self.connection()
+
+    text_query, where, params = self._where(body.get("query", {}))
+    if text_query is None:
+      # Nothing to search for (ex: the query is only punctuation), nothing matches
+      where, params = ["0"], []
+      text_query = False
+    source_table = "tweets t JOIN tweets_fts ON tweets_fts.rowid = t.id" if text_query else "tweets t"
+    matched = f"SELECT t.id AS id FROM {source_table} WHERE {' AND '.join(where) or '1'}"
+
+    hits = []
+    size = body.get("size", 10)
+    if size:
+      sort, sort_values = self._sort(body.get("sort"), text_query)
+      score = "-bm25(tweets_fts)" if text_query else "0.0"
+      rows = connection.execute(
+        f"SELECT t.tweetid, t.id, t.source, {score}{sort_values} FROM {source_table} "
+        f"WHERE {' AND '.join(where) or '1'} ORDER BY {sort} LIMIT ? OFFSET ?",
+        params + [size, body.get("from", 0)]
+      ).fetchall()
+      for tweetid, rowid, source, hit_score, *values in rows:
+        hit = {
+          "_index": "local",
+          "_id": tweetid or str(rowid),
+          "_score": hit_score,
+          "_source": self._filter_source(json.loads(source), body.get("_source"))
+        }
+        if body.get("sort"):
+          hit["sort"] = values
+        hits.append(hit)
+
+    response = {"timed_out": False, "hits": {"hits": hits, "max_score": None}}
+    if body.get("track_total_hits", True) is not False:
+      total = connection.execute(f"SELECT COUNT(*) FROM ({matched})", params).fetchone()[0]
+      response["hits"]["total"] = {"value": total, "relation": "eq"}
+    if body.get("aggs"):
+      response["aggregations"] = self._aggregations(connection, body["aggs"], matched, params)
+    response["took"] = int((time.perf_counter() - started) * 1000)
+    return response
+
+  def _where(self, query):
+    """
+    Translate a bool query to (text query, SQL conditions, params)
+
+    The text query is an FTS5 expression, False without multi_match, None
+    when the multi_match query has no term to search for.
+    """
+    bool_query = query.get("bool", {})
+    text_query = False
+    where = []
+    params = []
+    for clause in bool_query.get("must", []):
+      if "multi_match" not in clause:
+        raise ValueError(f"Unsupported query clause for the SQLite backend: {clause}")
+      match = clause["multi_match"]
+      terms = re.findall(r"\w+", match["query"])
+      if not terms:
+        return None, [], []
+      columns = [column for column in match.get("fields", []) if column in self.text_columns] or self.text_columns
+      expression = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+      text_query = f"{{{' '.join(columns)}}} : ({expression})"
+      where.append("tweets_fts MATCH ?")
+      params.append(text_query)
+
+    for clause in bool_query.get("filter", []):
+      self._filter(clause, where, params)
+    return text_query, where, params
+
+  def _filter(self, clause, where, params):
+    """
+    Translate a filter clause, adding its SQL conditions and params to where and params
+    """
+    if "term" in clause:
+      (field, value), = clause["term"].items()
+      if field in self.list_columns:
+        where.append("EXISTS (SELECT 1 FROM tweet_terms WHERE tweet = t.id AND field = ? AND value = ?)")
+        params += [field, str(value)]
+      else:
+        where.append(f"{self._column(field)} = ?")
+        params.append(value)
+    elif "bool" in clause and set(clause["bool"]) == {"filter"}:
+      for nested in clause["bool"]["filter"]:
+        self._filter(nested, where, params)
+    elif "range" in clause:
+      (field, bounds), = clause["range"].items()
+      operators = {"gte": ">=", "gt": ">", "lte": "<=", "lt": "<"}
+      for bound, value in bounds.items():
+        operator = operators[bound]
+        date_only = isinstance(value, str) and re.fullmatch(r"[0-9]{4}-[0-9]{2}-[0-9]{2}", value)
+        if bound in ("lte", "gt") and date_only:
+          # Like ES, a date-only upper bound covers its whole day: <= day is < next day, > day is >= next day
+          value = (datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+          operator = "<" if bound == "lte" else ">="
+        where.append(f"{self._column(field)} {operator} ?")
+        params.append(value)
+    else:
+      raise ValueError(f"Unsupported filter for the SQLite backend: {clause}")
+
+  def _column(self, field):
+    """
+    SQL expression of a field, a stored column or a value read from the JSON document
+    """
+    if field in self.columns:
+      return f"t.{field}"
+    if not re.fullmatch(r"\w+", field):
+      raise ValueError(f"Invalid field name: {field}")
+    return f"json_extract(t.source, '$.{field}')"
+
+  def _sort(self, sort, text_query):
+    """
+    Translate an ES sort to (ORDER BY clause, extra selected columns holding the sort values)
+    """
+    if not sort:
+      return ("bm25(tweets_fts), t.id" if text_query else "t.id"), ""
+    order = []
+    values = []
+    for clause in sort:
+      (field, options), = clause.items()
+      direction = "ASC" if options.get("order", "desc") == "asc" else "DESC"
+      if field == "_score":
+        expression = "-bm25(tweets_fts)" if text_query else "0.0"
+      else:
+        expression = self._column(field)
+        # ES puts tweets missing the field last
+        order.append(f"{expression} IS NULL")
+      order.append(f"{expression} {direction}")
+      values.append(expression)
+    order.append("t.id")
+    return ", ".join(order), "".join(f", {value}" for value in values)
+
+  @staticmethod
+  def _filter_source(source, source_filter):
+    """
+    Apply an ES _source filter (includes/excludes, wildcards allowed) to a document
+    """
+    if not source_filter:
+      return source
+    includes = source_filter.get("includes")
+    excludes = source_filter.get("excludes") or []
+    return {
+      key: value for key, value in source.items()
+      if (not includes or any(fnmatch.fnmatchcase(key, pattern) for pattern in includes))
+      and not any(fnmatch.fnmatchcase(key, pattern) for pattern in excludes)
+    }
+
+  def _aggregations(self, connection, aggs, matched, params):
+    """
+    Compute the aggregations of a query on the tweets it matches
+    """
+    results = {}
+    for agg_name, agg in aggs.items():
+      if "terms" in agg:
+        results[agg_name] = self._terms(connection, agg["terms"], matched, params, agg.get("aggs"))
+      elif "date_histogram" in agg:
+        results[agg_name] = self._date_histogram(connection, agg["date_histogram"], matched, params)
+      elif "cardinality" in agg:
+        field = agg["cardinality"]["field"]
+        if field in self.list_columns:
+          sql = (f"SELECT COUNT(DISTINCT value) FROM tweet_terms "
+                 f"WHERE field = ? AND tweet IN ({matched})")
+          value = connection.execute(sql, [field] + params).fetchone()[0]
+        else:
+          sql = f"SELECT COUNT(DISTINCT {self._column(field)}) FROM tweets t WHERE t.id IN ({matched})"
+          value = connection.execute(sql, params).fetchone()[0]
+        results[agg_name] = {"value": value}
+      elif "top_hits" in agg:
+        top_hits = agg["top_hits"]
+        sort, _ = self._sort(top_hits.get("sort"), False)
+        rows = connection.execute(
+          f"SELECT t.tweetid, t.id, t.source FROM tweets t WHERE t.id IN ({matched}) ORDER BY {sort} LIMIT ?",
+          params + [top_hits.get("size", 3)]
+        ).fetchall()
+        hits = [
+          {"_index": "local", "_id": tweetid or str(rowid),
+           "_source": self._filter_source(json.loads(source), top_hits.get("_source"))}
+          for tweetid, rowid, source in rows
+        ]
+        results[agg_name] = {"hits": {"hits": hits}}
+      elif "random_sampler" in agg:
+        # Local searches are fast enough to aggregate every tweet, the sample is the whole set
+        count = connection.execute(f"SELECT COUNT(*) FROM ({matched})", params).fetchone()[0]
+        results[agg_name] = {
+          "doc_count": count,
+          "probability": 1,
+          "seed": agg["random_sampler"].get("seed"),
+          **self._aggregations(connection, agg.get("aggs", {}), matched, params)
+        }
+      else:
+        raise ValueError(f"Unsupported aggregation for the SQLite backend: {agg}")
+    return results
+
+  def _terms(self, connection, terms, matched, params, sub_aggs=None):
+    """
+    ES terms aggregation: most frequent values ordered by count, ties by value
+    """
+    field = terms["field"]
+    if field in self.list_columns:
+      source = f"SELECT value FROM tweet_terms WHERE field = ? AND tweet IN ({matched})"
+      source_params = [field] + params
+    else:
+      source = (f"SELECT {self._column(field)} AS value FROM tweets t "
+                f"WHERE t.id IN ({matched}) AND {self._column(field)} IS NOT NULL")
+      source_params = params
+    # min_doc_count is applied outside the window, so the total still counts the values left out
+    rows = connection.execute(
+      f"SELECT value, doc_count, total FROM (SELECT value, COUNT(*) AS doc_count, SUM(COUNT(*)) OVER () AS total "
+      f"FROM ({source}) GROUP BY value) WHERE doc_count >= ? ORDER BY doc_count DESC, value ASC LIMIT ?",
+      source_params + [terms.get("min_doc_count", 1), terms.get("size", 10)]
+    ).fetchall()
+    total = rows[0][2] if rows else 0
+    buckets = [{"key": value, "doc_count": doc_count} for value, doc_count, _ in rows]
+    if sub_aggs:
+      # Sub-aggregations run on the matched tweets holding the bucket value
+      if field in self.list_columns:
+        bucket_matched = (f"SELECT t.id FROM tweets t WHERE t.id IN ({matched}) AND EXISTS "
+                          f"(SELECT 1 FROM tweet_terms WHERE tweet = t.id AND field = ? AND value = ?)")
+      else:
+        bucket_matched = f"SELECT t.id FROM tweets t WHERE t.id IN ({matched}) AND {self._column(field)} = ?"
+      for bucket in buckets:
+        bucket_params = params + ([field, bucket["key"]] if field in self.list_columns else [bucket["key"]])
+        bucket.update(self._aggregations(connection, sub_aggs, bucket_matched, bucket_params))
+    return {
+      "doc_count_error_upper_bound": 0,
+      "sum_other_doc_count": total - sum(bucket["doc_count"] for bucket in buckets),
+      "buckets": buckets
+    }
+
+  # Start of the calendar bucket of an ISO 8601 time, per date_histogram interval
+  bucket_starts = {
+    "year": "substr({0}, 1, 4) || '-01-01'",
+    "quarter": "substr({0}, 1, 5) || printf('%02d', (CAST(substr({0}, 6, 2) AS INTEGER) - 1) / 3 * 3 + 1) || '-01'",
+    "month": "substr({0}, 1, 7) || '-01'",
+    "week": "date({0}, 'weekday 0', '-6 days')",
+    "day": "substr({0}, 1, 10)"
+  }
+  interval_names = {"1y": "year", "1q": "quarter", "1M": "month", "1w": "week", "1d": "day"}
+
+  def _date_histogram(self, connection, histogram, matched, params):
+    """
+    ES date_histogram aggregation with a calendar_interval, empty buckets between the first and last included
+    """
+    interval = histogram.get("calendar_interval", "year")
+    interval = self.interval_names.get(interval, interval)
+    if interval not in self.bucket_starts:
+      raise ValueError(f"Unsupported histogram interval for the SQLite backend: {interval}")
+    column = self._column(histogram["field"])
+    bucket_start = self.bucket_starts[interval].format(column)
+    rows = connection.execute(
+      f"SELECT {bucket_start} AS bucket, COUNT(*) FROM tweets t "
+      f"WHERE t.id IN ({matched}) AND {column} IS NOT NULL GROUP BY bucket ORDER BY bucket",
+      params
+    ).fetchall()
+    counts = dict(rows)
+
+    buckets = []
+    if rows:
+      start = datetime.strptime(rows[0][0], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+      last = datetime.strptime(rows[-1][0], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+      while start <= last:
+        day = start.strftime("%Y-%m-%d")
+        buckets.append({
+          "key_as_string": start.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+          "key": int(start.timestamp() * 1000),
+          "doc_count": counts.get(day, 0)
+        })
+        start = _next_bucket(start, interval)
+    return {"buckets": buckets}
+
+
+def _next_bucket(start, interval):
+  """
+  Start of the calendar bucket following the one starting at start
+  """
+  if interval == "day":
+    return start + timedelta(days=1)
+  if interval == "week":
+    return start + timedelta(weeks=1)
+  months = {"month": 1, "quarter": 3, "year": 12}[interval]
+  month = start.month - 1 + months
+  return start.replace(year=start.year + month // 12, month=month % 12 + 1)
+
+
+def _benchmark(backends, queries, repeat=20):
+  """
+  Time the same queries on several backends and print their median and 95th percentile latency
+
+  Attributes:
+    backends: dict of backend name to SearchBackend
+    queries: dict of query name to function returning a new ESQueryBuilder
+    repeat: number of runs of each query per backend
+  """
+  for query_name, build_query in queries.items():
+    for backend_name, backend in backends.items():
+      backend.search(build_query())
+      timings = []
+      for _ in range(repeat):
+        started = time.perf_counter()
+        backend.search(build_query())
+        timings.append((time.perf_counter() - started) * 1000)
+      timings.sort()
+      p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+      print(f"{query_name:<24} {backend_name:<14} median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+
+
+if __name__ == "__main__":
+  # Latency of the SQLite backend against ES on the same data, the database being built by
+  # populate_IOA.py with search_backend = "sqlite" from the same datasets as the ES index:
+  #   python search_backend.py ../ioa_local.sqlite [query text]
+  # ES is only benchmarked when ES_HOST is set, as for the search API
+  import os
+  from dotenv import load_dotenv
+  from werkzeug.datastructures import MultiDict
+  from search_params import insights_query, paginated_query
+
+  load_dotenv()
+  text = sys.argv[2] if len(sys.argv) > 2 else "news"
+  backends = {"sqlite": SQLiteBackend(sys.argv[1] if len(sys.argv) > 1 else "../ioa_local.sqlite")}
+  if os.getenv("ES_HOST"):
+    from elasticsearch import Elasticsearch
+    client = Elasticsearch([f'https://{os.getenv("ES_HOST")}:{os.getenv("ES_PORT")}'],
+                           basic_auth=(os.getenv("ES_USER"), os.getenv("ES_PASSWORD")),
+                           verify_certs=False)
+    backends["elasticsearch"] = ElasticsearchBackend(client)
+
+  queries = {
+    "search": MultiDict([("query", text)]),
+    "search sorted by likes": MultiDict([("query", text), ("sort_by", "likes")]),
+    "search filtered": MultiDict([("query", text), ("language", "en"), ("from", "2019-01-01")]),
+    "latest tweets": MultiDict([("sort_by", "time")]),
+  }
+  _benchmark(backends, {
+    **{name: (lambda args=args: paginated_query(args, "ioa-tweets")[0]) for name, args in queries.items()},
+    "insights": lambda: insights_query(MultiDict(), "ioa-tweets"),
+    "insights filtered": lambda: insights_query(MultiDict([("query", text), ("interval", "month")]), "ioa-tweets"),
+  })
@@ -0,0 +1,393 @@
+import math
+import os
+from graph_store import edge_kinds
+from query_builder import ESQueryBuilder, encode_cursor
+
+# Read alias of the tweet indices
+index_name = 'ioa-tweets'
+
+# Index holding the generation counter bumped by populate_IOA.py after every ingest
+meta_index_name = 'ioa-meta'
+
+# Error of a cursor whose point in time is gone
+expired_cursor_error = "The cursor expired, start again from the first page"
+
+# Fields left out of /search hits unless asked for with fields=, the results list doesn't show them
+hidden_fields = ["user_profile_description", "user_display_name"]
+
+# Fast insights (mode=fast): share of the matching tweets aggregated by default, and the
+# precision threshold of the unique users/hashtags/urls counts
+default_sample_probability = 0.1
+cardinality_precision_threshold = 3000
+
+
+def partition_by_year():
+  """
+  Whether the tweets are split into yearly indices (index_name-YYYY) read through the index_name alias
+
+  Read from the PARTITION_BY_YEAR environment variable, which populate_IOA.py
+  reads too when it creates the indices, so both sides agree.
+  """
+  return os.getenv("PARTITION_BY_YEAR", "true").lower() != "false"
+
+
+def filtered_query(args, index_name):
+  """
+  Build an ESQueryBuilder with the search query and filters sent as request arguments
+
+  Shared by the Flask and async apps so both read the same arguments.
+
+  Attributes:
+    args: request arguments (request.args)
+    index_name: relevant index name for query
+  """
+  query = args.get('query', '')
+
+  from_date = args.get('from')
+  to_date = args.get('to')
+  tweet_language = args.get('language')
+  hashtags = args.getlist('hashtags')
+  user = args.get('user')
+  dataset = args.get('dataset')
+
+  query_body = ESQueryBuilder(index_name, partitioned=partition_by_year())
+
+  return (
+    query_body
+    .add_query(query)
+    .filter_user(user)
+    .filter_language(tweet_language)
+    .filter_date(to_date, from_date)
+    .filter_hashtags(hashtags)
+    .filter_dataset(dataset)
+  )
+
+
+def paginated_query(args, index_name):
+  """
+  Build the query of a /search request, returns (query_body, page, size)
+
+  Attributes:
+    args: request arguments (request.args)
+    index_name: relevant index name for query
+  """
+  page = int(args.get('page', 1))  # Default to page 1
+  size = int(args.get('size', 10))  # Default page size is 10
+  from_index = (page - 1) * size # Calculate 'from' for pagination
+  sort_param = args.get('sort_by')
+  fields = [field for value in args.getlist('fields') for field in value.split(',') if field]
+
+  query_body = (
+    filtered_query(args, index_name)
+    .paginate(from_index, size)
+    .sort_by(sort_param)
+    .source(includes=fields, excludes=None if fields else hidden_fields)
+  )
+  return query_body, page, size
+
+
+def insights_query(args, index_name):
+  """
+  Build the aggregation query of an /insights request
+
+  Attributes:
+    args: request arguments (request.args)
+    index_name: relevant index name for query
+  """
+  query_body = (
+    filtered_query(args, index_name)
+    .aggregations_only()
+    .track_total_hits(False)
+  )
+  return with_insights_aggs(query_body, args)
+
+
+def with_insights_aggs(query_body, args):
+  """
+  Add the /insights aggregations to a query, used to get hits and insights in one request
+
+  Attributes:
+    query_body: ESQueryBuilder to add the aggregations to
+    args: request arguments (request.args)
+  """
+  interval = args.get('interval')
+
+  query_body = (
+    query_body
+    .agg_users()
+    .agg_hashtags()
+    .agg_urls()
+    .agg_histogram(interval=interval)
+  )
+  if args.get('mode') == 'fast':
+    # Top values and histogram on a random sample, unique counts with HyperLogLog on every tweet
+    query_body = (
+      query_body
+      .sample_aggs(sample_probability(args))
+      .agg_cardinality("userid", "unique_users", cardinality_precision_threshold)
+      .agg_cardinality("hashtags", "unique_hashtags", cardinality_precision_threshold)
+      .agg_cardinality("urls", "unique_urls", cardinality_precision_threshold)
+    )
+  return query_body
+
+
+def sample_probability(args):
+  """
+  Sampling probability of a fast insights request, from the sample argument
+
+  random_sampler only accepts probabilities up to 0.5, or 1 to disable sampling.
+  Raises ValueError if sample isn't a finite number.
+
+  Attributes:
+    args: request arguments (request.args)
+  """
+  sample = args.get('sample', default_sample_probability)
+  try:
+    probability = float(sample)
+  except (TypeError, ValueError):
+    probability = math.nan
+  if not math.isfinite(probability):
+    raise ValueError(f"sample must be a number, got {sample}")
+  if probability >= 1:
+    return 1
+  return min(max(probability, 0.0001), 0.5)
+
+
+def insights_response(results):
+  """
+  Extract the /insights response from the ES results of insights_query
+
+  Attributes:
+    results: ES search response
+  """
+  aggregations = results['aggregations']
+  if 'sample' in aggregations:
+    return fast_insights_response(aggregations)
+
+  return {
+    "tweets_over_time": aggregations['tweets_over_time']['buckets'],
+    "top_users": aggregations['top_users']['buckets'],
+    "top_hashtags": aggregations['top_hashtags']['buckets'],
+    "top_urls": aggregations['top_urls']['buckets']
+  }
+
+
+def fast_insights_response(aggregations):
+  """
+  Build the /insights response of a fast (sampled) request, with estimates of its error
+
+  The relative error of a count is the standard error of an estimate from
+  a Bernoulli sample, sqrt((1 - p) / (p * count)). The one reported for each
+  aggregation is the worst over its buckets, that is the one of the smallest count.
+
+  Attributes:
+    aggregations: aggregations of the ES search response
+  """
+  sample = aggregations['sample']
+  probability = sample.get('probability', 1)
+
+  def relative_error(buckets):
+    counts = [bucket['doc_count'] for bucket in buckets if bucket['doc_count']]
+    if not counts or probability >= 1:
+      return 0.0
+    return math.sqrt((1 - probability) / (probability * min(counts)))
+
+  insights = {
+    "tweets_over_time": sample['tweets_over_time']['buckets'],
+    "top_users": sample['top_users']['buckets'],
+    "top_hashtags": sample['top_hashtags']['buckets'],
+    "top_urls": sample['top_urls']['buckets'],
+    "unique_users": aggregations['unique_users']['value'],
+    "unique_hashtags": aggregations['unique_hashtags']['value'],
+    "unique_urls": aggregations['unique_urls']['value']
+  }
+  insights["approximation"] = {
+    "mode": "fast",
+    "sample_probability": probability,
+    "sampled_tweets": sample['doc_count'],
+    "relative_error": {
+      agg_name: relative_error(insights[agg_name])
+      for agg_name in ("tweets_over_time", "top_users", "top_hashtags", "top_urls")
+    },
+    "doc_count_error_upper_bound": {
+      agg_name: sample[agg_name].get('doc_count_error_upper_bound', 0)
+      for agg_name in ("top_users", "top_hashtags", "top_urls")
+    },
+    # Unique counts are close to exact up to the threshold, HyperLogLog estimates above it
+    "cardinality_precision_threshold": cardinality_precision_threshold,
+    "cardinality_exact": {
+      agg_name: insights[agg_name] <= cardinality_precision_threshold
+      for agg_name in ("unique_users", "unique_hashtags", "unique_urls")
+    }
+  }
+  return insights
+
+
+def clusters_query(args, index_name):
+  """
+  Build the aggregation query of a /clusters request
+
+  Attributes:
+    args: request arguments (request.args)
+    index_name: relevant index name for query
+  """
+  size = min(int(args.get('size', 10)), 100)
+  min_size = max(int(args.get('min_size', 2)), 1)
+  return (
+    filtered_query(args, index_name)
+    .aggregations_only()
+    .track_total_hits(False)
+    .agg_clusters(size=size, min_doc_count=min_size)
+  )
+
+
+def clusters_response(results):
+  """
+  Extract the /clusters response from the ES results of clusters_query
+
+  Attributes:
+    results: ES search response
+  """
+  clusters = []
+  for bucket in results['aggregations']['top_clusters']['buckets']:
+    hits = bucket['first_tweet']['hits']['hits']
+    clusters.append({
+      "cluster_id": bucket['key'],
+      "size": bucket['doc_count'],
+      "accounts": bucket['accounts']['value'],
+      "first_tweet": hits[0]['_source'] if hits else None
+    })
+  return {"clusters": clusters}
+
+
+def network_response(graph, args):
+  """
+  Build the /network response of a dataset from its interaction graph
+
+  Attributes:
+    graph: InteractionGraph of the dataset
+    args: request arguments (request.args)
+  """
+  kinds = [kind for value in args.getlist('kinds') for kind in value.split(',') if kind]
+  unknown = [kind for kind in kinds if kind not in edge_kinds]
+  if unknown:
+    raise ValueError(f"Unknown edge kinds: {', '.join(unknown)}")
+  size = min(int(args.get('size', 10)), 100)
+
+  response = {
+    "dataset": args.get('dataset'),
+    # Accounts retweeting the most, and the most retweeted ones, unless other kinds are asked for
+    "amplifiers": graph.top_accounts(size, kinds or ["retweet"], direction="out"),
+    "amplified": graph.top_accounts(size, kinds or ["retweet"], direction="in")
+  }
+  if args.get('user'):
+    direction = args.get('direction', 'both')
+    if direction not in ("out", "in", "both"):
+      raise ValueError(f"Unknown direction: {direction}")
+    response["neighborhood"] = graph.neighborhood(
+      args.get('user'),
+      hops=min(max(int(args.get('hops', 1)), 1), 3),
+      kinds=kinds or edge_kinds,
+      direction=direction,
+      max_nodes=min(int(args.get('max_nodes', 500)), 5000)
+    )
+  return response
+
+
+def network_result(graph_store, args):
+  """
+  Answer a /network request, returns (JSON response, HTTP status)
+
+  Attributes:
+    graph_store: GraphStore the interaction graphs are read from
+    args: request arguments (request.args)
+  """
+  dataset = args.get('dataset')
+  if not dataset:
+    return {"error": "dataset is required"}, 400
+  graph = graph_store.get(dataset)
+  if graph is None:
+    return {"error": f"No interaction graph for dataset: {dataset}"}, 404
+  try:
+    network = network_response(graph, args)
+  except ValueError as e:
+    return {"error": str(e)}, 400
+  if network.get("neighborhood", {}) is None:
+    return {"error": f"Unknown account: {args.get('user')}"}, 404
+  return network, 200
+
+
+def cursor_response(results, pit_id, size):
+  """
+  Build the response of a cursor paginated /search page, returns (response, id of the point in time to close)
+
+  The point in time is kept open while there may be more pages, the id to
+  close is None then.
+
+  Attributes:
+    results: ES search response of the page
+    pit_id: id of the point in time the page was searched on
+    size: number of tweets per page
+  """
+  hits = results['hits']['hits']
+  # ES may return a new id for the same point in time
+  pit_id = results.get('pit_id', pit_id)
+  next_cursor = None
+  if len(hits) == size:
+    next_cursor = encode_cursor(pit_id, hits[-1]['sort'])
+  response = {
+    "total": results['hits']['total']['value'],
+    "size": size,
+    "tweets": [hit['_source'] for hit in hits],
+    "next_cursor": next_cursor,
+  }
+  return response, None if next_cursor else pit_id
+
+
+def msearch_searches(query_bodies):
+  """
+  Header and body lines of an _msearch running several queries
+
+  Aggregation-only searches are served from the ES request cache when possible.
+
+  Attributes:
+    query_bodies: list of ESQueryBuilder to run
+  """
+  searches = []
+  for query_body in query_bodies:
+    body = query_body.get_query()
+    header = {"index": query_body.get_index(), "ignore_unavailable": True}
+    if body.get("size") == 0:
+      header["request_cache"] = True
+    searches += [header, body]
+  return searches
+
+
+def msearch_error(responses):
+  """
+  First error of the responses of an _msearch as (JSON response, HTTP status), None if they all succeeded
+
+  Attributes:
+    responses: responses of the _msearch, in order
+  """
+  for response in responses:
+    if "error" in response:
+      return {"error": response["error"]}, response.get("status", 500)
+  return None
+
+
+def search_response(results, page, size):
+  """
+  Extract the /search response from the ES results of paginated_query
+
+  Attributes:
+    results: ES search response
+    page: page number of results
+    size: number of tweets per page
+  """
+  return {
+    "total": results['hits']['total']['value'],
+    "page": page,
+    "size": size,
+    "tweets": [hit['_source'] for hit in results['hits']['hits']],
+  }
@@ -0,0 +1,87 @@
+# Columns of the tweet documents, shared by populate_IOA.py (coercion, Parquet cache) and the exports
+
+# Every column of a tweet document, in the order of the IO dumps, followed by the ones added at ingest
+tweet_columns = [
+  "tweetid", "userid", "user_display_name", "user_screen_name", "user_reported_location",
+  "user_profile_description", "user_profile_url", "follower_count", "following_count",
+  "account_creation_date", "account_language", "tweet_language", "tweet_text", "tweet_time",
+  "tweet_client_name", "in_reply_to_userid", "in_reply_to_tweetid", "quoted_tweet_tweetid",
+  "is_retweet", "retweet_userid", "retweet_tweetid", "latitude", "longitude", "quote_count",
+  "reply_count", "like_count", "retweet_count", "hashtags", "urls", "user_mentions",
+  "dataset", "file_name", "cluster_id", "id_errors"
+]
+
+# Columns that need to be coerced before being inserted into ES
+int_columns = {"follower_count", "following_count", "like_count", "quote_count", "reply_count", "retweet_count"}
+date_columns = {"account_creation_date", "tweet_time"}
+list_columns = {"hashtags", "urls", "user_mentions"}
+bool_columns = {"is_retweet"}
+# Tweet ids are mapped as long, so lookups and joins between retweets, replies and originals compare integers.
+# User ids stay keywords, hashed datasets replace them with hashes
+tweet_id_columns = {"tweetid", "retweet_tweetid", "in_reply_to_tweetid", "quoted_tweet_tweetid"}
+user_id_columns = {"userid", "retweet_userid", "in_reply_to_userid"}
+# Id columns whose value was lost (ex: exported as a float, 1.2811923772777923e+18), listed per row
+id_errors_column = "id_errors"
+
+
+def parquet_column_type(column):
+  """
+  Arrow type a column is stored as in Parquet: int64 counts, timestamp dates, bool, lists of strings or strings
+  """
+  import pyarrow as pa
+
+  if column in int_columns:
+    return pa.int64()
+  if column in date_columns:
+    return pa.timestamp("s")
+  if column in bool_columns:
+    return pa.bool_()
+  if column in list_columns or column == id_errors_column:
+    return pa.list_(pa.string())
+  return pa.string()
+
+
+def parquet_value(column, value):
+  """
+  Value of a cell as stored in Parquet, empty and malformed typed values become null
+
+  Attributes:
+    column: name of the column
+    value: coerced value of the cell, or the one of an ES document
+  """
+  if value is None:
+    return None
+  if column in list_columns or column == id_errors_column:
+    return [str(item) for item in value] if isinstance(value, list) else None
+  if column in int_columns:
+    return value if isinstance(value, int) else None
+  if column in bool_columns:
+    # Documents indexed before is_retweet was coerced hold "True"/"False"
+    return value if isinstance(value, bool) else str(value).lower() == "true"
+  if column in date_columns:
+    return value or None
+  return str(value)
+
+
+def parquet_table(rows, columns):
+  """
+  Build an Arrow table of row dicts, typed with parquet_column_type
+
+  Attributes:
+    rows: list of row dicts, coerced rows or ES documents
+    columns: columns of the table, in order
+  """
+  import pyarrow as pa
+
+  # Dates are ISO strings, Arrow parses them while casting to timestamps
+  string_schema = pa.schema([
+    (column, pa.string() if column in date_columns else parquet_column_type(column))
+    for column in columns
+  ])
+  table = pa.Table.from_pylist([
+    {column: parquet_value(column, row.get(column)) for column in columns} for row in rows
+  ], schema=string_schema)
+  for column in date_columns.intersection(columns):
+    index = table.schema.get_field_index(column)
+    table = table.set_column(index, column, table[column].cast(pa.timestamp("s")))
+  return table
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The ingest scripts live at the root of the repository, the search API modules import each other by name
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "search_api"))
@@ -0,0 +1,49 @@
+import pytest
+
+from cascades import cascade_document
+
+hour = 3600000
+
+
+def terms(*keys):
+    return {"buckets": [{"key": key, "doc_count": 1} for key in keys]}
+
+
+def cascade_bucket(timeline):
+    first = timeline[0][0]
+    last = timeline[-1][0]
+    return {
+        "doc_count": sum(count for _, count in timeline),
+        "first_seen": {"value": first, "value_as_string": "2020-01-01T00:00:00"},
+        "last_seen": {"value": last, "value_as_string": "2020-01-01T05:00:00"},
+        "accounts": {"value": 4},
+        "participants": terms("10", "20"),
+        "original_user": terms("1"),
+        "languages": terms("en"),
+        "hashtags": terms("vote"),
+        "timeline": {"buckets": [
+            {"key": key, "key_as_string": str(key), "doc_count": count} for key, count in timeline
+        ]},
+        "first_retweet": {"hits": {"hits": [{"_source": {"tweet_text": "RT @someone: count every vote"}}]}}
+    }
+
+
+def test_cascade_document():
+    # 10 retweets over 5 hours, 6 of them in the second hour
+    bucket = cascade_bucket([(0, 2), (hour, 6), (3 * hour, 1), (5 * hour, 1)])
+    cascade = cascade_document(bucket, "99", "russia")
+    assert cascade["size"] == 10 and cascade["userid"] == "1"
+    assert cascade["duration_hours"] == 5.0
+    assert cascade["velocity"] == pytest.approx(2.0)
+    assert cascade["peak_hourly"] == 6
+    # Half of the retweets are reached in the hour bucket starting one hour after the first retweet
+    assert cascade["hours_to_half"] == 1.0
+    assert cascade["text"] == "RT @someone: count every vote"
+    assert cascade["timeline"][1] == {"hour": str(hour), "count": 6}
+
+
+def test_short_cascades_count_as_lasting_an_hour():
+    cascade = cascade_document(cascade_bucket([(0, 3)]), "99", "russia")
+    assert cascade["duration_hours"] == 0.0
+    assert cascade["velocity"] == 3.0
+    assert cascade["peak_hourly"] == 3 and cascade["hours_to_half"] == 0.0
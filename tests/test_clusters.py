@@ -0,0 +1,39 @@
+from werkzeug.datastructures import MultiDict
+
+from clusters import can_use_cluster_summaries, cluster_document, cluster_summaries_query, cluster_summaries_response
+from test_rollups import coverage_results
+
+
+def summaries_results(covered):
+    return {
+        "hits": {"hits": [{"_source": {"cluster_id": "1", "dataset": "russia", "size": 3, "accounts": 2,
+                                       "first_tweet": {"tweetid": "1"}}}]},
+        "aggregations": {"coverage": {"markers": {"datasets": {"buckets": [
+            {"key": dataset, "doc_count": 1, "count": {"value": float(count)}} for dataset, count in covered.items()
+        ]}}}}
+    }
+
+
+def test_cluster_document():
+    bucket = {"doc_count": 3, "accounts": {"value": 2},
+              "first_tweet": {"hits": {"hits": [{"_source": {"tweetid": "1", "tweet_text": "copy"}}]}}}
+    assert cluster_document(bucket, "1", "russia") == {
+        "cluster_id": "1", "dataset": "russia", "size": 3, "accounts": 2,
+        "first_tweet": {"tweetid": "1", "tweet_text": "copy"}}
+
+
+def test_summaries_answer_when_every_dataset_is_covered():
+    response = cluster_summaries_response(summaries_results({"russia": 5}), coverage_results({"russia": 5}))
+    assert response == {"clusters": [{"cluster_id": "1", "size": 3, "accounts": 2, "first_tweet": {"tweetid": "1"}}]}
+    # russia got tweets since its clusters were built, iran has none
+    assert cluster_summaries_response(summaries_results({"russia": 5}), coverage_results({"russia": 6})) is None
+    assert cluster_summaries_response(summaries_results({"russia": 5}),
+                                      coverage_results({"russia": 5, "iran": 1})) is None
+
+
+def test_summaries_only_filter_on_dataset():
+    assert can_use_cluster_summaries(MultiDict({"dataset": "russia", "size": "20"}))
+    assert not can_use_cluster_summaries(MultiDict({"dataset": "russia", "from": "2020-01-01"}))
+    _, body = cluster_summaries_query(MultiDict({"dataset": "russia", "min_size": "5"}))
+    assert body["query"]["bool"]["filter"] == [{"range": {"size": {"gte": 5}}}, {"term": {"dataset": "russia"}}]
+    assert "global" in body["aggs"]["coverage"]
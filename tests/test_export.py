@@ -0,0 +1,34 @@
+import io
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from export import csv_chunks, export_columns, parquet_chunks
+
+docs = [
+    {"tweetid": "1", "userid": "10", "tweet_time": "2019-12-31T23:30:00", "is_retweet": False, "like_count": 3,
+     "hashtags": ["vote"], "urls": [], "cluster_id": "1", "id_errors": ["retweet_tweetid"], "dataset": "russia"},
+    {"tweetid": "2", "userid": "20", "tweet_time": None, "is_retweet": "True", "like_count": None,
+     "hashtags": None, "cluster_id": None, "dataset": "russia"},
+]
+
+
+def test_export_columns_include_the_columns_added_at_ingest():
+    assert {"cluster_id", "id_errors", "dataset", "file_name"} <= set(export_columns)
+
+
+def test_csv_export():
+    lines = b"".join(csv_chunks([docs])).decode("utf-8").splitlines()
+    assert lines[0].split(",") == export_columns
+    assert len(lines) == 3
+
+
+def test_parquet_export():
+    table = pq.read_table(io.BytesIO(b"".join(parquet_chunks([docs[:1], docs[1:]]))))
+    assert table.column_names == export_columns
+    assert pa.types.is_timestamp(table.schema.field("tweet_time").type)
+    assert table.schema.field("like_count").type == pa.int64()
+    rows = table.to_pylist()
+    assert rows[0]["hashtags"] == ["vote"] and rows[0]["urls"] == []
+    assert rows[0]["cluster_id"] == "1" and rows[0]["id_errors"] == ["retweet_tweetid"]
+    assert rows[1]["is_retweet"] is True and rows[1]["like_count"] is None and rows[1]["tweet_time"] is None
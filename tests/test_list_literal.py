@@ -0,0 +1,53 @@
+import ast
+import random
+
+import pytest
+
+from list_literal import parse_list_literal
+
+# Invalid escapes such as '\q' are kept as is by both, with a warning
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning", "ignore::SyntaxWarning")
+
+
+def literal_eval(value):
+    try:
+        return ast.literal_eval(value)
+    except Exception:
+        return []
+
+
+literals = [
+    # Empty lists
+    "[]", "[ ]", " [] ", "[\t]",
+    # Quoting
+    "['1255650154021113862']", "['a', 'b']", '["a", "b"]', "['a', \"b\"]", "['it\"s']", '["it\'s"]',
+    "['']", "['', '']", "[' spaced ']", "['ünïcödé', '#日本']", "['a','b']", "[ 'a' , 'b' ]",
+    # Escapes
+    r"['it\'s']", r'["say \"hi\""]', r"['back\\slash']", r"['tab\there']", r"['\n']", r"['\x41é']",
+    r"['\N{BULLET}']", r"['\q']", "['line\\\ncontinued']", r"[r'\n']", r"[b'bytes']",
+    # Trailing commas
+    "['a',]", "['a', ]", "['a',  'b',]", "[,]", "['a',,]",
+    # Implicit string concatenation
+    "['a' 'b']", "['a''b']", "['a' \"b\"]", "['a' 'b', 'c']",
+    # Triple quotes
+    "['''a''']", '["""a"""]', "['''it's''']",
+    # Not only strings
+    "[1, 2]", "['a', 1]", "[['a']]", "[None]", "['a'] + ['b']", "['a']  # comment",
+    # Malformed
+    "", "[", "]", "['a'", "['a]", "'a'", "a", "[a]", "['a' b]", "['a']]", "[['a']", "['a'] x", "nan",
+    "['a\nb']", "['a\rb']", "['a\x00']", "{'a'}", "('a',)", "['a';'b']", "[\n'a']", "['a'\n]",
+]
+
+
+@pytest.mark.parametrize("value", literals)
+def test_same_as_literal_eval(value):
+    assert parse_list_literal(value) == literal_eval(value)
+
+
+def test_random_literals_same_as_literal_eval():
+    # Lists put together from pieces of valid and broken literals
+    pieces = ["[", "]", ",", " ", "'", '"', "\\", "a", "é", "'a'", '"b"', "'it\\'s'", "\\n", "\t", "#", "1"]
+    rng = random.Random(42)
+    for _ in range(20000):
+        value = "[" + "".join(rng.choice(pieces) for _ in range(rng.randint(0, 8))) + rng.choice(["]", ""])
+        assert parse_list_literal(value) == literal_eval(value), value
@@ -0,0 +1,30 @@
+from near_duplicates import ClusterAssigner, lsh_bands
+
+
+def rows(*texts):
+    return [{"tweetid": str(i), "_lsh_bands": lsh_bands(text)} for i, text in enumerate(texts, 1)]
+
+
+def test_near_duplicates_join_the_first_cluster():
+    clusters = ClusterAssigner()
+    assigned = list(clusters.assign(rows(
+        "the quick brown fox jumps over the lazy dog today",
+        "RT @someone: the quick brown fox jumps over the lazy dog today https://t.co/x",
+        "something else entirely different here"
+    ), "russia"))
+    # Leaders and unique tweets have no cluster_id until populate_IOA.py back-fills the leaders
+    assert [row["cluster_id"] for row in assigned] == [None, "1", None]
+    assert all("_lsh_bands" not in row for row in assigned)
+
+
+def test_leaders_are_bounded():
+    clusters = ClusterAssigner(max_leaders=2)
+    texts = ["first text about one thing", "second text about another", "third text about something"]
+    list(clusters.assign(rows(*texts), "russia"))
+    leaders = clusters.leaders["russia"]
+    assert set(leaders.values()) == {"2", "3"}
+    # The first cluster was dropped, a copy of its text leads a new one
+    again = list(clusters.assign([{"tweetid": "4", "_lsh_bands": lsh_bands(texts[0])},
+                                  {"tweetid": "5", "_lsh_bands": lsh_bands(texts[0])}], "russia"))
+    assert [row["cluster_id"] for row in again] == [None, "4"]
+    assert len(leaders) <= 2 * len(lsh_bands(texts[0]))
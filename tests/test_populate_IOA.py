@@ -0,0 +1,285 @@
+import io
+
+import pandas as pd
+
+import populate_IOA
+from graph_store import GraphBuilder, InteractionGraph, graph_path
+from ingest_manifest import IngestManifest
+from populate_IOA import coerce_id_column, coerce_int_column, finish_bulk_load
+
+
+def test_coerce_int_column():
+    column = pd.Series([" 12 ", "-4", "+7", "1.5", "x", "", None], dtype=object)
+    assert coerce_int_column(column).tolist() == [12, -4, 7, None, None, None, None]
+
+
+def test_coerce_int_column_leaves_out_unicode_digits():
+    # Arabic-Indic and fullwidth digits match \d but pd.to_numeric can't parse them
+    column = pd.Series(["٣", "１２", "3"], dtype=object)
+    assert coerce_int_column(column).tolist() == [None, None, 3]
+
+
+def test_coerce_id_column():
+    column = pd.Series(["1281192377277792256", "0042", "1.5e+3", "1500.0", "", None], dtype=object)
+    ids, lost = coerce_id_column(column)
+    assert ids.tolist() == ["1281192377277792256", "42", "1500", "1500", None, None]
+    assert lost.tolist() == [False] * 6
+
+
+def test_coerce_id_column_flags_ids_that_went_through_a_float():
+    column = pd.Series(["1.2811923772777923e+18", "1281192377277792256.0", "9007199254740991.0", "1.5"],
+                       dtype=object)
+    ids, lost = coerce_id_column(column)
+    assert ids.tolist() == [None, None, "9007199254740991", None]
+    assert lost.tolist() == [True, True, False, True]
+
+
+def test_coerce_id_column_unicode_digits():
+    column = pd.Series(["٣٤", "12", "a1b2c3"], dtype=object)
+    ids, lost = coerce_id_column(column)
+    assert ids.tolist() == [None, "12", None]
+    assert lost.tolist() == [True, False, True]
+    # User ids that aren't numbers, such as hashes, are kept as is
+    ids, lost = coerce_id_column(column, numeric=False)
+    assert ids.tolist() == ["٣٤", "12", "a1b2c3"]
+    assert not lost.any()
+
+
+class FakeIndices:
+    def __init__(self, names):
+        self.names = names
+        self.merged = []
+
+    def get_mapping(self, index):
+        return {name: {"mappings": {"_meta": {}}} for name in self.names}
+
+    def put_settings(self, index, settings):
+        pass
+
+    def put_mapping(self, index, meta):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def forcemerge(self, index, max_num_segments):
+        self.merged.append(index)
+
+
+class FakeClient:
+    def __init__(self, names):
+        self.indices = FakeIndices(names)
+
+    def options(self, **kwargs):
+        return self
+
+
+def test_finish_bulk_load_only_merges_written_indices():
+    client = FakeClient(["ioa-tweets-2018", "ioa-tweets-2019", "ioa-tweets-2020"])
+    finish_bulk_load(client, "ioa-tweets-*", merge_indices={"ioa-tweets-2020", "ioa-tweets-2018"})
+    assert client.indices.merged == ["ioa-tweets-2018,ioa-tweets-2020"]
+
+    client = FakeClient(["ioa-tweets-2018", "ioa-tweets-2019"])
+    finish_bulk_load(client, "ioa-tweets-*", merge_indices=set())
+    assert client.indices.merged == []
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+def serve(content, etag, requests_sent):
+    """
+    Fake requests.get of a server honoring Range and If-Range
+    """
+    def get(url, headers, stream, timeout):
+        requests_sent.append(headers)
+        if "Range" in headers and headers.get("If-Range", etag) == etag:
+            start = int(headers["Range"][len("bytes="):-1])
+            return FakeResponse(206, content[start:], {"ETag": etag})
+        return FakeResponse(200, content, {"ETag": etag})
+    return get
+
+
+def test_download_file_resumes_with_if_range(tmp_path, monkeypatch):
+    destination = str(tmp_path / "dataset.zip")
+    requests_sent = []
+    monkeypatch.setattr(populate_IOA.requests, "get", serve(b"0123456789", '"v1"', requests_sent))
+    (tmp_path / "dataset.zip.part").write_bytes(b"0123")
+
+    assert populate_IOA.download_file(destination, destination, validator='"v1"') == destination
+    assert requests_sent == [{"Range": "bytes=4-", "If-Range": '"v1"'}]
+    assert (tmp_path / "dataset.zip").read_bytes() == b"0123456789"
+
+
+def test_download_datasets_counts_the_zip_being_indexed(monkeypatch):
+    on_disk = set()
+    most_on_disk = []
+
+    def download_zip(url, destination_folder, manifest):
+        on_disk.add(url)
+        most_on_disk.append(len(on_disk))
+        return url, "v1"
+
+    monkeypatch.setattr(populate_IOA, "download_zip", download_zip)
+    urls = [f"zip{i}" for i in range(6)]
+    indexed = []
+    for url, zip_file_path, version in populate_IOA.download_datasets(urls, "", max_workers=2):
+        # Indexed, then deleted before the next one is asked for
+        indexed.append(url)
+        on_disk.discard(zip_file_path)
+    assert sorted(indexed) == urls
+    assert max(most_on_disk) <= 2
+
+
+def test_download_file_starts_over_when_the_file_changed(tmp_path, monkeypatch):
+    destination = str(tmp_path / "dataset.zip")
+    requests_sent = []
+    # The partial file was started by a previous run, on the first version of the file
+    (tmp_path / "dataset.zip.part").write_bytes(b"old")
+    (tmp_path / "dataset.zip.part.validator").write_text('"v1"')
+    monkeypatch.setattr(populate_IOA.requests, "get", serve(b"new content", '"v2"', requests_sent))
+
+    assert populate_IOA.download_file(destination, destination, validator='"v2"') == destination
+    assert requests_sent == [{"Range": "bytes=3-", "If-Range": '"v1"'}]
+    assert (tmp_path / "dataset.zip").read_bytes() == b"new content"
+    assert not (tmp_path / "dataset.zip.part.validator").exists()
+
+
+class CompositeClient:
+    """
+    Fake client answering composite aggregations over a list of keys, page by page
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.requests = []
+
+    def search(self, index, size, track_total_hits, query, aggs):
+        composite = aggs["buckets"]["composite"]
+        self.requests.append(dict(composite))
+        start = composite.get("after", {}).get("userid", -1) + 1
+        page = self.keys[start:start + composite["size"]]
+        buckets = {"buckets": [{"key": {"userid": key}, "doc_count": 1} for key in page]}
+        if page:
+            buckets["after_key"] = {"userid": page[-1]}
+        return {"aggregations": {"buckets": buckets}}
+
+
+def test_iter_composite_buckets_pages_with_after_key():
+    client = CompositeClient(list(range(5)))
+    sources = [{"userid": {"terms": {"field": "userid"}}}]
+    buckets = list(populate_IOA.iter_composite_buckets(client, "ioa-tweets", {"match_all": {}}, sources, page_size=2))
+    assert [bucket["key"]["userid"] for bucket in buckets] == [0, 1, 2, 3, 4]
+    assert [request.get("after") for request in client.requests] == [None, {"userid": 1}, {"userid": 3}]
+
+
+def test_iter_touched_users():
+    client = CompositeClient(list(range(4)))
+    assert list(populate_IOA.iter_touched_users(client, "ioa-tweets", {"russia"}, page_size=2)) == [0, 1, 2, 3]
+    # A full last page needs one more request to find out there is nothing after it
+    assert len(client.requests) == 3
+
+
+def test_parse_list_column_empty_cells_are_none():
+    column = pd.Series(["['a', 'b']", "", "[", "[]"], dtype=object)
+    assert populate_IOA.parse_list_column(column).tolist() == [["a", "b"], None, [], []]
+
+
+class FakeBackend:
+    path = "fake.sqlite"
+
+    def __init__(self):
+        self.docs = []
+
+    def index_documents(self, docs):
+        self.docs += docs
+
+
+def test_resumed_file_is_cached_whole(tmp_path):
+    csv = "tweetid,userid,tweet_text,hashtags\n" + "".join(f"{i},u{i},text {i},['h{i}']\n" for i in range(1, 6))
+    backend = FakeBackend()
+    path = str(tmp_path / "russia_tweets.parquet")
+    with populate_IOA.ParquetCacheWriter(path, "russia_tweets.csv") as cache_writer:
+        rows = populate_IOA.csv_to_sqlite(io.BytesIO(csv.encode()), "russia_tweets.csv", backend, "russia",
+                                          skip_rows=2, parquet_cache=cache_writer)
+    assert rows == 5
+    assert [doc["tweetid"] for doc in backend.docs] == ["3", "4", "5"]
+    cached = list(populate_IOA.iter_parquet_rows(path))
+    assert [row["tweetid"] for row in cached] == ["1", "2", "3", "4", "5"]
+    assert cached[0]["hashtags"] == ["h1"]
+
+
+def test_missing_parquet_files(tmp_path):
+    manifest = IngestManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.update_file("https://example.com/a.zip", "etag:1", "russia_tweets_1.csv", 10, status="done")
+    manifest.update_file("https://example.com/a.zip", "etag:1", "russia_tweets_2.csv", 4)
+    manifest.update_file("https://example.com/a.zip", "etag:1", "russia_tweets_3.csv", 0)
+    folder = str(tmp_path / "parquet_cache")
+    cached = populate_IOA.parquet_cache_path(folder, "russia", "russia_tweets_1.csv")
+    (tmp_path / "parquet_cache" / "dataset=russia").mkdir(parents=True)
+    open(cached, "wb").close()
+    assert populate_IOA.missing_parquet_files(manifest, folder) == [
+        populate_IOA.parquet_cache_path(folder, "russia", "russia_tweets_2.csv")
+    ]
+    manifest.close()
+
+
+def zip_graph(*edges):
+    graph = GraphBuilder("russia")
+    for source, target in edges:
+        graph.add_edge(source, target, 0)
+    return graph
+
+
+def test_save_zip_graph_merges_each_zip_once(tmp_path):
+    manifest = IngestManifest(str(tmp_path / "manifest.sqlite"))
+    folder = str(tmp_path / "graphs")
+    assert populate_IOA.save_zip_graph(zip_graph(("a", "b")), folder, manifest, "zip1", "etag:1") == (2, 1)
+    # Next run, another zip of the dataset
+    assert populate_IOA.save_zip_graph(zip_graph(("a", "c")), folder, manifest, "zip2", "etag:1") == (3, 2)
+    # The second zip again, after a run stopped before it was marked as done
+    assert populate_IOA.save_zip_graph(zip_graph(("a", "c")), folder, manifest, "zip2", "etag:1") is None
+    graph = InteractionGraph(graph_path(folder, "russia"))
+    assert list(graph.out_weights) == [1, 1]
+    # A new version of a zip can't replace its edges in a merged graph
+    assert populate_IOA.save_zip_graph(zip_graph(("a", "d")), folder, manifest, "zip2", "etag:2") is None
+    assert manifest.graph_sources("russia") == {"zip1": "etag:1", "zip2": "etag:1"}
+    manifest.close()
+
+
+def test_save_zip_graph_replaces_the_graph_of_a_new_version(tmp_path):
+    manifest = IngestManifest(str(tmp_path / "manifest.sqlite"))
+    folder = str(tmp_path / "graphs")
+    populate_IOA.save_zip_graph(zip_graph(("a", "b")), folder, manifest, "zip1", "etag:1")
+    assert populate_IOA.save_zip_graph(zip_graph(("a", "c")), folder, manifest, "zip1", "etag:2") == (2, 1)
+    assert list(InteractionGraph(graph_path(folder, "russia")).users) == ["a", "c"]
+    manifest.close()
+
+
+def test_coerce_frame():
+    csv = ("tweetid,tweet_time,follower_count,is_retweet,hashtags,retweet_tweetid\n"
+           "1,2020-1-5 3:04,12,True,\"['a']\",1.5e3\n"
+           "2,bad,x,False,\"['a']\",1.2811923772777923e+18\n"
+           "3,2020-01-05 03:04,12,,,\n"
+           "4\n")
+    rows = [row for frame in populate_IOA.read_csv_batches(io.StringIO(csv)) for row in populate_IOA.coerce_frame(frame)]
+    assert rows[0] == {"tweetid": "1", "tweet_time": "2020-01-05T03:04:00", "follower_count": 12, "is_retweet": True,
+                       "hashtags": ["a"], "retweet_tweetid": "1500", "id_errors": None}
+    assert rows[1] == {"tweetid": "2", "tweet_time": None, "follower_count": None, "is_retweet": False,
+                       "hashtags": ["a"], "retweet_tweetid": None, "id_errors": ["retweet_tweetid"]}
+    assert rows[2]["tweet_time"] == "2020-01-05T03:04:00" and rows[2]["hashtags"] is None
+    # Short rows get null cells
+    assert rows[3] == {"tweetid": "4", "tweet_time": None, "follower_count": None, "is_retweet": None,
+                       "hashtags": None, "retweet_tweetid": None, "id_errors": None}
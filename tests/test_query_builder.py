@@ -0,0 +1,71 @@
+import json
+import re
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from search_params import clusters_query, insights_query, paginated_query, with_insights_aggs
+
+
+def render(source, params):
+    """
+    Render a search template the way the mustache engine of ES does for the {{#toJson}} tags it is made of
+    """
+    tags = re.findall(r"\{\{#toJson\}\}(\w+)\{\{/toJson\}\}", source)
+    # Every tag has a param, a missing one would render as an empty string
+    assert set(tags) == set(params)
+    rendered = re.sub(r"\{\{#toJson\}\}(\w+)\{\{/toJson\}\}", lambda tag: json.dumps(params[tag.group(1)]), source)
+    assert "{{" not in rendered
+    return json.loads(rendered)
+
+
+def search_query(args):
+    return paginated_query(args, "ioa-tweets")[0]
+
+
+def dashboard_query(args):
+    query_body, _, _ = paginated_query(args, "ioa-tweets")
+    return with_insights_aggs(query_body, args)
+
+
+every_filter = {"query": "count every vote", "from": "2019-01-01", "to": "2020-12-31", "language": "en",
+                "user": "10", "dataset": "russia", "hashtags": ["vote", "election"]}
+
+route_queries = [
+    # /search
+    (search_query, {}),
+    (search_query, {**every_filter, "page": "3", "size": "20", "sort_by": "time"}),
+    (search_query, {"from": "2019-01-01", "fields": "tweetid,tweet_text", "sort_by": "likes"}),
+    (search_query, {"to": "2019-01-01", "hashtags": ["", "vote"], "fields": ["tweetid", "user_screen_name"]}),
+    # /insights
+    (lambda args: insights_query(args, "ioa-tweets"), {}),
+    (lambda args: insights_query(args, "ioa-tweets"), {**every_filter, "interval": "month"}),
+    (lambda args: insights_query(args, "ioa-tweets"), {"dataset": "iran", "mode": "fast", "sample": "0.2"}),
+    # /clusters
+    (lambda args: clusters_query(args, "ioa-tweets"), {}),
+    (lambda args: clusters_query(args, "ioa-tweets"), {**every_filter, "size": "50", "min_size": "3"}),
+    # /dashboard, first page with the aggregations, deeper pages send insights_query in the same _msearch
+    (dashboard_query, {"user": "10", "interval": "week"}),
+    (dashboard_query, {**every_filter, "mode": "fast"}),
+]
+
+
+@pytest.mark.parametrize("build, args", route_queries)
+def test_templates_render_the_query(build, args):
+    query_body = build(MultiDict(args))
+    template_id, source, params = query_body.get_template()
+    assert render(source, json.loads(json.dumps(params))) == query_body.get_query()
+
+
+def test_templates_only_depend_on_the_shape_of_the_query():
+    first = search_query(MultiDict({**every_filter, "hashtags": ["vote"]}))
+    second = search_query(MultiDict({**every_filter, "query": "other", "hashtags": ["a", "b", "c"], "size": "50"}))
+    first_id, first_source, first_params = first.get_template()
+    second_id, second_source, second_params = second.get_template()
+    assert (first_id, first_source) == (second_id, second_source)
+    assert second_params["hashtag_filters"] == [{"term": {"hashtags": hashtag}} for hashtag in ("a", "b", "c")]
+    assert render(second_source, second_params) == second.get_query()
+
+    # Filters that aren't sent don't leave params or tags behind
+    unfiltered = search_query(MultiDict({"user": None, "hashtags": [""]}))
+    assert set(unfiltered.get_template()[2]) == {"from", "size"}
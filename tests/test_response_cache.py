@@ -0,0 +1,65 @@
+import response_cache
+from response_cache import ResponseCache
+
+
+def test_least_recently_used_responses_are_evicted_first():
+    cache = ResponseCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_responses_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(ttl=10)
+    cache.set("a", 1)
+    now[0] = 109.0
+    assert cache.get("a") == 1
+    now[0] = 111.0
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_a_generation_bump_clears_the_cache(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    generation = [1]
+    cache = ResponseCache(generation=lambda: generation[0], generation_check_interval=30)
+    cache.get("a")
+    cache.set("a", 1)
+    generation[0] = 2
+    # Not checked again before generation_check_interval
+    now[0] = 120.0
+    assert cache.get("a") == 1
+    now[0] = 131.0
+    assert cache.get("a") is None
+    assert cache.stats()["generation"] == 2 and cache.stats()["invalidations"] == 1
+
+
+def test_responses_computed_before_an_invalidation_are_dropped():
+    cache = ResponseCache()
+    assert cache.get("a") is None
+    invalidations = cache.invalidations
+    cache.set_generation(2)
+    cache.set("a", 1, invalidations)
+    assert cache.get("a") is None
+    invalidations = cache.invalidations
+    cache.set("a", 1, invalidations)
+    assert cache.get("a") == 1
+
+
+def test_stats_count_hits_and_misses():
+    cache = ResponseCache(maxsize=8, ttl=60)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 1, 1)
+    assert stats["hit_rate"] == 2 / 3
+    assert (stats["maxsize"], stats["ttl"]) == (8, 60)
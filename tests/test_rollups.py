@@ -0,0 +1,42 @@
+from werkzeug.datastructures import MultiDict
+
+from rollups import coverage_query, rollup_insights_response, rollup_query
+
+
+def rollup_results(covered):
+    empty = {"buckets": {"buckets": []}}
+    return {"aggregations": {
+        "tweets_over_time": {"doc_count": 2, "buckets": {"buckets": [
+            {"key_as_string": "2020-01-01", "key": 0, "doc_count": 1, "count": {"value": 5.0}}
+        ]}},
+        "top_users": empty, "top_hashtags": empty, "top_urls": empty,
+        "coverage": {"markers": {"datasets": {"buckets": [
+            {"key": dataset, "doc_count": 1, "count": {"value": float(count)}} for dataset, count in covered.items()
+        ]}}}
+    }}
+
+
+def coverage_results(counts):
+    return {"aggregations": {"datasets": {"buckets": [
+        {"key": dataset, "doc_count": count} for dataset, count in counts.items()
+    ]}}}
+
+
+def test_rollups_answer_when_every_dataset_is_covered():
+    insights = rollup_insights_response(rollup_results({"russia": 5, "iran": 3}),
+                                        coverage_results({"russia": 5, "iran": 3}))
+    assert insights["tweets_over_time"] == [{"key_as_string": "2020-01-01", "key": 0, "doc_count": 5}]
+    assert insights["approximation"] == {"source": "rollups", "top_k_per_bucket": 100}
+
+
+def test_rollups_fall_back_to_live_without_coverage():
+    # iran has no rollups, russia got tweets since its rollups were built
+    assert rollup_insights_response(rollup_results({"russia": 5}), coverage_results({"russia": 5, "iran": 3})) is None
+    assert rollup_insights_response(rollup_results({"russia": 5}), coverage_results({"russia": 6})) is None
+
+
+def test_coverage_is_read_whatever_the_filters():
+    args = MultiDict({"dataset": "russia", "from": "2020-01-01"})
+    _, body = rollup_query(args)
+    assert "global" in body["aggs"]["coverage"]
+    assert coverage_query(args)["query"] == {"bool": {"filter": [{"term": {"dataset": "russia"}}]}}
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from route_flows import (cascades_flow, clusters_flow, dashboard_flow, insights_flow, run_flow, run_flow_async,
+                         search_flow)
+from response_cache import ResponseCache
+from test_search_api import not_found
+
+
+class FakeBackend:
+    """
+    Backend recording the calls of a flow, answering searches with one page of hits
+    """
+    def __init__(self, hits=1, fail=()):
+        self.calls = []
+        self.hits = hits
+        self.fail = fail
+
+    def _call(self, name, *args):
+        self.calls.append(name)
+        if name in self.fail:
+            not_found()
+        if name == "open_point_in_time":
+            return {"id": "pit"}
+        hits = [{"_source": {"tweetid": str(i)}, "sort": [i]} for i in range(self.hits)]
+        return {"hits": {"total": {"value": self.hits}, "hits": hits},
+                "aggregations": {"top_clusters": {"buckets": []}}}
+
+    def __getattr__(self, name):
+        return lambda *args: self._call(name, *args)
+
+
+class AsyncFakeBackend(FakeBackend):
+    def __getattr__(self, name):
+        async def call(*args):
+            return self._call(name, *args)
+        return call
+
+
+def run_both(make_flow, **backend_args):
+    backend = FakeBackend(**backend_args)
+    result = run_flow(make_flow(), backend)
+    async_backend = AsyncFakeBackend(**backend_args)
+    assert asyncio.run(run_flow_async(make_flow(), async_backend)) == result
+    assert async_backend.calls == backend.calls
+    return result, backend.calls
+
+
+def test_cursor_search_flow_closes_the_point_in_time_on_the_last_page():
+    (response, status), calls = run_both(lambda: search_flow(MultiDict({"paginate": "cursor", "size": 2}), "ioa-tweets"))
+    assert status == 200 and response["next_cursor"] is None
+    assert calls == ["open_point_in_time", "search_index", "close_point_in_time"]
+
+
+def test_search_flow_without_cursor_support():
+    (response, status), calls = run_both(
+        lambda: search_flow(MultiDict({"paginate": "cursor"}), "ioa-tweets", cursors=False))
+    assert status == 400 and calls == []
+
+
+def test_flows_catch_the_errors_of_the_backend():
+    cache = ResponseCache()
+    (response, status), _ = run_both(lambda: cascades_flow(MultiDict(), cache), fail=("search_index",))
+    assert status == 404
+
+
+def test_flows_raise_the_errors_they_dont_handle():
+    # Without a cursor, a missing point in time is not an expired cursor
+    flow = search_flow(MultiDict({"paginate": "cursor"}), "ioa-tweets")
+    with pytest.raises(Exception, match="search_context_missing_exception"):
+        run_flow(flow, FakeBackend(fail=("search_index",)))
+
+
+def test_clusters_flow_falls_back_to_live_without_summaries():
+    (response, status), calls = run_both(lambda: clusters_flow(MultiDict(), ResponseCache(), "ioa-tweets"),
+                                         fail=("search_index",))
+    assert status == 200 and response == {"clusters": []}
+    assert calls == ["search_index", "search"]
+    (response, status), calls = run_both(
+        lambda: clusters_flow(MultiDict({"query": "vote"}), ResponseCache(), "ioa-tweets"))
+    assert calls == ["search"]
+
+
+@pytest.mark.parametrize("flow", [insights_flow, dashboard_flow])
+def test_invalid_sample_is_a_bad_request(flow):
+    (response, status), calls = run_both(
+        lambda: flow(MultiDict({"mode": "fast", "sample": "nan"}), ResponseCache(), "ioa-tweets"))
+    assert status == 400 and response == {"error": "sample must be a number, got nan"}
+    assert calls == []
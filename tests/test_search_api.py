@@ -0,0 +1,159 @@
+import asyncio
+import base64
+import os
+
+import pytest
+from elastic_transport import ApiResponseMeta
+from elasticsearch import NotFoundError
+from werkzeug.datastructures import MultiDict
+
+for name, value in {"ES_HOST": "localhost", "ES_PORT": "9200", "ES_USER": "elastic", "ES_PASSWORD": "x"}.items():
+    os.environ.setdefault(name, value)
+
+import ioa_search  # noqa: E402
+import ioa_search_async  # noqa: E402
+from query_builder import encode_cursor  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+from search_params import hidden_fields, insights_query  # noqa: E402
+
+
+def not_found(*args, **kwargs):
+    meta = ApiResponseMeta(status=404, http_version="1.1", headers={}, duration=0.0, node=None)
+    raise NotFoundError("search_context_missing_exception", meta, {"error": "No search context found"})
+
+
+async def async_not_found(*args, **kwargs):
+    not_found()
+
+
+malformed_cursors = [
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(b'{"after": [1]}').decode(),
+    base64.urlsafe_b64encode(b'["pit", [1]]').decode(),
+    base64.urlsafe_b64encode(b'{"pit": 1, "after": [1]}').decode(),
+]
+
+
+@pytest.mark.parametrize("cursor", malformed_cursors)
+def test_malformed_cursor(cursor):
+    response = ioa_search.app.test_client().get("/search", query_string={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid cursor"}
+
+
+def test_expired_cursor(monkeypatch):
+    monkeypatch.setattr(ioa_search.client, "search", not_found)
+    response = ioa_search.app.test_client().get("/search", query_string={"cursor": encode_cursor("pit", [1.0, 2])})
+    assert response.status_code == 410
+
+
+@pytest.mark.parametrize("cursor", malformed_cursors)
+def test_malformed_cursor_async(cursor):
+    async def get():
+        return await ioa_search_async.app.test_client().get("/search", query_string={"cursor": cursor})
+    response = asyncio.run(get())
+    assert response.status_code == 400
+
+
+def test_expired_cursor_async(monkeypatch):
+    es = ioa_search_async.client.options(request_timeout=1)
+    monkeypatch.setattr(type(es), "search", async_not_found)
+
+    async def get():
+        return await ioa_search_async.app.test_client().get(
+            "/search", query_string={"cursor": encode_cursor("pit", [1.0, 2])})
+    response = asyncio.run(get())
+    assert response.status_code == 410
+
+
+def search_results(*tweetids):
+    hits = [{"_source": {"tweetid": tweetid}} for tweetid in tweetids]
+    return {"hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+
+def insights_results(user):
+    buckets = {"buckets": [{"key": user, "doc_count": 3}]}
+    return {"hits": {"total": {"value": 3}, "hits": []}, "aggregations": {
+        "tweets_over_time": {"buckets": []}, "top_users": buckets, "top_hashtags": buckets, "top_urls": buckets}}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Flask test client whose backend records the searches of each request, with an empty insights cache
+    """
+    calls = []
+    cache = ResponseCache()
+    monkeypatch.setattr(ioa_search, "insights_cache", cache)
+
+    def search(query_body):
+        calls.append(("search", query_body.get_query()))
+        return search_results("1", "2")
+
+    def msearch(query_bodies):
+        calls.append(("msearch", [query_body.get_query() for query_body in query_bodies]))
+        return [search_results("3"), insights_results("live")]
+
+    monkeypatch.setattr(ioa_search.backend, "search", search)
+    monkeypatch.setattr(ioa_search.backend, "msearch", msearch)
+    return ioa_search.app.test_client(), calls, cache
+
+
+def dashboard_cache_key(args):
+    query_body = insights_query(MultiDict(args), ioa_search.index_name)
+    return ResponseCache.make_key(query_body.get_index(), query_body.get_query())
+
+
+def test_dashboard_serves_cached_insights(api):
+    client, calls, cache = api
+    args = {"dataset": "russia", "page": "3"}
+    cached = {"tweets_over_time": [], "top_users": [{"key": "cached", "doc_count": 9}],
+              "top_hashtags": [], "top_urls": []}
+    cache.set(dashboard_cache_key(args), cached)
+
+    response = client.get("/dashboard", query_string=args)
+    assert response.status_code == 200
+    assert response.get_json() == {"total": 2, "page": 3, "size": 10,
+                                   "tweets": [{"tweetid": "1"}, {"tweetid": "2"}], **cached}
+    # Only the hits are searched, without aggregations
+    assert [name for name, _ in calls] == ["search"]
+    assert calls[0][1]["aggs"] == {}
+
+
+def test_dashboard_deeper_pages_use_msearch(api):
+    client, calls, cache = api
+    args = {"dataset": "russia", "page": "2"}
+    response = client.get("/dashboard", query_string=args)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["tweets"] == [{"tweetid": "3"}] and body["top_users"] == [{"key": "live", "doc_count": 3}]
+
+    (name, (hits_body, aggs_body)), = calls
+    assert name == "msearch"
+    assert hits_body["from"] == 10 and hits_body["aggs"] == {}
+    assert aggs_body["size"] == 0 and "top_users" in aggs_body["aggs"]
+    assert cache.get(dashboard_cache_key(args))["top_users"] == [{"key": "live", "doc_count": 3}]
+
+
+def test_dashboard_msearch_error(api, monkeypatch):
+    client, calls, cache = api
+    monkeypatch.setattr(ioa_search.backend, "msearch", lambda query_bodies: [
+        search_results("3"), {"error": {"type": "search_phase_execution_exception"}, "status": 503}])
+    args = {"dataset": "russia", "page": "2"}
+    response = client.get("/dashboard", query_string=args)
+    assert response.status_code == 503
+    assert response.get_json() == {"error": {"type": "search_phase_execution_exception"}}
+    assert cache.get(dashboard_cache_key(args)) is None
+
+
+@pytest.mark.parametrize("fields, source", [
+    (None, {"excludes": hidden_fields}),
+    ("tweetid,tweet_text", {"includes": ["tweetid", "tweet_text"]}),
+    (["tweetid", "user_screen_name,"], {"includes": ["tweetid", "user_screen_name"]}),
+])
+def test_search_fields_select_the_source(api, fields, source):
+    client, calls, _ = api
+    response = client.get("/search", query_string={"query": "vote", **({"fields": fields} if fields else {})})
+    assert response.status_code == 200
+    assert calls[0][1]["_source"] == source
@@ -0,0 +1,116 @@
+import json
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from search_backend import SearchBackend, SQLiteBackend
+from search_params import filtered_query, paginated_query
+
+
+tweets = [
+    {"tweetid": "1", "userid": "10", "tweet_text": "count every vote", "tweet_language": "en",
+     "tweet_time": "2019-12-30T23:59:00", "hashtags": ["vote", "election"], "dataset": "russia"},
+    {"tweetid": "2", "userid": "10", "tweet_text": "late night tweet", "tweet_language": "en",
+     "tweet_time": "2019-12-31T23:30:00", "hashtags": ["vote"], "dataset": "russia"},
+    {"tweetid": "3", "userid": "20", "tweet_text": "feliz año nuevo", "tweet_language": "es",
+     "tweet_time": "2020-01-01T00:00:00", "hashtags": [], "dataset": "venezuela"},
+]
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "tweets.db"))
+    backend.index_documents(tweets)
+    yield backend
+    backend.close()
+
+
+def search_ids(backend, **args):
+    query_body, _, _ = paginated_query(MultiDict(args), "ioa-tweets")
+    return sorted(hit["_source"]["tweetid"] for hit in backend.search(query_body)["hits"]["hits"])
+
+
+def where(backend, query):
+    return backend._where(query)[1:]
+
+
+def test_date_only_lte_covers_the_whole_day(backend):
+    assert search_ids(backend, to="2019-12-31") == ["1", "2"]
+    assert where(backend, {"bool": {"filter": [{"range": {"tweet_time": {"lte": "2019-12-31"}}}]}}) == (
+        ["t.tweet_time < ?"], ["2020-01-01"])
+
+
+def test_date_only_gt_starts_after_the_day(backend):
+    assert where(backend, {"bool": {"filter": [{"range": {"tweet_time": {"gt": "2019-12-31"}}}]}}) == (
+        ["t.tweet_time >= ?"], ["2020-01-01"])
+    assert where(backend, {"bool": {"filter": [{"range": {"tweet_time": {"gt": "2019-12-30"}}}]}}) == (
+        ["t.tweet_time >= ?"], ["2019-12-31"])
+
+
+def test_gte_and_timestamp_bounds_are_kept(backend):
+    query = {"bool": {"filter": [{"range": {"tweet_time": {"gte": "2019-12-31", "lte": "2019-12-31T12:00:00"}}}]}}
+    assert where(backend, query) == (
+        ["t.tweet_time >= ?", "t.tweet_time <= ?"], ["2019-12-31", "2019-12-31T12:00:00"])
+    assert search_ids(backend, **{"from": "2019-12-31"}) == ["2", "3"]
+
+
+def test_term_filters(backend):
+    query = {"bool": {"filter": [{"term": {"tweet_language": "en"}}, {"term": {"hashtags": "vote"}}]}}
+    assert where(backend, query) == (
+        ["t.tweet_language = ?",
+         "EXISTS (SELECT 1 FROM tweet_terms WHERE tweet = t.id AND field = ? AND value = ?)"],
+        ["en", "hashtags", "vote"])
+    assert search_ids(backend, language="es") == ["3"]
+    assert search_ids(backend, user="10", dataset="russia") == ["1", "2"]
+
+
+def test_hashtag_filters_are_all_required(backend):
+    query = filtered_query(MultiDict([("hashtags", "vote"), ("hashtags", "election")]), "ioa-tweets")
+    assert where(backend, query.get_query()["query"]) == (
+        ["EXISTS (SELECT 1 FROM tweet_terms WHERE tweet = t.id AND field = ? AND value = ?)"] * 2,
+        ["hashtags", "vote", "hashtags", "election"])
+    assert search_ids(backend, hashtags="vote") == ["1", "2"]
+    assert search_ids(backend, hashtags=["vote", "election"]) == ["1"]
+
+
+def test_text_query(backend):
+    text_query, conditions, params = backend._where(filtered_query(MultiDict({"query": "vote!"}), "ioa-tweets")
+                                                    .get_query()["query"])
+    assert text_query == '{tweet_text user_screen_name hashtags} : ("vote")'
+    assert conditions == ["tweets_fts MATCH ?"]
+    assert params == [text_query]
+    assert search_ids(backend, query="vote") == ["1", "2"]
+    # Nothing to search for matches nothing
+    assert backend._where({"bool": {"must": [{"multi_match": {"query": "!!"}}]}}) == (None, [], [])
+
+
+def test_unsupported_clauses_are_rejected(backend):
+    with pytest.raises(ValueError):
+        backend._where({"bool": {"filter": [{"prefix": {"userid": "1"}}]}})
+    with pytest.raises(ValueError):
+        backend._where({"bool": {"must": [{"match_all": {}}]}})
+    with pytest.raises(ValueError):
+        backend._where({"bool": {"filter": [{"term": {"tweet_text') OR 1=1 --": "x"}}]}})
+
+
+def test_backends_implement_the_interface(backend):
+    assert isinstance(backend, SearchBackend)
+    with pytest.raises(TypeError):
+        SearchBackend()
+
+
+def test_backfill_cluster_leaders(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "clusters.db"))
+    backend.index_documents([
+        {"tweetid": "1", "dataset": "russia", "cluster_id": None},
+        {"tweetid": "2", "dataset": "russia", "cluster_id": "1"},
+        {"tweetid": "3", "dataset": "russia", "cluster_id": None},
+        {"tweetid": "4", "dataset": "iran", "cluster_id": None},
+        {"tweetid": "5", "dataset": "iran", "cluster_id": "4"},
+    ])
+    assert backend.backfill_cluster_leaders({"russia"}) == 1
+    rows = backend.connection().execute("SELECT tweetid, cluster_id, source FROM tweets ORDER BY tweetid").fetchall()
+    assert [(tweetid, cluster_id) for tweetid, cluster_id, _ in rows] == [
+        ("1", "1"), ("2", "1"), ("3", None), ("4", None), ("5", "4")]
+    assert json.loads(rows[0][2])["cluster_id"] == "1"
+    backend.close()
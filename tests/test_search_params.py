@@ -0,0 +1,95 @@
+import math
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from query_builder import decode_cursor
+from search_params import (cursor_response, fast_insights_response, insights_query, msearch_error, msearch_searches,
+                           paginated_query, sample_probability)
+
+
+def hit(tweetid):
+    return {"_source": {"tweetid": tweetid}, "sort": [tweetid]}
+
+
+def test_cursor_response_keeps_the_point_in_time_open_on_full_pages():
+    results = {"hits": {"total": {"value": 3}, "hits": [hit(1), hit(2)]}, "pit_id": "pit-2"}
+    response, finished_pit_id = cursor_response(results, "pit-1", size=2)
+    assert response["tweets"] == [{"tweetid": 1}, {"tweetid": 2}]
+    assert decode_cursor(response["next_cursor"]) == ("pit-2", [2])
+    assert finished_pit_id is None
+
+
+def test_cursor_response_closes_the_point_in_time_on_the_last_page():
+    results = {"hits": {"total": {"value": 3}, "hits": [hit(3)]}}
+    response, finished_pit_id = cursor_response(results, "pit-1", size=2)
+    assert response == {"total": 3, "size": 2, "tweets": [{"tweetid": 3}], "next_cursor": None}
+    assert finished_pit_id == "pit-1"
+
+
+def test_msearch_searches_caches_aggregation_only_searches():
+    query_body, _, _ = paginated_query(MultiDict(), "ioa-tweets")
+    aggs_body = insights_query(MultiDict(), "ioa-tweets")
+    headers = msearch_searches([query_body, aggs_body])[::2]
+    assert headers == [{"index": "ioa-tweets", "ignore_unavailable": True},
+                       {"index": "ioa-tweets", "ignore_unavailable": True, "request_cache": True}]
+
+
+def test_msearch_error():
+    assert msearch_error([{"hits": {}}, {"hits": {}}]) is None
+    assert msearch_error([{"hits": {}}, {"error": "boom", "status": 503}]) == ({"error": "boom"}, 503)
+
+
+def test_date_ranges_only_search_their_yearly_indices():
+    query_body, _, _ = paginated_query(MultiDict({"from": "2019-03-01", "to": "2020-06-30"}), "ioa-tweets")
+    assert query_body.get_index() == "ioa-tweets-2019,ioa-tweets-2020"
+
+
+def test_wide_date_ranges_search_the_alias():
+    query_body, _, _ = paginated_query(MultiDict({"from": "1000-01-01"}), "ioa-tweets")
+    assert query_body.get_index() == "ioa-tweets"
+    query_body, _, _ = paginated_query(MultiDict({"from": "2020-01-01", "to": "9999-12-31"}), "ioa-tweets")
+    assert query_body.get_index() == "ioa-tweets"
+
+
+def test_unpartitioned_indices_are_searched_through_the_alias(monkeypatch):
+    monkeypatch.setenv("PARTITION_BY_YEAR", "false")
+    query_body, _, _ = paginated_query(MultiDict({"from": "2019-03-01", "to": "2020-06-30"}), "ioa-tweets")
+    assert query_body.get_index() == "ioa-tweets"
+
+
+@pytest.mark.parametrize("sample", ["nan", "NaN", "inf", "abc", ""])
+def test_sample_probability_rejects_what_isnt_a_finite_number(sample):
+    with pytest.raises(ValueError, match="sample must be a number"):
+        sample_probability(MultiDict({"sample": sample}))
+
+
+def test_sample_probability_is_clamped():
+    assert sample_probability(MultiDict()) == 0.1
+    assert sample_probability(MultiDict({"sample": "0.9"})) == 0.5
+    assert sample_probability(MultiDict({"sample": "0"})) == 0.0001
+    assert sample_probability(MultiDict({"sample": "1"})) == 1
+
+
+def test_fast_insights_error_estimate():
+    def terms(*counts):
+        return {"buckets": [{"key": str(i), "doc_count": count} for i, count in enumerate(counts)],
+                "doc_count_error_upper_bound": 2}
+
+    aggregations = {
+        "sample": {"probability": 0.1, "doc_count": 50, "tweets_over_time": {"buckets": [{"doc_count": 0}]},
+                   "top_users": terms(40, 10), "top_hashtags": terms(), "top_urls": terms(90)},
+        "unique_users": {"value": 12}, "unique_hashtags": {"value": 5000}, "unique_urls": {"value": 0}
+    }
+    approximation = fast_insights_response(aggregations)["approximation"]
+    assert approximation["sample_probability"] == 0.1 and approximation["sampled_tweets"] == 50
+    # Worst relative error of the buckets, the one of the smallest non empty count
+    assert approximation["relative_error"]["top_users"] == pytest.approx(math.sqrt(0.9 / (0.1 * 10)))
+    assert approximation["relative_error"]["top_urls"] == pytest.approx(math.sqrt(0.9 / (0.1 * 90)))
+    assert approximation["relative_error"]["top_hashtags"] == 0.0
+    assert approximation["relative_error"]["tweets_over_time"] == 0.0
+    assert approximation["doc_count_error_upper_bound"]["top_users"] == 2
+    assert approximation["cardinality_exact"] == {"unique_users": True, "unique_hashtags": False, "unique_urls": True}
+
+    aggregations["sample"]["probability"] = 1
+    assert fast_insights_response(aggregations)["approximation"]["relative_error"]["top_users"] == 0.0